@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Сравнение пикового RSS: полные словари страниц против компактных OfferRecord.
+
+Генерирует синтетический каталог (по умолчанию 50 000 позиций, страницы по 100 строк
+в формате ответа /entity/product с expand) и в отдельном процессе для каждого режима
+декодирует все страницы:
+
+- dicts   — прежний путь: json.loads страницы, все строки хранятся до конца прогона;
+- records — новый путь: быстрый декодер (orjson, если установлен) и свертка строк
+            в OfferRecord сразу после разбора страницы.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_decode.py --items 50000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGE_SIZE = 100
+PRICE_TYPE_IDS = [
+    "9fd68e0e-ca75-11ef-0a80-0c7900359c7d",
+    "a1b2c3d4-0000-11ef-0a80-000000000001",
+    "a1b2c3d4-0000-11ef-0a80-000000000002",
+    "a1b2c3d4-0000-11ef-0a80-000000000003",
+]
+API = "https://api.moysklad.ru/api/remap/1.2"
+
+
+def make_row(i):
+    entity_id = f"{i:08d}-0000-11ef-0a80-000000000000"
+    return {
+        "meta": {
+            "href": f"{API}/entity/product/{entity_id}",
+            "metadataHref": f"{API}/entity/product/metadata",
+            "type": "product",
+            "mediaType": "application/json",
+            "uuidHref": f"https://online.moysklad.ru/app/#good/edit?id={entity_id}",
+        },
+        "id": entity_id,
+        "accountId": "00000000-0000-11ef-0a80-000000000000",
+        "updated": "2026-01-01 00:00:00.000",
+        "name": f"Товар номер {i} с достаточно длинным наименованием",
+        "code": str(100000 + i),
+        "externalCode": f"ext{i:08d}",
+        "archived": False,
+        "pathName": "Каталог/Раздел/Подраздел",
+        "productFolder": {"meta": {"href": f"{API}/entity/productfolder/f{i % 50}", "type": "productfolder"}},
+        "attributes": [
+            {
+                "meta": {"href": f"{API}/entity/product/metadata/attributes/attr{n}", "type": "attributemetadata"},
+                "id": f"attr{n}",
+                "name": f"Доп. поле {n}",
+                "type": "string",
+                "value": f"значение {n} для товара {i}",
+            }
+            for n in range(8)
+        ],
+        "salePrices": [
+            {
+                "value": (1000 + i % 9000) * 100,
+                "currency": {"meta": {"href": f"{API}/entity/currency/kzt", "type": "currency"}},
+                "priceType": {
+                    "meta": {"href": f"{API}/context/companysettings/pricetype/{pt}", "type": "pricetype"},
+                    "id": pt,
+                    "name": f"Тип цены {n}",
+                    "externalCode": f"pt{n}",
+                },
+            }
+            for n, pt in enumerate(PRICE_TYPE_IDS)
+        ],
+        "barcodes": [{"ean13": f"{2000000000000 + i}"}],
+        "weight": 0.5,
+        "volume": 0.001,
+    }
+
+
+def iter_pages(items):
+    for offset in range(0, items, PAGE_SIZE):
+        rows = [make_row(i) for i in range(offset, min(offset + PAGE_SIZE, items))]
+        yield json.dumps({"meta": {"size": items, "offset": offset}, "rows": rows}, ensure_ascii=False).encode("utf-8")
+
+
+def peak_rss_mb():
+    # ru_maxrss в килобайтах на Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode, items):
+    import kaspi_xml_sync
+
+    baseline = peak_rss_mb()
+    kept = []
+    started = time.perf_counter()
+    for body in iter_pages(items):
+        if mode == "dicts":
+            kept.extend(json.loads(body)["rows"])
+        else:
+            kept.extend(kaspi_xml_sync.project_entity_row(row) for row in kaspi_xml_sync.json_loads(body)["rows"])
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": mode,
+        "items": len(kept),
+        "peak_rss_delta_mb": round(peak_rss_mb() - baseline, 1),
+        "decode_seconds": round(elapsed, 2),
+        "json_backend": "orjson" if kaspi_xml_sync.orjson and mode == "records" else "json",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=50000)
+    parser.add_argument("--mode", choices=["dicts", "records"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.items)))
+        return
+
+    results = []
+    for mode in ("dicts", "records"):
+        # Каждый режим в своем процессе: ru_maxrss монотонен в пределах процесса
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--items", str(args.items), "--mode", mode],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    for result in results:
+        print(f"{result['mode']:>8}: {result['items']} позиций, пик RSS +{result['peak_rss_delta_mb']} МБ, "
+              f"разбор {result['decode_seconds']} с ({result['json_backend']})")
+    dicts, records = results
+    if records["peak_rss_delta_mb"] > 0:
+        print(f"Снижение пикового RSS: в {dicts['peak_rss_delta_mb'] / records['peak_rss_delta_mb']:.1f} раза")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Масштабирование рендеринга офферов по числу процессов.
+
+Строит синтетические строки офферов в формате offer_render (по умолчанию 200 000 позиций)
+и рендерит их:
+
+- inline   — в основном процессе одним вызовом render_offers (как при каталоге меньше
+             RENDER_POOL_THRESHOLD);
+- pool N   — шардами в ProcessPoolExecutor на N процессах, включая передачу шардов
+             в процессы и склейку фрагментов (пул прогревается заранее, его запуск не входит в замер).
+
+Для каждого режима печатается время, офферов в секунду и ускорение относительно inline,
+а также проверяется, что склеенный результат совпадает с inline побайтно.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_render.py --items 200000 --processes 1,2,4,8
+"""
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from offer_render import render_offers, split_shards
+from price_rules import compile_price_rules
+
+PRICE_RULES = {
+    "exact_price_adjustments": {str(price): {"operation": "add", "value": -1} for price in range(1000, 91000, 1000)},
+    "range_price_adjustments": [
+        {"min": start, "max": start + 999, "operation": "percent", "value": 3} for start in range(50000, 91000, 1000)
+    ],
+    "rounding": {"step": 100, "ending": 90, "min_price": 2000},
+}
+
+
+def make_rows(items, stores):
+    rows = []
+    for i in range(items):
+        entity_type = "bundle" if i % 10 == 0 else "product"
+        availabilities = tuple((f"PP{store + 1}", (i * 7 + store * 3) % 13) for store in range(stores))
+        price = 1000 + (i * 37) % 90000
+        name = f"Товар {i} с достаточно длинным наименованием & <спецсимволами>"
+        rows.append((f"{i:08d}-0000-4000-8000-000000000001", entity_type, str(100000 + i), name, f"Бренд {i % 40}",
+                     name, str(100000 + i), f"folder{i % 50}", ((availabilities, price, entity_type == "bundle"),)))
+    return rows
+
+
+def render_pool(pool, rows, rules, shards):
+    futures = [pool.submit(render_offers, shard, 1, rules) for shard in split_shards(rows, shards)]
+    results = [future.result() for future in futures]
+    return "".join(result[0][0] for result in results), sum(result[0][2]["offers"] for result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=200000)
+    parser.add_argument("--stores", type=int, default=1, help="складов (availability) в оффере")
+    parser.add_argument("--processes", default=",".join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1) * 2),
+                        help="число процессов через запятую")
+    parser.add_argument("--shards-per-process", type=int, default=2)
+    args = parser.parse_args()
+
+    rules = compile_price_rules(PRICE_RULES)
+    rows = make_rows(args.items, args.stores)
+    print(f"{args.items} позиций, {args.stores} склад(ов), процессоров: {os.cpu_count()}")
+
+    started = time.perf_counter()
+    inline = render_offers(rows, 1, rules)[0]
+    inline_seconds = time.perf_counter() - started
+    print(f"{'inline':>8}: {inline_seconds:7.3f} с  {inline[2]['offers'] / inline_seconds:10.0f} офферов/с")
+
+    for processes in (int(value) for value in args.processes.split(",") if value):
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as pool:
+            # Прогрев: запуск процессов и импорт модулей не входят в замер
+            list(pool.map(render_offers, [rows[:10]] * processes, [1] * processes, [rules] * processes))
+            started = time.perf_counter()
+            body, offers = render_pool(pool, rows, rules, processes * args.shards_per_process)
+            seconds = time.perf_counter() - started
+        same = "совпадает" if body == inline[0] else "ОТЛИЧАЕТСЯ"
+        print(f"{'pool ' + str(processes):>8}: {seconds:7.3f} с  {offers / seconds:10.0f} офферов/с  "
+              f"ускорение {inline_seconds / seconds:4.2f}x  (XML {same} с inline)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""Локальная замена API МойСклад для бенчмарков: синтетический каталог и aiohttp-сервер.
+
+Каталог детерминирован (зависит только от размеров и seed) и строится лениво: строка
+товара или комплекта генерируется по индексу при запросе страницы, поэтому каталог
+на 100 000 товаров не держится в памяти целиком.
+
+Сервер поддерживает то, что использует kaspi_xml_sync:
+
+- POST /security/token;
+- GET /entity/store — склад по фильтру externalCode (каждому коду выдается свой склад);
+- GET /entity/product, /entity/bundle, /entity/variant — limit/offset, meta.size,
+  фильтры по атрибуту «Выгружать на Каспи?», id=...;id=... и updated>=...; с expand страница
+  ограничена max_page строками, без него — 1000, как у МойСклад;
+- GET /entity/assortment — товары с остатками склада из фильтра stockStore=...;
+- GET /report/stock/all — остатки по складу страницами до 1000 строк;
+- GET /report/stock/bystore — остатки по складам из фильтра store=...;store=....
+- GET /report/stock/all/current, /report/stock/bystore/current — краткий отчет текущих остатков
+  (stockType=stock|freeStock|reserve) по складам из фильтра storeId=...;storeId=..., одним ответом.
+
+Цены и остатки товаров можно менять, а товары — удалять (SyntheticCatalog.price_overrides,
+stock_overrides, deleted, а новое значение updated — в touched); post_webhook() отправляет
+вебхук об этом, как МойСклад.
+
+Задержка ответа, максимальный размер страницы и лимиты (запросов за период и параллельных
+запросов, при превышении — 429 с X-Lognex-Retry-After, как у МойСклад) настраиваются.
+"""
+import asyncio
+import random
+import time
+from collections import deque
+
+import aiohttp
+from aiohttp import web
+
+API_PATH = "/api/remap/1.2"
+MAX_PAGE = 1000
+STORE_ID = "00000000-0000-4000-8000-00000000000s"
+
+
+def store_id(number):
+    return f"{number:08d}-0000-4000-8000-00000000000s"
+
+
+def entity_id(kind, index):
+    return f"{index:08d}-0000-4000-8000-{kind:012d}"
+
+
+def entity_index(value):
+    return int(value.split("-")[0])
+
+
+class SyntheticCatalog:
+    """
+    Синтетический каталог: products товаров (каждый flagged_every-й не отмечен для Каспи),
+    bundles комплектов из 2–4 товаров, часть комплектов (nested_ratio) содержит вложенный
+    комплект, у части комплектов нет своей цены (цена считается по компонентам).
+    in_stock_ratio — доля товаров, у которых вообще есть остаток (остальные — 0 на всех складах).
+    """
+
+    PRODUCT = 1
+    BUNDLE = 2
+
+    def __init__(self, products=10000, bundles=1000, nested_ratio=0.1, flagged_every=10, seed=1,
+                 attribute_id="", price_type_id="", in_stock_ratio=1.0):
+        self.products = products
+        self.bundles = bundles
+        self.nested_ratio = nested_ratio
+        self.flagged_every = flagged_every
+        self.seed = seed
+        self.attribute_id = attribute_id
+        self.price_type_id = price_type_id
+        self.in_stock_ratio = in_stock_ratio
+        self.updated = "2026-01-01 00:00:00.000"
+        # Изменения поверх синтетических данных (для тестов вебхуков): цена и (остаток, резерв) товара,
+        # удаленные товары
+        self.price_overrides = {}
+        self.stock_overrides = {}
+        self.deleted = set()
+        # {(тип, индекс): updated} сущностей, измененных после self.updated
+        self.touched = {}
+
+    def _rng(self, kind, index):
+        return random.Random(self.seed * 1_000_003 + kind * 10_000_019 + index)
+
+    def updated_of(self, entity_type, index):
+        return self.touched.get((entity_type, index), self.updated)
+
+    def count(self, entity_type):
+        return {"product": self.products, "bundle": self.bundles}.get(entity_type, 0)
+
+    def is_flagged(self, entity_type, index):
+        return entity_type == "bundle" or index % self.flagged_every != 0
+
+    def price(self, index):
+        if index in self.price_overrides:
+            return self.price_overrides[index]
+        return 1000 + (index * 37) % 90000
+
+    def stock(self, index, store=0):
+        """(остаток, резерв) товара на складе с номером store."""
+        if index in self.stock_overrides:
+            return self.stock_overrides[index]
+        if self.in_stock_ratio < 1 and (index * 2654435761) % 1000 >= self.in_stock_ratio * 1000:
+            return 0, 0
+        return (index * 7 + store * 3) % 13, 1 if index % 5 == 0 else 0
+
+    def components(self, index):
+        """[(тип, индекс, количество)] комплекта."""
+        rng = self._rng(self.BUNDLE, index)
+        result = [("product", rng.randrange(self.products), rng.randint(1, 3)) for _ in range(rng.randint(2, 4))]
+        if index > 0 and rng.random() < self.nested_ratio:
+            result.append(("bundle", rng.randrange(index), 1))
+        return result
+
+    def _meta(self, base, entity_type, index):
+        kind = self.PRODUCT if entity_type == "product" else self.BUNDLE
+        return {
+            "href": f"{base}/entity/{entity_type}/{entity_id(kind, index)}",
+            "metadataHref": f"{base}/entity/{entity_type}/metadata",
+            "type": entity_type,
+            "mediaType": "application/json",
+        }
+
+    def _sale_prices(self, base, value):
+        return [
+            {"value": value * 100, "currency": {"meta": {"href": f"{base}/entity/currency/kzt", "type": "currency"}},
+             "priceType": {"meta": {"href": f"{base}/context/companysettings/pricetype/{self.price_type_id}",
+                                    "type": "pricetype"}, "id": self.price_type_id, "name": "Каспи"}},
+            {"value": value * 90, "priceType": {"id": "00000000-0000-4000-8000-0000000000p2", "name": "Опт"}},
+        ]
+
+    def _attributes(self, base, entity_type, flagged):
+        return [
+            {"meta": {"href": f"{base}/entity/{entity_type}/metadata/attributes/{self.attribute_id}",
+                      "type": "attributemetadata"}, "id": self.attribute_id, "name": "Выгружать на Каспи?",
+             "type": "boolean", "value": flagged},
+            {"meta": {"href": f"{base}/entity/{entity_type}/metadata/attributes/extra",
+                      "type": "attributemetadata"}, "id": "extra", "name": "Описание", "type": "string",
+             "value": "Дополнительное описание позиции для Kaspi"},
+        ]
+
+    def product_row(self, base, index):
+        return {
+            "meta": self._meta(base, "product", index),
+            "id": entity_id(self.PRODUCT, index),
+            "updated": self.updated_of("product", index),
+            "name": f"Товар {index} с достаточно длинным наименованием",
+            "code": str(100000 + index),
+            "externalCode": f"ext{index:08d}",
+            "archived": False,
+            "pathName": "Каталог/Раздел",
+            "productFolder": {"meta": {"href": f"{base}/entity/productfolder/folder{index % 50}",
+                                       "type": "productfolder"}},
+            "brand": {"name": f"Бренд {index % 40}"} if index % 3 else None,
+            "attributes": self._attributes(base, "product", self.is_flagged("product", index)),
+            "salePrices": self._sale_prices(base, self.price(index)),
+            "barcodes": [{"ean13": f"{2000000000000 + index}"}],
+        }
+
+    def bundle_row(self, base, index, expand_assortment=True):
+        rows = []
+        for comp_type, comp_index, quantity in self.components(index):
+            if comp_type == "product" and expand_assortment:
+                assortment = self.product_row(base, comp_index)
+            else:
+                assortment = {"meta": self._meta(base, comp_type, comp_index)}
+            rows.append({"quantity": quantity, "assortment": assortment})
+        own_price = 0 if index % 2 else 5000 + index % 1000
+        return {
+            "meta": self._meta(base, "bundle", index),
+            "id": entity_id(self.BUNDLE, index),
+            "updated": self.updated_of("bundle", index),
+            "name": f"Комплект {index}",
+            "code": f"B{100000 + index}",
+            "archived": False,
+            "productFolder": {"meta": {"href": f"{base}/entity/productfolder/bundles", "type": "productfolder"}},
+            "attributes": self._attributes(base, "bundle", True),
+            "salePrices": self._sale_prices(base, own_price),
+            "components": {"meta": {"size": len(rows)}, "rows": rows},
+        }
+
+    def row(self, base, entity_type, index, expand_assortment=True):
+        if entity_type == "product":
+            return self.product_row(base, index)
+        return self.bundle_row(base, index, expand_assortment)
+
+    def stock_row(self, base, index, store=0):
+        stock, reserve = self.stock(index, store)
+        return {"meta": dict(self._meta(base, "product", index),
+                             href=f"{base}/entity/product/{entity_id(self.PRODUCT, index)}?expand=supplier"),
+                "stock": stock, "reserve": reserve, "inTransit": 0, "quantity": stock - reserve,
+                "name": f"Товар {index}", "code": str(100000 + index)}
+
+    def stock_by_store_row(self, base, index, stores):
+        store_rows = []
+        for store in stores:
+            stock, reserve = self.stock(index, store)
+            store_rows.append({"meta": {"href": f"{base}/entity/store/{store_id(store)}", "type": "store"},
+                               "name": f"Склад {store}", "stock": stock, "reserve": reserve, "inTransit": 0})
+        return {"meta": self._meta(base, "product", index), "stockByStore": store_rows}
+
+
+class FakeMoySklad:
+    """
+    aiohttp-приложение с лимитами и задержкой; stats — счетчики запросов по путям и ответов 429.
+    failing_id_paths — пути сущностей (например, "/entity/product"), запросы которых по id отвечают 503.
+    """
+
+    def __init__(self, catalog, latency=0.05, max_page=100, rate_limit=45, rate_period=3.0, max_parallel=5,
+                 retry_after_ms=1000):
+        self.catalog = catalog
+        self.latency = latency
+        self.max_page = max_page
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.max_parallel = max_parallel
+        self.retry_after_ms = retry_after_ms
+        self._recent = deque()
+        self._active = 0
+        self._stores = {}
+        self.failing_id_paths = set()
+        self.stats = {"requests": 0, "throttled": 0, "by_path": {}}
+        self.runner = None
+        self.base_url = None
+
+    def make_app(self):
+        app = web.Application(middlewares=[self._limits])
+        app.router.add_post(f"{API_PATH}/security/token", self.token)
+        app.router.add_get(f"{API_PATH}/entity/store", self.store)
+        app.router.add_get(f"{API_PATH}/entity/assortment", self.assortment)
+        app.router.add_get(f"{API_PATH}/entity/{{entity_type}}", self.entities)
+        app.router.add_get(f"{API_PATH}/report/stock/all", self.stock)
+        app.router.add_get(f"{API_PATH}/report/stock/bystore", self.stock_by_store)
+        app.router.add_get(f"{API_PATH}/report/stock/all/current", self.current_stock)
+        app.router.add_get(f"{API_PATH}/report/stock/bystore/current", self.current_stock)
+        return app
+
+    @web.middleware
+    async def _limits(self, request, handler):
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > self.rate_period:
+            self._recent.popleft()
+        self.stats["requests"] += 1
+        path = request.path[len(API_PATH):]
+        self.stats["by_path"][path.split("?")[0]] = self.stats["by_path"].get(path.split("?")[0], 0) + 1
+        if (self.rate_limit and len(self._recent) >= self.rate_limit) or \
+                (self.max_parallel and self._active >= self.max_parallel):
+            self.stats["throttled"] += 1
+            return web.json_response({"errors": [{"error": "Превышено ограничение на количество запросов", "code": 1049}]},
+                                     status=429, headers={"X-Lognex-Retry-After": str(self.retry_after_ms)})
+        if path in self.failing_id_paths and any(condition.startswith("id=")
+                                                 for condition in request.query.get("filter", "").split(";")):
+            return web.json_response({"errors": [{"error": "Сервис временно недоступен"}]}, status=503)
+        self._recent.append(now)
+        self._active += 1
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await handler(request)
+        finally:
+            self._active -= 1
+
+    def _base(self, request):
+        return f"{request.scheme}://{request.host}{API_PATH}"
+
+    async def token(self, request):
+        return web.json_response({"access_token": "benchmark-token"}, status=201)
+
+    def _authorized(self, request):
+        return request.headers.get("Authorization") == "Bearer benchmark-token"
+
+    async def store(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401)
+        code = request.query.get("filter", "").partition("externalCode=")[2]
+        number = self._stores.setdefault(code, len(self._stores))
+        href = f"{self._base(request)}/entity/store/{store_id(number)}"
+        return web.json_response({"meta": {"size": 1},
+                                  "rows": [{"meta": {"href": href, "type": "store"}, "id": store_id(number)}]})
+
+    def _select(self, entity_type, filter_value):
+        """Индексы сущностей, подходящих под фильтр API."""
+        count = self.catalog.count(entity_type)
+        ids = None
+        attribute_only = False
+        updated_since = None
+        for condition in filter(None, filter_value.split(";")):
+            if condition.startswith("id="):
+                ids = (ids or []) + [entity_index(condition[3:])]
+            elif "/attributes/" in condition and condition.endswith("=true"):
+                attribute_only = True
+            elif condition.startswith("updated>="):
+                updated_since = condition[len("updated>="):]
+        indexes = sorted(i for i in ids if 0 <= i < count) if ids is not None else range(count)
+        if updated_since is not None:
+            indexes = [i for i in indexes if self.catalog.updated_of(entity_type, i) >= updated_since]
+        if entity_type == "product" and self.catalog.deleted:
+            indexes = [i for i in indexes if i not in self.catalog.deleted]
+        if attribute_only:
+            return [i for i in indexes if self.catalog.is_flagged(entity_type, i)]
+        return indexes
+
+    async def entities(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401)
+        entity_type = request.match_info["entity_type"]
+        if entity_type not in ("product", "bundle", "variant"):
+            return web.json_response({"errors": [{"error": "not found"}]}, status=404)
+        limit = min(int(request.query.get("limit", 1000)), self.max_page if "expand" in request.query else MAX_PAGE)
+        offset = int(request.query.get("offset", 0))
+        indexes = self._select(entity_type, request.query.get("filter", ""))
+        expand = "components.assortment" in request.query.get("expand", "")
+        base = self._base(request)
+        rows = [self.catalog.row(base, entity_type, i, expand) for i in indexes[offset:offset + limit]]
+        return web.json_response({"meta": {"size": len(indexes), "limit": limit, "offset": offset}, "rows": rows})
+
+    async def assortment(self, request):
+        """Ассортимент: товары (модификаций в каталоге нет) с полями stock/reserve/quantity склада stockStore."""
+        if not self._authorized(request):
+            return web.Response(status=401)
+        limit = min(int(request.query.get("limit", 1000)), MAX_PAGE)
+        offset = int(request.query.get("offset", 0))
+        conditions = request.query.get("filter", "").split(";")
+        types = {condition[len("type="):] for condition in conditions if condition.startswith("type=")}
+        store = next((entity_index(condition.split("/")[-1]) for condition in conditions
+                      if condition.startswith("stockStore=")), None)
+        total = self.catalog.products if not types or "product" in types else 0
+        base = self._base(request)
+        rows = []
+        for index in range(offset, min(offset + limit, total)):
+            row = self.catalog.product_row(base, index)
+            if store is not None:
+                stock, reserve = self.catalog.stock(index, store)
+                row.update(stock=stock, reserve=reserve, inTransit=0, quantity=stock - reserve)
+            rows.append(row)
+        return web.json_response({"meta": {"size": total, "limit": limit, "offset": offset}, "rows": rows})
+
+    async def stock(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401)
+        limit = min(int(request.query.get("limit", 1000)), 1000)
+        offset = int(request.query.get("offset", 0))
+        base = self._base(request)
+        store = entity_index(request.query.get("store.id", STORE_ID))
+        end = min(offset + limit, self.catalog.products)
+        rows = [self.catalog.stock_row(base, i, store) for i in range(offset, end)]
+        return web.json_response({"meta": {"size": self.catalog.products, "limit": limit, "offset": offset},
+                                  "rows": rows})
+
+    async def stock_by_store(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401)
+        limit = min(int(request.query.get("limit", 1000)), 1000)
+        offset = int(request.query.get("offset", 0))
+        stores = [entity_index(condition.split("/")[-1]) for condition in request.query.get("filter", "").split(";")
+                  if condition.startswith("store=")]
+        base = self._base(request)
+        end = min(offset + limit, self.catalog.products)
+        rows = [self.catalog.stock_by_store_row(base, i, stores) for i in range(offset, end)]
+        return web.json_response({"meta": {"size": self.catalog.products, "limit": limit, "offset": offset},
+                                  "rows": rows})
+
+    async def current_stock(self, request):
+        """Краткий отчет: [{assortmentId, stock}] (по складам — еще storeId), строки с нулем не передаются."""
+        if not self._authorized(request):
+            return web.Response(status=401)
+        stock_type = request.query.get("stockType", "stock")
+        stores = [condition[len("storeId="):] for condition in request.query.get("filter", "").split(";")
+                  if condition.startswith("storeId=")] or [STORE_ID]
+        by_store = request.path.endswith("/bystore/current")
+        rows = []
+        for index in range(self.catalog.products):
+            totals = []
+            for store in stores:
+                stock, reserve = self.catalog.stock(index, entity_index(store))
+                totals.append({"stock": stock, "freeStock": stock - reserve, "reserve": reserve}.get(stock_type, stock))
+            assortment_id = entity_id(SyntheticCatalog.PRODUCT, index)
+            if by_store:
+                rows.extend({"assortmentId": assortment_id, "storeId": store, "stock": value}
+                            for store, value in zip(stores, totals) if value)
+            elif sum(totals):
+                rows.append({"assortmentId": assortment_id, "stock": sum(totals)})
+        return web.json_response(rows)
+
+    def webhook_payload(self, entity_type=None, indexes=(), action="UPDATE", stock_changed=False):
+        """Тело вебхука МойСклад: события по сущностям или (stock_changed) об изменении остатков."""
+        base = self.base_url or f"http://127.0.0.1{API_PATH}"
+        if stock_changed:
+            return {"accountId": "benchmark", "stockType": "stock", "reportType": "all",
+                    "reportUrl": f"{base}/report/stock/all/current?changedSince=2026-01-01 00:00:00"}
+        return {"auditContext": {"meta": {"type": "audit"}, "uid": "admin@benchmark", "moment": self.catalog.updated},
+                "events": [{"meta": self.catalog._meta(base, entity_type, index), "action": action,
+                            "accountId": "benchmark"} for index in indexes]}
+
+    async def post_webhook(self, url, payload):
+        """Отправляет вебхук на url, как МойСклад; возвращает (HTTP-статус, JSON ответа)."""
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=payload) as response:
+                return response.status, await response.json()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}{API_PATH}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест /xml: N одновременных «поллеров», как Kaspi и зеркала фида.
+
+Каждый поллер в цикле запрашивает фид в течение --duration секунд. Режимы:
+
+- plain — без сжатия и условных заголовков (полная выдача каждый раз);
+- gzip  — Accept-Encoding: gzip, br;
+- etag  — условный запрос с If-None-Match из первого ответа (ожидается 304).
+
+Без --url скрипт сам генерирует синтетический фид (--offers позиций) во временном
+каталоге и поднимает сервер приложения (waitress, если установлен) на свободном порту.
+
+Запуск из корня репозитория:
+
+    python benchmarks/load_xml.py --concurrency 100 --duration 10
+    python benchmarks/load_xml.py --url http://localhost:5000/xml --modes etag
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build_feed(directory, offers):
+    """Синтетический kaspi.xml в directory/docs через штатный OfferXmlWriter."""
+    import kaspi_xml_sync
+
+    docs = os.path.join(directory, "docs")
+    os.makedirs(docs, exist_ok=True)
+    writer = kaspi_xml_sync.OfferXmlWriter(os.path.join(docs, "kaspi.xml"), "Company", "12345", "2024-01-01 00:00")
+    for i in range(offers):
+        writer.write_offer(f"SKU-{i:06d}", f"Товар номер {i} с длинным названием", "Brand", i % 17, 1000 + i)
+    writer.commit()
+
+
+def start_local_server(offers):
+    tmp = tempfile.mkdtemp(prefix="kaspi_load_")
+    build_feed(tmp, offers)
+    os.chdir(tmp)
+    os.environ["XML_FILE"] = "kaspi.xml"
+
+    import kaspi_xml_sync
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    kaspi_xml_sync.feed_cache.active = True
+
+    def serve():
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            kaspi_xml_sync.app.run(host="127.0.0.1", port=port, threaded=True)
+            return
+        waitress_serve(kaspi_xml_sync.app, host="127.0.0.1", port=port,
+                       threads=kaspi_xml_sync.HTTP_THREADS,
+                       connection_limit=kaspi_xml_sync.HTTP_CONNECTION_LIMIT, _quiet=True)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return f"http://127.0.0.1:{port}/xml"
+
+
+async def wait_ready(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def run_mode(url, mode, concurrency, duration):
+    headers = {"Accept-Encoding": "identity"}
+    if mode == "gzip":
+        headers = {"Accept-Encoding": "gzip, br"}
+    latencies = []
+    statuses = {}
+    transferred = 0
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, auto_decompress=False) as session:
+        if mode == "etag":
+            async with session.get(url, headers=headers) as response:
+                await response.read()
+                headers = dict(headers, **{"If-None-Match": response.headers["ETag"]})
+
+        deadline = time.monotonic() + duration
+
+        async def poller():
+            nonlocal transferred
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        body = await response.read()
+                        status = response.status
+                except aiohttp.ClientError as e:
+                    status = type(e).__name__
+                    body = b""
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+                transferred += len(body)
+
+        started = time.monotonic()
+        await asyncio.gather(*(poller() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+        "mb_per_s": round(transferred / elapsed / 1e6, 2),
+        "statuses": {str(k): v for k, v in statuses.items()},
+    }
+
+
+async def main(args):
+    url = args.url or start_local_server(args.offers)
+    await wait_ready(url)
+    results = []
+    for mode in args.modes.split(","):
+        result = await run_mode(url, mode, args.concurrency, args.duration)
+        print(f"{mode:6} {result['requests']:7d} запросов  {result['rps']:8.1f} rps  "
+              f"p50 {result['p50_ms']} мс  p99 {result['p99_ms']} мс  max {result['max_ms']} мс  "
+              f"{result['mb_per_s']} МБ/с  {result['statuses']}")
+        results.append(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "concurrency": args.concurrency, "duration": args.duration, "results": results}, f,
+                      ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="адрес /xml; без него поднимается локальный сервер")
+    parser.add_argument("--offers", type=int, default=20000, help="размер синтетического фида")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--modes", default="plain,gzip,etag")
+    parser.add_argument("--json", help="сохранить результаты в JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Сквозной бенчмарк генерации фида на синтетическом каталоге без обращения к МойСклад.
+
+Поднимает локальную замену API (benchmarks/fake_moysklad.py) и по очереди замеряет стадии:
+
+- fetch     — fetch_catalog(): товары, комплекты и остатки через ms_client;
+- bundles   — BundleResolver: индекс, догрузка компонентов, расчет остатков и цен;
+- price     — компиляция и применение правил цен ко всем позициям;
+- xml       — generate_xml(): расчет офферов и потоковая запись XML;
+- update    — update_xml() целиком (включает все стадии выше; с --pipeline — конвейером
+              STREAM_PIPELINE, в результатах — счетчики его стадий).
+
+Результаты сохраняются в JSON (по умолчанию benchmarks/results/<commit>.json); --compare
+печатает изменение времени стадий относительно сохраненного ранее файла.
+
+Запуск из корня репозитория:
+
+    python benchmarks/run_benchmarks.py --preset small
+    python benchmarks/run_benchmarks.py --products 100000 --bundles 5000 --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_moysklad import FakeMoySklad, SyntheticCatalog
+
+PRESETS = {
+    "small": {"products": 10000, "bundles": 1000},
+    "large": {"products": 100000, "bundles": 5000},
+}
+
+BENCH_PRICE_RULES = {
+    "exact_price_adjustments": {str(price): {"operation": "add", "value": -1} for price in range(1000, 91000, 1000)},
+    "range_price_adjustments": [
+        {"min": start, "max": start + 999, "operation": "percent", "value": 3} for start in range(50000, 91000, 1000)
+    ],
+    "rounding": {"step": 100, "ending": 90, "min_price": 2000},
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def prepare_environment(workdir, stores=1, assortment=False, stock_first=False, pipeline=False, stock_source="report"):
+    """Окружение до импорта kaspi_xml_sync: учетные данные, кэши и фид во временном каталоге."""
+    os.chdir(workdir)
+    os.environ.update({
+        "MS_LOGIN": "benchmark",
+        "MS_PASSWORD": "benchmark",
+        "CATALOG_DB": "",
+        "MS_TOKEN_CACHE_HOURS": "0",
+        "METADATA_CACHE_FILE": os.path.join(workdir, ".cache", "metadata.json"),
+        "FEED_MANIFEST_FILE": os.path.join(workdir, ".cache", "kaspi_manifest.json"),
+        "PRICE_RULES_FILE": os.path.join(workdir, "price_adjustments.json"),
+        "XML_FILE": "kaspi.xml",
+        "FORCE_PUBLISH": "1",
+        "LOG_CONSOLE": "0",
+        "MS_ASSORTMENT_MODE": "1" if assortment else "",
+        "MS_STOCK_FIRST": "1" if stock_first else "",
+        "STREAM_PIPELINE": "1" if pipeline else "",
+        "MS_STOCK_SOURCE": stock_source,
+    })
+    with open(os.environ["PRICE_RULES_FILE"], "w", encoding="utf-8") as f:
+        json.dump(BENCH_PRICE_RULES, f)
+    if stores > 1:
+        # Один фид с несколькими складами: остатки идут через /report/stock/bystore
+        os.environ["FEEDS_CONFIG"] = os.path.join(workdir, "feeds.json")
+        with open(os.environ["FEEDS_CONFIG"], "w", encoding="utf-8") as f:
+            json.dump({"feeds": [{"name": "kaspi", "stores": [
+                {"external_code": f"store{number}", "store_id": f"PP{number + 1}"} for number in range(stores)
+            ]}]}, f)
+
+
+async def timed(coro):
+    started = time.perf_counter()
+    result = await coro
+    return result, round(time.perf_counter() - started, 3)
+
+
+async def run(args):
+    import kaspi_xml_sync
+    from price_rules import compile_price_rules
+
+    catalog = SyntheticCatalog(products=args.products, bundles=args.bundles, nested_ratio=args.nested_ratio,
+                               attribute_id=kaspi_xml_sync.ATTRIBUTE_ID,
+                               price_type_id=kaspi_xml_sync.KASPI_PRICE_TYPE_ID, in_stock_ratio=args.in_stock_ratio)
+    server = FakeMoySklad(catalog, latency=args.latency / 1000, max_page=args.max_page,
+                          rate_limit=args.rate_limit, rate_period=args.rate_period, max_parallel=args.max_parallel)
+    kaspi_xml_sync.MS_API_BASE = await server.start()
+    results = {}
+    try:
+        fetched, seconds = await timed(kaspi_xml_sync.fetch_catalog())
+        results["fetch"] = {"seconds": seconds, "items": len(fetched.items),
+                            "stock_rows": sum(len(stock) for stock in fetched.stock_by_store.values()),
+                            "sources": fetched.timings, "server_requests": server.stats["requests"],
+                            "response_bytes": sum(kaspi_xml_sync.MS_RESPONSE_BYTES.snapshot().values()),
+                            "server_throttled": server.stats["throttled"],
+                            "client": dict(kaspi_xml_sync.ms_client.scheduler.stats)}
+
+        started = time.perf_counter()
+        resolver = kaspi_xml_sync.BundleResolver(fetched.items + fetched.component_records)
+        index_seconds = time.perf_counter() - started
+        state = kaspi_xml_sync.LiveCatalog(fetched.items, fetched.stock_by_store, resolver, fetched.checked_ids)
+        _, backfill_seconds = await timed(resolver.backfill(kaspi_xml_sync.current_token,
+                                                            bundle_ids=state.backfill_bundle_ids()))
+        started = time.perf_counter()
+        bundle_values = resolver.resolve(fetched.stock)
+        resolve_seconds = time.perf_counter() - started
+        results["bundles"] = {"seconds": round(index_seconds + backfill_seconds + resolve_seconds, 3),
+                              "index_seconds": round(index_seconds, 3), "backfill_seconds": backfill_seconds,
+                              "resolve_seconds": round(resolve_seconds, 3), "bundles": len(bundle_values)}
+
+        started = time.perf_counter()
+        rules = compile_price_rules(BENCH_PRICE_RULES)
+        compile_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        for record in fetched.items:
+            rules.apply(record.price, sku=record.code, folder=record.folder)
+        results["price"] = {"seconds": round(compile_seconds + time.perf_counter() - started, 3),
+                            "compile_seconds": round(compile_seconds, 3), "rules": len(rules),
+                            "offers": len(fetched.items)}
+
+        status, seconds = await timed(kaspi_xml_sync.generate_xml(
+            fetched.items, bundle_resolver=resolver, stock_by_store=fetched.stock_by_store))
+        xml_path = os.path.join("docs", "kaspi.xml")
+        results["xml"] = {"seconds": seconds, "status": status,
+                          "bytes": os.path.getsize(xml_path) if os.path.exists(xml_path) else 0}
+
+        requests_before = server.stats["requests"]
+        status, seconds = await timed(kaspi_xml_sync.update_xml())
+        results["update"] = {"seconds": seconds, "status": status,
+                             "server_requests": server.stats["requests"] - requests_before}
+        report = kaspi_xml_sync.last_run_report or {}
+        results["update"]["phases"] = report.get("phases")
+        if report.get("pipeline"):
+            results["update"]["pipeline"] = report["pipeline"]
+    finally:
+        await kaspi_xml_sync.ms_client.close()
+        await server.stop()
+    return results
+
+
+def compare(results, previous_path):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\nСравнение с {previous_path} (коммит {previous.get('commit')}):")
+    for stage, result in results.items():
+        before = previous.get("results", {}).get(stage, {}).get("seconds")
+        if not before:
+            continue
+        change = (result["seconds"] - before) / before * 100
+        print(f"  {stage:8} {before:8.3f} с -> {result['seconds']:8.3f} с  ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--products", type=int)
+    parser.add_argument("--bundles", type=int)
+    parser.add_argument("--nested-ratio", type=float, default=0.1, help="доля комплектов с вложенным комплектом")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа сервера, мс")
+    parser.add_argument("--max-page", type=int, default=100, help="максимальный limit страницы сущностей с expand")
+    parser.add_argument("--rate-limit", type=int, default=45, help="запросов за --rate-period (0 — без лимита)")
+    parser.add_argument("--rate-period", type=float, default=3.0)
+    parser.add_argument("--max-parallel", type=int, default=5, help="параллельных запросов (0 — без лимита)")
+    parser.add_argument("--stores", type=int, default=1, help="складов в фиде (больше 1 — отчет по складам)")
+    parser.add_argument("--assortment", action="store_true", help="загрузка через /entity/assortment (MS_ASSORTMENT_MODE)")
+    parser.add_argument("--stock-first", action="store_true", help="сначала остатки, затем товары по id (MS_STOCK_FIRST)")
+    parser.add_argument("--pipeline", action="store_true", help="update_xml конвейером (STREAM_PIPELINE)")
+    parser.add_argument("--stock-source", choices=("report", "current"), default="report",
+                        help="источник остатков (MS_STOCK_SOURCE)")
+    parser.add_argument("--in-stock-ratio", type=float, default=1.0, help="доля товаров с остатком")
+    parser.add_argument("--output", help="файл результатов (по умолчанию benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="файл результатов предыдущего запуска для сравнения")
+    args = parser.parse_args()
+    args.products = args.products or PRESETS[args.preset]["products"]
+    args.bundles = args.bundles if args.bundles is not None else PRESETS[args.preset]["bundles"]
+
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join(ROOT, "benchmarks", "results", f"{commit}.json"))
+    previous = os.path.abspath(args.compare) if args.compare else None
+    with tempfile.TemporaryDirectory(prefix="kaspi_bench_") as workdir:
+        prepare_environment(workdir, args.stores, args.assortment, args.stock_first, args.pipeline, args.stock_source)
+        results = asyncio.run(run(args))
+
+    for stage, result in results.items():
+        details = {key: value for key, value in result.items() if key != "seconds"}
+        print(f"{stage:8} {result['seconds']:8.3f} с  {details}")
+
+    report = {
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == "__main__":
+    main()
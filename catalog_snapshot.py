@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Снимок загруженного каталога (JSONL.gz): позиции фида, компоненты комплектов и остатки по складам.
+
+Снимок позволяет перегенерировать XML без обращения к МойСклад (cloud_run.py render) и служит
+фикстурой для сравнения результатов. Формат — gzip с JSON-строками:
+
+    {"type": "header", "format": "kaspi-catalog-snapshot", "version": 1, "created": ..., ...}
+    {"type": "item", "record": {...}}        — позиция фида (товар или комплект), в исходном порядке
+    {"type": "component", "record": {...}}   — компонент комплекта, не входящий в фид
+    {"type": "stock", "store": "<externalCode>", "stock": {id: остаток}}
+
+Записи — словари OfferRecord.to_dict(); модуль не зависит от kaspi_xml_sync.
+"""
+import datetime
+import gzip
+import json
+import os
+
+SNAPSHOT_FORMAT = "kaspi-catalog-snapshot"
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(ValueError):
+    """Файл не является снимком каталога поддерживаемой версии."""
+
+
+class CatalogSnapshot:
+    """Содержимое снимка: header (метаданные), items и components (словари записей), stock_by_store."""
+
+    def __init__(self, header, items, components, stock_by_store):
+        self.header = header
+        self.items = items
+        self.components = components
+        self.stock_by_store = stock_by_store
+
+
+def write_snapshot(path, items, components, stock_by_store, metadata=None):
+    """
+    Записывает снимок атомарно (через временный файл). items и components — словари записей,
+    metadata — дополнительные поля заголовка (типы цен, склады). Возвращает размер файла в байтах.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    header = dict(metadata or {}, type="header", format=SNAPSHOT_FORMAT, version=SNAPSHOT_VERSION,
+                  created=datetime.datetime.now().isoformat(timespec="seconds"),
+                  counts={"items": len(items), "components": len(components),
+                          "stock": {code: len(stock) for code, stock in stock_by_store.items()}})
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for kind, records in (("item", items), ("component", components)):
+            for record in records:
+                f.write(json.dumps({"type": kind, "record": record}, ensure_ascii=False, separators=(",", ":")) + "\n")
+        for code, stock in stock_by_store.items():
+            f.write(json.dumps({"type": "stock", "store": code, "stock": stock}, separators=(",", ":")) + "\n")
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def read_snapshot(path):
+    """Читает снимок; ошибка формата или версии — SnapshotError."""
+    items, components, stock_by_store = [], [], {}
+    header = None
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                entry = json.loads(line)
+                kind = entry.get("type")
+                if header is None:
+                    if kind != "header" or entry.get("format") != SNAPSHOT_FORMAT:
+                        raise SnapshotError(f"{path}: нет заголовка снимка каталога")
+                    if entry.get("version") != SNAPSHOT_VERSION:
+                        raise SnapshotError(f"{path}: версия снимка {entry.get('version')}, ожидается {SNAPSHOT_VERSION}")
+                    header = entry
+                elif kind == "item":
+                    items.append(entry["record"])
+                elif kind == "component":
+                    components.append(entry["record"])
+                elif kind == "stock":
+                    stock_by_store[entry["store"]] = entry["stock"]
+                else:
+                    raise SnapshotError(f"{path}:{line_number}: неизвестная строка {kind!r}")
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        if isinstance(e, SnapshotError):
+            raise
+        raise SnapshotError(f"Не удалось прочитать снимок {path}: {e}")
+    if header is None:
+        raise SnapshotError(f"{path}: пустой файл")
+    return CatalogSnapshot(header, items, components, stock_by_store)
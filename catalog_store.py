@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Локальное хранилище каталога МойСклад (SQLite) для инкрементальной синхронизации.
+
+Сущности (компактные записи в виде словарей) хранятся по id МойСклад вместе с полем `updated`. Для каждого типа
+сущности хранится водяной знак (максимальный `updated`), по которому следующий
+прогон запрашивает только измененные записи, и время последней полной сверки.
+"""
+import datetime
+import json
+import os
+import sqlite3
+
+# Версия формата записей; при несовпадении хранилище очищается и заполняется полной сверкой
+SCHEMA_VERSION = "4"
+
+
+class CatalogStore:
+    """
+    layout — описание состава записей помимо версии (например, набор сохраняемых типов цен):
+    при его изменении хранилище так же очищается.
+    """
+
+    def __init__(self, path, layout=""):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entities ("
+            "id TEXT PRIMARY KEY, entity_type TEXT NOT NULL, updated TEXT, data TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entities_type ON entities (entity_type)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+        version = f"{SCHEMA_VERSION}:{layout}" if layout else SCHEMA_VERSION
+        if self._get_state("schema_version") != version:
+            self._conn.execute("DELETE FROM entities")
+            self._conn.execute("DELETE FROM sync_state")
+            self._set_state("schema_version", version)
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def _get_state(self, key):
+        row = self._conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self._conn.execute(
+            "INSERT INTO sync_state (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    def watermark(self, entity_type):
+        """Максимальное значение `updated` среди сохраненных сущностей типа."""
+        return self._get_state(f"watermark:{entity_type}")
+
+    def needs_full_sync(self, entity_type, max_age_hours):
+        """Нужна ли полная сверка: хранилище пустое или последняя сверка старше max_age_hours."""
+        last_full = self._get_state(f"full_sync:{entity_type}")
+        if not last_full or self.watermark(entity_type) is None:
+            return True
+        age = datetime.datetime.now() - datetime.datetime.fromisoformat(last_full)
+        return age > datetime.timedelta(hours=max_age_hours)
+
+    def count(self, entity_type):
+        row = self._conn.execute("SELECT COUNT(*) FROM entities WHERE entity_type = ?", (entity_type,)).fetchone()
+        return row[0]
+
+    def load(self, entity_type):
+        """Все сохраненные сущности типа в порядке их первого появления."""
+        cursor = self._conn.execute(
+            "SELECT data FROM entities WHERE entity_type = ? ORDER BY rowid", (entity_type,)
+        )
+        return [json.loads(data) for (data,) in cursor]
+
+    def _advance_watermark(self, entity_type, items):
+        updated_values = [item.get("updated") for item in items if item.get("updated")]
+        current = self.watermark(entity_type)
+        if current:
+            updated_values.append(current)
+        if updated_values:
+            self._set_state(f"watermark:{entity_type}", max(updated_values))
+
+    def replace_all(self, entity_type, items):
+        """Полная сверка: заменяет все сущности типа и сбрасывает водяной знак."""
+        with self._conn:
+            self._conn.execute("DELETE FROM entities WHERE entity_type = ?", (entity_type,))
+            self._conn.execute("DELETE FROM sync_state WHERE key = ?", (f"watermark:{entity_type}",))
+            self._conn.executemany(
+                "INSERT INTO entities (id, entity_type, updated, data) VALUES (?, ?, ?, ?)",
+                [(item["id"], entity_type, item.get("updated"), json.dumps(item, ensure_ascii=False)) for item in items],
+            )
+            self._advance_watermark(entity_type, items)
+            self._set_state(f"full_sync:{entity_type}", datetime.datetime.now().isoformat())
+
+    def apply_changes(self, entity_type, upserts, removed):
+        """
+        Инкрементальное обновление: добавляет/обновляет измененные сущности
+        и удаляет снятые с выгрузки (removed — сущности, а не id, чтобы учесть их `updated`).
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO entities (id, entity_type, updated, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated = excluded.updated, data = excluded.data",
+                [(item["id"], entity_type, item.get("updated"), json.dumps(item, ensure_ascii=False)) for item in upserts],
+            )
+            self._conn.executemany("DELETE FROM entities WHERE id = ?", [(item["id"],) for item in removed])
+            self._advance_watermark(entity_type, upserts + removed)
@@ -1,5 +1,7 @@
+import argparse
 import asyncio
 import os
+import sys
 import json
 import base64
 import hashlib
@@ -10,6 +12,12 @@ import hashlib
 This script intentionally does not use Google Drive. Use GitHub Actions to
 publish `docs/kaspi.xml` on an hourly schedule (workflow present in
 .github/workflows/generate-xml.yml).
+
+Без аргументов выполняется полный прогон. Подкоманды работают со снимком каталога:
+
+    python cloud_run.py fetch  [--snapshot PATH]            # загрузить каталог и остатки в снимок
+    python cloud_run.py render [--snapshot PATH] [--force]  # сгенерировать XML из снимка без сети
+    python cloud_run.py run    [--snapshot PATH] [--force]  # fetch, затем render
 """
 
 import shutil
@@ -17,13 +25,81 @@ from dotenv import load_dotenv
 import kaspi_xml_sync
 
 
-async def main():
+def write_github_output(status):
+    """Передает итог прогона следующим шагам workflow (changed=false — деплой не нужен)."""
+    output_path = os.getenv('GITHUB_OUTPUT')
+    if not output_path:
+        return
+    with open(output_path, 'a', encoding='utf-8') as f:
+        f.write(f"status={status}\n")
+        f.write(f"changed={'true' if status == kaspi_xml_sync.RUN_UPDATED else 'false'}\n")
+
+
+def write_run_report(status):
+    """
+    Сохраняет JSON-отчет о прогоне (фазы, офферы, запросы к МойСклад, метрики) в RUN_REPORT_FILE.
+    Если прогон дольше RUN_SLOW_SECONDS, в GitHub Actions выводится предупреждение.
+    """
+    report = kaspi_xml_sync.last_run_report or {"status": status}
+    report_path = os.getenv('RUN_REPORT_FILE', os.path.join('.cache', 'run_report.json'))
+    directory = os.path.dirname(report_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Отчет о прогоне сохранен в {report_path}: {report.get('duration_seconds')} с, фазы {report.get('phases')}")
+
+    slow_seconds = float(os.getenv('RUN_SLOW_SECONDS', '0') or 0)
+    duration = report.get('duration_seconds') or 0
+    if slow_seconds and duration > slow_seconds:
+        print(f"::warning title=Медленный прогон::Генерация заняла {duration:.0f} с (порог {slow_seconds:.0f} с), фазы: {report.get('phases')}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Генерация kaspi.xml: полный прогон или работа со снимком каталога")
+    commands = parser.add_subparsers(dest="command")
+    for name, help_text in (("fetch", "загрузить каталог и остатки в снимок"),
+                            ("render", "сгенерировать XML из снимка без обращения к МойСклад"),
+                            ("run", "загрузить снимок и сгенерировать из него XML")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--snapshot", default=os.getenv('CATALOG_SNAPSHOT', os.path.join('.cache', 'catalog_snapshot.jsonl.gz')),
+                             help="файл снимка (по умолчанию CATALOG_SNAPSHOT или .cache/catalog_snapshot.jsonl.gz)")
+        if name != "fetch":
+            command.add_argument("--force", action="store_true", help="опубликовать фид, даже если офферы не изменились")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
     load_dotenv()
-    print("\nНачинаем процесс генерации kaspi.xml...")
+    args = parse_args(argv)
+    if getattr(args, "force", False):
+        kaspi_xml_sync.FORCE_PUBLISH = True
+
+    if args.command in ("fetch", "run"):
+        print(f"\nЗагружаем каталог в снимок {args.snapshot}...")
+        async with kaspi_xml_sync.ms_client:
+            size = await kaspi_xml_sync.fetch_snapshot(args.snapshot)
+        if size is None:
+            status = kaspi_xml_sync.RUN_FAILED
+            write_github_output(status)
+            print("Не удалось загрузить каталог, снимок не сохранен.")
+            return status
+        if args.command == "fetch":
+            return kaspi_xml_sync.RUN_UPDATED
 
-    await kaspi_xml_sync.update_xml()
-    print("Процесс генерации kaspi.xml завершен.")
+    if args.command in ("render", "run"):
+        print(f"\nГенерируем kaspi.xml из снимка {args.snapshot}...")
+        status = await kaspi_xml_sync.render_snapshot(args.snapshot)
+    else:
+        print("\nНачинаем процесс генерации kaspi.xml...")
+        async with kaspi_xml_sync.ms_client:
+            status = await kaspi_xml_sync.update_xml()
+    write_github_output(status)
+    write_run_report(status)
+    print(f"Процесс генерации kaspi.xml завершен: {status}.")
+    return status
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    status = asyncio.run(main(sys.argv[1:]))
+    sys.exit(1 if status == kaspi_xml_sync.RUN_FAILED else 0)
\ No newline at end of file
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Конфигурация фидов Kaspi (FEEDS_CONFIG): какие XML строить из одного загруженного каталога.
+
+Без файла строится один фид из переменных окружения (COMPANY, MERCHANT_ID, XML_FILE,
+склад STOCK_ID как точка PP1) — как раньше. Файл позволяет описать несколько складов
+(несколько <availability> в оффере) и несколько фидов (другой магазин или тип цены):
+
+    {
+      "feeds": [
+        {
+          "name": "main",
+          "file": "kaspi.xml",
+          "company": "ИП ВОЗРОЖДЕНИЕ",
+          "merchant_id": "30286450",
+          "stores": [
+            {"external_code": "V2M50lgsggOhAsUxFXeMK3", "store_id": "PP1"},
+            {"external_code": "<externalCode второго склада>", "store_id": "PP2"}
+          ]
+        },
+        {
+          "name": "wholesale",
+          "file": "kaspi_wholesale.xml",
+          "merchant_id": "30286451",
+          "price_type_id": "<id типа цены>",
+          "stores": [{"external_code": "V2M50lgsggOhAsUxFXeMK3", "store_id": "PP1"}]
+        }
+      ]
+    }
+
+Необязательные поля (company, merchant_id, stores) берутся из окружения; price_type_id
+по умолчанию — тип цены Каспи (KASPI_PRICE_TYPE_ID).
+"""
+import json
+import os
+
+
+class FeedConfigError(ValueError):
+    """Ошибка в конфигурации фидов."""
+
+
+class FeedStore:
+    """Склад МойСклад (externalCode) и точка продаж Kaspi (storeId), куда идет его остаток."""
+    __slots__ = ("external_code", "store_id")
+
+    def __init__(self, external_code, store_id):
+        self.external_code = external_code
+        self.store_id = store_id
+
+
+class FeedConfig:
+    """Один выходной XML: магазин, тип цены, склады и файл манифеста офферов."""
+    __slots__ = ("name", "file", "company", "merchant_id", "price_type_id", "stores", "manifest_file")
+
+    def __init__(self, name, file, company, merchant_id, price_type_id, stores, manifest_file):
+        self.name = name
+        self.file = file
+        self.company = company
+        self.merchant_id = merchant_id
+        self.price_type_id = price_type_id
+        self.stores = stores
+        self.manifest_file = manifest_file
+
+
+def _parse_stores(value, where):
+    if not isinstance(value, list) or not value:
+        raise FeedConfigError(f"{where}: stores должен быть непустым списком")
+    stores = []
+    for index, item in enumerate(value):
+        if not isinstance(item, dict) or not item.get("external_code") or not item.get("store_id"):
+            raise FeedConfigError(f"{where}.stores[{index}]: нужны external_code и store_id")
+        stores.append(FeedStore(str(item["external_code"]), str(item["store_id"])))
+    store_ids = [store.store_id for store in stores]
+    if len(set(store_ids)) != len(store_ids):
+        raise FeedConfigError(f"{where}: storeId повторяется")
+    return stores
+
+
+def _manifest_file(manifest_file, name, single):
+    """Манифест единственного фида — FEED_MANIFEST_FILE, у нескольких — с именем фида в названии."""
+    if single:
+        return manifest_file
+    root, ext = os.path.splitext(manifest_file)
+    return f"{root}.{name}{ext}"
+
+
+def parse_feed_configs(data, defaults):
+    """
+    Проверяет JSON конфигурации и возвращает список FeedConfig.
+    defaults — словарь company, merchant_id, file, stores [(externalCode, storeId)], manifest_file.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("feeds"), list) or not data["feeds"]:
+        raise FeedConfigError("Ожидается объект с непустым списком feeds")
+
+    single = len(data["feeds"]) == 1
+    feeds = []
+    for index, item in enumerate(data["feeds"]):
+        where = f"feeds[{index}]"
+        if not isinstance(item, dict):
+            raise FeedConfigError(f"{where}: фид должен быть объектом")
+        name = str(item.get("name") or f"feed{index + 1}")
+        file = item.get("file") or (defaults["file"] if single else f"kaspi_{name}.xml")
+        if os.path.basename(file) != file:
+            raise FeedConfigError(f"{where}: file должен быть именем файла в docs/, без каталогов")
+        if "stores" in item:
+            stores = _parse_stores(item["stores"], where)
+        else:
+            stores = [FeedStore(code, store_id) for code, store_id in defaults["stores"]]
+        feeds.append(FeedConfig(
+            name, file,
+            str(item.get("company") or defaults["company"]),
+            str(item.get("merchant_id") or defaults["merchant_id"]),
+            item.get("price_type_id") or None,
+            stores,
+            _manifest_file(defaults["manifest_file"], name, single),
+        ))
+
+    for field in ("name", "file"):
+        values = [getattr(feed, field) for feed in feeds]
+        if len(set(values)) != len(values):
+            raise FeedConfigError(f"Поле {field} фидов должно быть уникальным")
+    return feeds
+
+
+def default_feed_configs(defaults):
+    """Один фид из переменных окружения — поведение без FEEDS_CONFIG."""
+    stores = [FeedStore(code, store_id) for code, store_id in defaults["stores"]]
+    return [FeedConfig("kaspi", defaults["file"], defaults["company"], defaults["merchant_id"], None, stores,
+                       defaults["manifest_file"])]
+
+
+def load_feed_configs(path, defaults):
+    """Фиды из файла path; без path — фид по умолчанию. Ошибка в файле — FeedConfigError."""
+    if not path:
+        return default_feed_configs(defaults)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        raise FeedConfigError(f"Не удалось прочитать {path}: {e}")
+    return parse_feed_configs(data, defaults)
+
+
+def store_codes(feeds):
+    """externalCode всех складов фидов без повторов; первый — основной склад."""
+    codes = []
+    for feed in feeds:
+        for store in feed.stores:
+            if store.external_code not in codes:
+                codes.append(store.external_code)
+    return codes
@@ -3,26 +3,59 @@ import os
 import logging
 import aiohttp
 import asyncio
-from flask import Flask, send_file
-import schedule
-import queue
-import threading
+from flask import Flask, Response
 from flask import jsonify, request
 import time
+import random
 import datetime
 import base64
+import hashlib
 import json
-import xml.etree.ElementTree as ET
-from functools import wraps
-
-# Настройка логирования
-logging.basicConfig(filename='kaspi_xml_sync.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', encoding='utf-8')
+import shutil
+import gzip
+import threading
+import sqlite3
+import multiprocessing
+import concurrent.futures
+from xml.sax.saxutils import escape
+from catalog_snapshot import SnapshotError, read_snapshot, write_snapshot
+from catalog_store import CatalogStore
+from page_checkpoint import PageCheckpoint, stream_key
+from price_rules import PriceRulesLoader
+from feed_config import load_feed_configs, store_codes
+from offer_render import offer_xml, render_offers, split_shards, xml_attr
+from pipeline import Pipeline
+from metrics import registry as metrics_registry
+from logging_setup import CONSOLE, LogSampler, setup_logging
+
+# Brotli-вариант фида отдается, только если установлен пакет brotli
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Быстрый JSON-декодер, если установлен orjson; иначе стандартный json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
 
 from dotenv import load_dotenv
 
 # Конфигурация через переменные окружения (поддерживается .env)
 load_dotenv()
 
+# Настройка логирования: запись в фоновом потоке, файл с ротацией, итоговые сообщения дублируются в консоль
+setup_logging(
+    os.getenv('LOG_FILE', 'kaspi_xml_sync.log'),
+    level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO),
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    console=os.getenv('LOG_CONSOLE', '1').lower() not in ('0', 'false', 'no'),
+)
+
 # LOGIN и PASSWORD должны храниться в окружении (не в коде)
 LOGIN = os.getenv('MS_LOGIN') or os.getenv('LOGIN')
 PASSWORD = os.getenv('MS_PASSWORD') or os.getenv('PASSWORD')
@@ -35,19 +68,186 @@ STOCK_EXTERNAL_CODE = os.getenv('STOCK_ID', 'V2M50lgsggOhAsUxFXeMK3')
 KASPI_PRICE_TYPE_ID = os.getenv('KASPI_PRICE_TYPE_ID', '9fd68e0e-ca75-11ef-0a80-0c7900359c7d')
 PRICE_RULES_FILE = os.getenv('PRICE_RULES_FILE', 'price_adjustments.json')
 
+MS_API_BASE = "https://api.moysklad.ru/api/remap/1.2"
+# Параметры пула соединений к МойСклад (МойСклад допускает до 5 параллельных запросов от пользователя)
+MS_CONNECTIONS_PER_HOST = int(os.getenv('MS_CONNECTIONS_PER_HOST', '5'))
+MS_KEEPALIVE_TIMEOUT = float(os.getenv('MS_KEEPALIVE_TIMEOUT', '60'))
+MS_DNS_CACHE_TTL = int(os.getenv('MS_DNS_CACHE_TTL', '600'))
+# Лимиты API МойСклад: не более 45 запросов за 3 секунды и 5 параллельных запросов от пользователя
+MS_RATE_LIMIT = int(os.getenv('MS_RATE_LIMIT', '45'))
+MS_RATE_PERIOD = float(os.getenv('MS_RATE_PERIOD', '3'))
+MS_MAX_PARALLEL = int(os.getenv('MS_MAX_PARALLEL', '5'))
+MS_MAX_RETRIES = int(os.getenv('MS_MAX_RETRIES', '5'))
+MS_BACKOFF_BASE = float(os.getenv('MS_BACKOFF_BASE', '1'))
+MS_BACKOFF_MAX = float(os.getenv('MS_BACKOFF_MAX', '30'))
+# Размер страницы сущностей (МойСклад разрешает expand только при limit <= 100) и число параллельно загружаемых страниц
+ENTITY_PAGE_SIZE = 100
+MS_PAGE_MAX_SIZE = 1000
+MS_PAGE_CONCURRENCY = int(os.getenv('MS_PAGE_CONCURRENCY', '4'))
+# Профили загрузки по типам сущностей: что разворачивать и размер страницы. Атрибуты, цены (с id типа цены)
+# и группа товара приходят и без expand, поэтому товары и модификации грузятся страницами по 1000 строк;
+# состав с ценами компонентов нужен только комплектам
+FETCH_PROFILES = {
+    "product": {"expand": None, "limit": MS_PAGE_MAX_SIZE},
+    "variant": {"expand": None, "limit": MS_PAGE_MAX_SIZE},
+    "assortment": {"expand": None, "limit": MS_PAGE_MAX_SIZE},
+    "bundle": {"expand": "components,components.assortment", "limit": ENTITY_PAGE_SIZE},
+    # Комплекты в режимах ассортимента и остатков: компоненты загружаются отдельно, цены в составе не нужны
+    "bundle_components": {"expand": "components", "limit": ENTITY_PAGE_SIZE},
+}
+# Товары, модификации и остатки одним потоком /entity/assortment вместо /entity/product и отчета по остаткам
+MS_ASSORTMENT_MODE = os.getenv('MS_ASSORTMENT_MODE', '').lower() in ('1', 'true', 'yes')
+# Сначала остатки, затем по id только товары с остатком и компоненты комплектов, которые можно собрать
+MS_STOCK_FIRST = os.getenv('MS_STOCK_FIRST', '').lower() in ('1', 'true', 'yes')
+# Источник остатков: report — постраничный /report/stock/all (bystore), current — краткий отчет текущих остатков
+MS_STOCK_SOURCE = os.getenv('MS_STOCK_SOURCE', 'report').strip().lower()
+# Повторы страницы целиком после исчерпания повторов запроса (например, оборванный ответ)
+MS_PAGE_RETRIES = int(os.getenv('MS_PAGE_RETRIES', '2'))
+# Контрольные точки постраничной загрузки: прерванный прогон продолжает с сохраненных страниц; пусто — выключено
+FETCH_CHECKPOINT_DB = os.getenv('FETCH_CHECKPOINT_DB', os.path.join('.cache', 'fetch_checkpoints.sqlite3'))
+FETCH_CHECKPOINT_MAX_AGE_MINUTES = float(os.getenv('FETCH_CHECKPOINT_MAX_AGE_MINUTES', '30'))
+# Сколько id передавать в одном фильтре id=...;id=... (ограничено длиной URL)
+ENTITY_ID_BATCH = 80
+# Локальное хранилище каталога (SQLite) для инкрементальной синхронизации; пусто — выключено
+CATALOG_DB = os.getenv('CATALOG_DB', '')
+CATALOG_FULL_SYNC_HOURS = float(os.getenv('CATALOG_FULL_SYNC_HOURS', '24'))
+# Кэш токена и метаданных (href склада, id типа цены и атрибута) между запусками
+METADATA_CACHE_FILE = os.getenv('METADATA_CACHE_FILE', os.path.join('.cache', 'metadata.json'))
+MS_TOKEN_CACHE_HOURS = float(os.getenv('MS_TOKEN_CACHE_HOURS', '12'))
+METADATA_CACHE_HOURS = float(os.getenv('METADATA_CACHE_HOURS', '24'))
+# Манифест опубликованного фида (хэши офферов) для пропуска публикации без изменений
+FEED_MANIFEST_FILE = os.getenv('FEED_MANIFEST_FILE', os.path.join('.cache', 'kaspi_manifest.json'))
+FORCE_PUBLISH = os.getenv('FORCE_PUBLISH', '').lower() in ('1', 'true', 'yes')
+
+# Рендеринг офферов в пуле процессов для больших каталогов (offer_render.py)
+RENDER_PROCESSES = int(os.getenv('RENDER_PROCESSES', str(os.cpu_count() or 1)))
+RENDER_POOL_THRESHOLD = int(os.getenv('RENDER_POOL_THRESHOLD', '50000'))
+RENDER_SHARDS_PER_PROCESS = int(os.getenv('RENDER_SHARDS_PER_PROCESS', '2'))
+# Конвейер: офферы первых страниц товаров рендерятся, пока загружаются следующие
+STREAM_PIPELINE = os.getenv('STREAM_PIPELINE', '').lower() in ('1', 'true', 'yes')
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+
+# Фиды, которые строятся из одного каталога (feed_config.py); без FEEDS_CONFIG — один фид из окружения
+FEEDS_CONFIG = os.getenv('FEEDS_CONFIG', '')
+FEEDS = load_feed_configs(FEEDS_CONFIG, {
+    "company": os.getenv('COMPANY', 'ИП ВОЗРОЖДЕНИЕ'),
+    "merchant_id": os.getenv('MERCHANT_ID', '30286450'),
+    "file": os.getenv('XML_FILE', 'kaspi.xml'),
+    "stores": [(STOCK_EXTERNAL_CODE, "PP1")],
+    "manifest_file": FEED_MANIFEST_FILE,
+})
+# Склады всех фидов (первый — основной) и типы цен помимо Каспи, которые нужно сохранять в OfferRecord
+STORE_CODES = store_codes(FEEDS)
+EXTRA_PRICE_TYPE_IDS = frozenset(feed.price_type_id for feed in FEEDS
+                                 if feed.price_type_id and feed.price_type_id != KASPI_PRICE_TYPE_ID)
+# HTTP-сервер /xml: потоки и лимит соединений waitress, max-age для кэширующих клиентов
+HTTP_THREADS = int(os.getenv('HTTP_THREADS', '16'))
+HTTP_CONNECTION_LIMIT = int(os.getenv('HTTP_CONNECTION_LIMIT', '500'))
+FEED_MAX_AGE = int(os.getenv('FEED_MAX_AGE', '60'))
+# Вебхуки МойСклад: общий секрет в параметре ?secret=, пауза тишины перед пересборкой и предельная задержка
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv('WEBHOOK_DEBOUNCE_SECONDS', '3'))
+WEBHOOK_MAX_DELAY_SECONDS = float(os.getenv('WEBHOOK_MAX_DELAY_SECONDS', '15'))
+# Если заданы имена, id типа цены и атрибута определяются через API по имени (и кэшируются)
+KASPI_PRICE_TYPE_NAME = os.getenv('KASPI_PRICE_TYPE_NAME', '')
+ATTRIBUTE_NAME = os.getenv('ATTRIBUTE_NAME', '')
+
 # Логируем используемый ID цены Каспи для диагностики
-logging.info(f"Используется ID цены Каспи: {KASPI_PRICE_TYPE_ID}")
-print(f"[{datetime.datetime.now().isoformat()}] Используется ID цены Каспи: {KASPI_PRICE_TYPE_ID}")
+logging.info("Используется ID цены Каспи: %s", KASPI_PRICE_TYPE_ID, extra=CONSOLE)
 
 app = Flask(__name__)
 
-# Control queue for commands from external GUI (thread-safe)
-control_queue = queue.Queue()
+# Метрики запросов к МойСклад и прогонов (/metrics и JSON-отчет cloud_run)
+MS_REQUEST_SECONDS = metrics_registry.histogram(
+    "moysklad_request_seconds", "Длительность запросов к МойСклад", ("endpoint", "status"))
+MS_RESPONSE_BYTES = metrics_registry.counter(
+    "moysklad_response_bytes_total", "Получено байт от МойСклад", ("endpoint",))
+MS_PAGES = metrics_registry.counter(
+    "moysklad_pages_total", "Загружено страниц ответов МойСклад", ("source",))
+MS_RETRIES = metrics_registry.counter(
+    "moysklad_retries_total", "Повторы запросов к МойСклад", ("reason",))
+MS_CHECKPOINT_PAGES = metrics_registry.counter(
+    "moysklad_checkpoint_pages_total", "Страниц взято из контрольной точки вместо запроса", ("source",))
+MS_TOKEN_REFRESHES = metrics_registry.counter(
+    "moysklad_token_refreshes_total", "Обновления токена после ответа 401")
+PHASE_SECONDS = metrics_registry.histogram(
+    "kaspi_phase_seconds", "Длительность фаз прогона", ("phase",))
+LAST_PHASE_SECONDS = metrics_registry.gauge(
+    "kaspi_last_phase_seconds", "Длительность фаз последнего прогона", ("phase",))
+RUNS = metrics_registry.counter("kaspi_runs_total", "Прогоны генерации фида", ("status",))
+LAST_RUN_SECONDS = metrics_registry.gauge("kaspi_last_run_seconds", "Длительность последнего прогона")
+LAST_RUN_TIMESTAMP = metrics_registry.gauge(
+    "kaspi_last_run_timestamp_seconds", "Время завершения последнего прогона (unix)")
+OFFERS = metrics_registry.gauge(
+    "kaspi_offers", "Офферы последней генерации: emitted, skipped_zero_stock, price_adjusted, without_price", ("state",))
+PIPELINE_ITEMS_PER_SECOND = metrics_registry.gauge(
+    "kaspi_pipeline_items_per_second", "Страниц в секунду по стадиям конвейера последнего прогона", ("stage",))
+PIPELINE_MAX_QUEUE_DEPTH = metrics_registry.gauge(
+    "kaspi_pipeline_max_queue_depth", "Максимальная глубина входной очереди стадий конвейера", ("stage",))
+
+# Выборочные сообщения в циклах по позициям: первые LOG_SAMPLE_FIRST по каждому виду, затем каждое LOG_SAMPLE_EVERY-е
+log_sampler = LogSampler(first=int(os.getenv('LOG_SAMPLE_FIRST', '20')), every=int(os.getenv('LOG_SAMPLE_EVERY', '1000')))
+
+# Фазы текущего прогона (fetch, stock, bundles, xml_write, publish), сбрасываются в метрики в конце прогона
+run_phases = {}
+# Счетчики стадий конвейера STREAM_PIPELINE текущего прогона
+run_pipeline_stats = {}
+last_run_report = None
+
+def record_phase(phase, seconds):
+    run_phases[phase] = run_phases.get(phase, 0.0) + seconds
+
+def finish_run_metrics(status, seconds, trigger="schedule"):
+    """Переносит фазы прогона в метрики и собирает отчет о прогоне (last_run_report)."""
+    global last_run_report
+    phases = {phase: round(value, 3) for phase, value in run_phases.items()}
+    run_phases.clear()
+    pipeline_stats = dict(run_pipeline_stats) or None
+    run_pipeline_stats.clear()
+    for phase, value in phases.items():
+        PHASE_SECONDS.observe(value, phase=phase)
+        LAST_PHASE_SECONDS.set(value, phase=phase)
+    RUNS.inc(status=status)
+    LAST_RUN_SECONDS.set(round(seconds, 3))
+    LAST_RUN_TIMESTAMP.set(round(time.time(), 3))
+    last_run_report = {
+        "status": status,
+        "trigger": trigger,
+        "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+        "duration_seconds": round(seconds, 3),
+        "phases": phases,
+        "pipeline": pipeline_stats,
+        "offers": OFFERS.snapshot(),
+        "feed_diff": last_feed_diff,
+        "moysklad": ms_client.connection_stats(),
+        "metrics": metrics_registry.snapshot(),
+    }
+    return last_run_report
+
+def metrics_endpoint(url):
+    """Путь запроса без базового адреса, параметров и id: /entity/product, /entity/store/{id}."""
+    path = url.split("?")[0]
+    if path.startswith(MS_API_BASE):
+        path = path[len(MS_API_BASE):]
+    return "/".join("{id}" if len(part) >= 32 and "-" in part else part for part in path.split("/"))
+
+# Итог прогона update_xml
+RUN_UPDATED = "updated"
+RUN_UNCHANGED = "unchanged"
+RUN_FAILED = "failed"
 
 # runtime status
 last_generated_time = None
+last_run_status = None
+last_feed_diff = None
 event_loop = None
+generation_scheduler = None
+webhook_processor = None
+live_catalog = None
 current_token = None
+catalog_store = None
+page_checkpoint = None
+render_pool = None
 
 DEFAULT_PRICE_RULES = {
     "exact_price_adjustments": {
@@ -58,100 +258,340 @@ DEFAULT_PRICE_RULES = {
     }
 }
 
+price_rules_loader = PriceRulesLoader(PRICE_RULES_FILE, DEFAULT_PRICE_RULES)
+
 def load_price_rules():
-    """Загружает правила корректировки цен из JSON-файла."""
-    try:
-        with open(PRICE_RULES_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if not isinstance(data, dict):
-                raise ValueError("Корень JSON должен быть объектом")
-            return data
-    except FileNotFoundError:
-        logging.warning(f"Файл правил цен не найден: {PRICE_RULES_FILE}. Используются значения по умолчанию.")
-    except Exception as e:
-        logging.error(f"Ошибка загрузки правил цен из {PRICE_RULES_FILE}: {e}. Используются значения по умолчанию.")
-    return DEFAULT_PRICE_RULES
+    """Скомпилированные правила корректировки цен; файл перечитывается только после изменения."""
+    return price_rules_loader.get()
+
+class MsResponse:
+    """Ответ МойСклад, уже прочитанный целиком (соединение возвращено в пул)."""
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json_loads(self.body)
+
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+class MsApiError(RuntimeError):
+    """Ответ МойСклад с ошибкой после всех повторов запроса; status — HTTP-код."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+class RequestScheduler:
+    """
+    Планировщик запросов к МойСклад.
+    Token bucket ограничивает частоту (MS_RATE_LIMIT запросов за MS_RATE_PERIOD секунд),
+    семафор — число параллельных запросов. Ответ 429 приостанавливает все запросы
+    на время из X-Lognex-Retry-After (мс) или Retry-After (с); ответы 5xx и сетевые
+    ошибки повторяются с экспоненциальной задержкой и случайным разбросом.
+    """
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, rate_limit=MS_RATE_LIMIT, rate_period=MS_RATE_PERIOD, max_parallel=MS_MAX_PARALLEL,
+                 max_retries=MS_MAX_RETRIES, backoff_base=MS_BACKOFF_BASE, backoff_max=MS_BACKOFF_MAX):
+        self.capacity = max(1, rate_limit)
+        self.refill_rate = self.capacity / rate_period
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._semaphore = asyncio.Semaphore(max(1, max_parallel))
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "retried": 0,
+            "failed": 0,
+            "rate_limit_waits": 0,
+        }
 
-def apply_price_adjustment(price, price_rules):
+    async def _acquire_slot(self):
+        """Ждет окончания паузы после 429 и свободного токена в bucket."""
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            self.stats["rate_limit_waits"] += 1
+            await asyncio.sleep((1 - self._tokens) / self.refill_rate)
+
+    def _backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _retry_after(headers):
+        lognex = headers.get("X-Lognex-Retry-After")
+        if lognex:
+            try:
+                return int(lognex) / 1000
+            except ValueError:
+                pass
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return None
+
+    async def request(self, session, method, url, **kwargs):
+        """Выполняет запрос с учетом лимитов и повторов, возвращает MsResponse."""
+        attempt = 0
+        while True:
+            await self._acquire_slot()
+            endpoint = metrics_endpoint(url)
+            started = time.monotonic()
+            try:
+                async with self._semaphore:
+                    self.stats["requests"] += 1
+                    async with session.request(method, url, **kwargs) as response:
+                        result = MsResponse(response.status, response.headers, await response.read())
+                MS_REQUEST_SECONDS.observe(time.monotonic() - started, endpoint=endpoint, status=result.status)
+                MS_RESPONSE_BYTES.inc(len(result.body), endpoint=endpoint)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                MS_REQUEST_SECONDS.observe(time.monotonic() - started, endpoint=endpoint, status="error")
+                retry_reason = "network"
+                if attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                delay = self._backoff(attempt)
+                logging.warning(f"RequestScheduler: {method} {url} ошибка {e!r}, повтор через {delay:.1f} с")
+            else:
+                retry_reason = str(result.status)
+                if result.status == 429:
+                    self.stats["throttled"] += 1
+                    delay = self._retry_after(result.headers)
+                    if delay is None:
+                        delay = self._backoff(attempt)
+                    # Пауза общая: остальные запросы тоже не должны упираться в лимит
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                elif result.status in self.RETRY_STATUSES:
+                    delay = self._backoff(attempt)
+                else:
+                    return result
+                if attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    return result
+                logging.warning(f"RequestScheduler: {method} {url} ответ {result.status}, повтор через {delay:.1f} с")
+            attempt += 1
+            self.stats["retried"] += 1
+            MS_RETRIES.inc(reason=retry_reason)
+            await asyncio.sleep(delay)
+
+class MoySkladClient:
     """
-    Применяет правило к итоговой цене.
-    Используется после окончательного расчета цены товара или комплекта.
+    Долгоживущий клиент МойСклад: одна aiohttp-сессия на весь процесс.
+    Пул соединений настроен на keep-alive, лимит соединений на хост и DNS-кэш,
+    все запросы идут с gzip. Ведет статистику переиспользования соединений.
     """
-    if price <= 0:
-        return price
 
-    exact_rules = price_rules.get("exact_price_adjustments", {})
-    rule = exact_rules.get(str(price))
-    if not isinstance(rule, dict):
-        return price
+    def __init__(self, limit_per_host=MS_CONNECTIONS_PER_HOST, keepalive_timeout=MS_KEEPALIVE_TIMEOUT, dns_cache_ttl=MS_DNS_CACHE_TTL):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.scheduler = RequestScheduler()
+        self._session = None
+        self.stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "dns_cache_hits": 0,
+            "dns_cache_misses": 0,
+        }
 
-    operation = rule.get("operation")
-    value = rule.get("value", 0)
+    def _trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.stats["requests"] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self.stats["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.stats["connections_reused"] += 1
+
+        async def on_dns_cache_hit(session, ctx, params):
+            self.stats["dns_cache_hits"] += 1
+
+        async def on_dns_cache_miss(session, ctx, params):
+            self.stats["dns_cache_misses"] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    async def get_session(self):
+        """Возвращает общую сессию, создавая ее при первом обращении."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Accept-Encoding": "gzip"},
+                timeout=aiohttp.ClientTimeout(total=60),
+                trace_configs=[self._trace_config()],
+            )
+            logging.info(f"MoySkladClient: создан пул соединений (limit_per_host={self.limit_per_host}, keepalive={self.keepalive_timeout}s)")
+        return self._session
+
+    async def request(self, method, url, **kwargs):
+        """Запрос через планировщик (лимиты, 429, повторы); возвращает MsResponse."""
+        session = await self.get_session()
+        return await self.scheduler.request(session, method, url, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        await self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def connection_stats(self):
+        """Статистика запросов и переиспользования соединений с момента запуска."""
+        stats = dict(self.stats)
+        opened = stats["connections_created"] + stats["connections_reused"]
+        stats["reuse_ratio"] = round(stats["connections_reused"] / opened, 3) if opened else 0.0
+        for key in ("throttled", "retried", "failed", "rate_limit_waits"):
+            stats[key] = self.scheduler.stats[key]
+        return stats
+
+    def log_stats(self):
+        stats = self.connection_stats()
+        logging.info(
+            f"MoySkladClient: запросов {stats['requests']}, новых соединений {stats['connections_created']}, "
+            f"переиспользовано {stats['connections_reused']} (доля {stats['reuse_ratio']}), "
+            f"DNS-кэш попаданий {stats['dns_cache_hits']}/промахов {stats['dns_cache_misses']}, "
+            f"429 {stats['throttled']}, повторов {stats['retried']}, неудачных {stats['failed']}, "
+            f"ожиданий лимита {stats['rate_limit_waits']}",
+            extra=CONSOLE,
+        )
+        return stats
+
+# Общий клиент для всех обращений к МойСклад
+ms_client = MoySkladClient()
+
+class MetadataCache:
+    """
+    Небольшой JSON-кэш на диске со сроком жизни записей.
+    Хранит токен и редко меняющиеся метаданные МойСклад, чтобы при старте
+    не повторять последовательные запросы; записи сбрасываются по TTL или явно (401/404).
+    """
 
-    try:
-        value = int(value)
-    except (TypeError, ValueError):
-        logging.warning(f"Некорректное значение value в правиле для цены {price}: {value}")
-        return price
-
-    adjusted_price = price
-    if operation == "add":
-        adjusted_price = price + value
-    elif operation == "subtract":
-        adjusted_price = price - value
-    elif operation == "set":
-        adjusted_price = value
-    else:
-        logging.warning(f"Неизвестная операция '{operation}' для цены {price}")
-        return price
-
-    if adjusted_price < 0:
-        logging.warning(f"Скорректированная цена стала отрицательной ({adjusted_price}) для исходной цены {price}. Используем 0.")
-        adjusted_price = 0
-
-    return adjusted_price
-
-def retry_async(retries=2, delay=15):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            for i in range(retries + 1):
-                try:
-                    result = await func(*args, **kwargs)
-                    if result is not None:
-                        return result
-                except Exception as e:
-                    logging.warning(f"Попытка {i + 1}/{retries + 1}: Функция {func.__name__} вызвала исключение: {e}")
-                if i < retries:
-                    logging.info(f"Повторная попытка через {delay} секунд...")
-                    await asyncio.sleep(delay)
-            logging.error(f"Функция {func.__name__} не выполнилась после {retries + 1} попыток.")
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+                if not isinstance(self._entries, dict):
+                    raise ValueError("Корень JSON должен быть объектом")
+            except FileNotFoundError:
+                self._entries = {}
+            except Exception as e:
+                logging.warning(f"Не удалось прочитать кэш метаданных {self.path}: {e}. Начинаем с пустого кэша.")
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            # В кэше лежит токен — файл доступен только владельцу
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить кэш метаданных {self.path}: {e}")
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if not entry:
+            return None
+        if entry.get("expires", 0) < time.time():
+            self.invalidate(key)
             return None
-        return wrapper
-    return decorator
+        return entry.get("value")
+
+    def set(self, key, value, ttl_seconds):
+        if ttl_seconds <= 0:
+            return
+        self._load()[key] = {"value": value, "expires": time.time() + ttl_seconds}
+        self._save()
+
+    def invalidate(self, key):
+        if self._load().pop(key, None) is not None:
+            logging.info(f"Кэш метаданных: запись {key} сброшена")
+            self._save()
+
+metadata_cache = MetadataCache(METADATA_CACHE_FILE)
+token_refresh_lock = asyncio.Lock()
 
-@retry_async()
 async def get_access_token():
     if not LOGIN or not PASSWORD:
         logging.error('MS_LOGIN / MS_PASSWORD not set in environment')
         return None
     credentials = f"{LOGIN}:{PASSWORD}"
     encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
-    url = "https://api.moysklad.ru/api/remap/1.2/security/token"
+    url = f"{MS_API_BASE}/security/token"
     headers = {"Authorization": f"Basic {encoded_credentials}"}
     timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, headers=headers) as response:
-            if response.status in [200, 201]:
-                data = await response.json()
-                logging.info("Successfully obtained access token")
-                return data["access_token"]
-            else:
-                logging.error(f"Failed to obtain access token: {response.status} - {await response.text()}")
-                return None
+    try:
+        response = await ms_client.request("POST", url, headers=headers, timeout=timeout)
+    except Exception as e:
+        logging.error(f"Exception while obtaining access token: {e}")
+        return None
+    if response.status in [200, 201]:
+        logging.info("Successfully obtained access token")
+        return response.json()["access_token"]
+    else:
+        logging.error(f"Failed to obtain access token: {response.status} - {response.text()}")
+        return None
 
 async def ensure_token_is_valid(force_refresh=False):
     global current_token
+    if force_refresh or MS_TOKEN_CACHE_HOURS <= 0:
+        # Без кэширования токена удаляем и сохраненный ранее, чтобы он не оставался в файле кэша
+        metadata_cache.invalidate("token")
+    if not force_refresh and not current_token and MS_TOKEN_CACHE_HOURS > 0:
+        current_token = metadata_cache.get("token")
+        if current_token:
+            logging.info("Using cached access token.")
     if force_refresh or not current_token:
         if force_refresh:
             logging.info("Forcing token refresh.")
@@ -161,112 +601,345 @@ async def ensure_token_is_valid(force_refresh=False):
         if not current_token:
             logging.error("Failed to obtain a valid access token.")
             return False
+        metadata_cache.set("token", current_token, MS_TOKEN_CACHE_HOURS * 3600)
     return True
 
-@retry_async()
-async def get_store_href(token):
-    url = f"https://api.moysklad.ru/api/remap/1.2/entity/store?filter=externalCode={STOCK_EXTERNAL_CODE}"
+async def refresh_token_after_401(stale_token):
+    """
+    Обновляет токен после ответа 401. Параллельные запросы с тем же устаревшим
+    токеном обновляют его только один раз.
+    """
+    async with token_refresh_lock:
+        if current_token and current_token != stale_token:
+            return True
+        MS_TOKEN_REFRESHES.inc()
+        return await ensure_token_is_valid(force_refresh=True)
+
+async def get_store_href(token, external_code=None):
+    external_code = external_code or STOCK_EXTERNAL_CODE
+    url = f"{MS_API_BASE}/entity/store?filter=externalCode={external_code}"
     headers = {"Authorization": f"Bearer {token}"}
     timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                rows = data.get("rows", [])
-                if rows:
-                    logging.info(f"Store with externalCode {STOCK_EXTERNAL_CODE} found: {rows[0]['meta']['href']}")
-                    return rows[0]["meta"]["href"]
-                else:
-                    logging.error(f"Store with externalCode {STOCK_EXTERNAL_CODE} not found")
-                    return None
-            else:
-                logging.error(f"Failed to fetch store: {response.status} - {await response.text()}")
-                return None
+    try:
+        response = await ms_client.request("GET", url, headers=headers, timeout=timeout)
+    except Exception as e:
+        logging.error(f"Exception while fetching store: {e}")
+        return None
+    if response.status == 200:
+        rows = response.json().get("rows", [])
+        if rows:
+            logging.info(f"Store with externalCode {external_code} found: {rows[0]['meta']['href']}")
+            return rows[0]["meta"]["href"]
+        else:
+            logging.error(f"Store with externalCode {external_code} not found")
+            return None
+    else:
+        logging.error(f"Failed to fetch store: {response.status} - {response.text()}")
+        return None
+
+async def resolve_store_href(token, external_code=None):
+    """href склада по externalCode, по умолчанию STOCK_EXTERNAL_CODE (из кэша метаданных или через API)."""
+    external_code = external_code or STOCK_EXTERNAL_CODE
+    cache_key = f"store_href:{external_code}"
+    store_href = metadata_cache.get(cache_key)
+    if store_href:
+        return store_href
+    store_href = await get_store_href(token, external_code)
+    if store_href:
+        metadata_cache.set(cache_key, store_href, METADATA_CACHE_HOURS * 3600)
+    return store_href
+
+async def get_store_stock(token, external_code):
+    """Остатки по складу external_code; при 404 сбрасывает закэшированный href склада и повторяет с новым."""
+    for attempt in range(2):
+        store_href = await resolve_store_href(token, external_code)
+        if not store_href:
+            logging.error(f"get_store_stock: склад {external_code} не найден.")
+            return {}
+        if MS_STOCK_SOURCE == "current":
+            stock = await fetch_current_stock({external_code: store_href})
+            stock = None if stock is None else stock.get(external_code, {})
+        else:
+            stock = await fetch_stock_report(store_href)
+        if stock is not None:
+            return stock
+        metadata_cache.invalidate(f"store_href:{external_code}")
+    return {}
+
+async def get_stock_by_store(token):
+    """
+    Остатки для всех складов фидов: {externalCode: {id: остаток}}.
+    Один склад — отчет /report/stock/all, как раньше; несколько — один отчет /report/stock/bystore
+    по всем складам сразу вместо отдельного отчета на каждый склад.
+    """
+    if len(STORE_CODES) == 1:
+        return {STORE_CODES[0]: await get_store_stock(token, STORE_CODES[0])}
+    for attempt in range(2):
+        hrefs = {}
+        for code in STORE_CODES:
+            store_href = await resolve_store_href(token, code)
+            if not store_href:
+                logging.error(f"get_stock_by_store: склад {code} не найден, его остатки считаются нулевыми.")
+                continue
+            hrefs[code] = store_href
+        if not hrefs:
+            return {code: {} for code in STORE_CODES}
+        if MS_STOCK_SOURCE == "current":
+            stock = await fetch_current_stock(hrefs)
+        else:
+            stock = await fetch_stock_by_store_report(hrefs)
+        if stock is not None:
+            return {code: stock.get(code, {}) for code in STORE_CODES}
+        for code in STORE_CODES:
+            metadata_cache.invalidate(f"store_href:{code}")
+    return {code: {} for code in STORE_CODES}
+
+async def resolve_catalog_metadata(token):
+    """
+    Определяет по имени id типа цены (KASPI_PRICE_TYPE_NAME) и атрибута (ATTRIBUTE_NAME),
+    если имена заданы. Найденные id кэшируются на диске на METADATA_CACHE_HOURS.
+    """
+    global KASPI_PRICE_TYPE_ID, ATTRIBUTE_ID
+    lookups = []
+    if KASPI_PRICE_TYPE_NAME:
+        lookups.append(("price_type", KASPI_PRICE_TYPE_NAME, f"{MS_API_BASE}/context/companysettings/pricetype"))
+    if ATTRIBUTE_NAME:
+        lookups.append(("attribute", ATTRIBUTE_NAME, f"{MS_API_BASE}/entity/product/metadata/attributes"))
+
+    timeout = aiohttp.ClientTimeout(total=30)
+    for kind, name, url in lookups:
+        cache_key = f"{kind}:{name}"
+        resolved_id = metadata_cache.get(cache_key)
+        if not resolved_id:
+            try:
+                response = await ms_client.request("GET", url, headers={"Authorization": f"Bearer {token}"}, timeout=timeout)
+                if response.status != 200:
+                    logging.error(f"Failed to resolve {kind} '{name}': {response.status} - {response.text()}")
+                    continue
+                data = response.json()
+            except Exception as e:
+                logging.error(f"Exception while resolving {kind} '{name}': {e}")
+                continue
+            rows = data.get("rows", []) if isinstance(data, dict) else data
+            resolved_id = next((row.get("id") for row in rows if row.get("name") == name), None)
+            if not resolved_id:
+                logging.error(f"{kind} '{name}' не найден в МойСклад, используется id из окружения")
+                continue
+            metadata_cache.set(cache_key, resolved_id, METADATA_CACHE_HOURS * 3600)
+        if kind == "price_type":
+            KASPI_PRICE_TYPE_ID = resolved_id
+        else:
+            ATTRIBUTE_ID = resolved_id
+        logging.info(f"{kind} '{name}' -> {resolved_id}")
 
 async def get_stock_for_products(products):
-    """Получаем остатки для списка товаров с учетом резервов"""
+    """Получаем остатки для списка товаров с учетом резервов: {externalCode склада: {id: остаток}}"""
     if not products:
         logging.debug("get_stock_for_products: Product list is empty.")
         return {}
 
     if not await ensure_token_is_valid():
         return {}
+    return await get_stock_by_store(current_token)
 
+async def fetch_stock_pages(url, params, consume):
+    """
+    Постранично загружает отчет об остатках, передавая строки каждой страницы в consume.
+    Возвращает True, None при 404 (склад не найден) и False при прочих ошибках.
+    Неудачная страница повторяется до MS_PAGE_RETRIES раз. Контрольные точки для отчета не используются:
+    сохраненные страницы смешали бы старые остатки со свежими, а от остатка зависит, попадет ли оффер в фид.
+    """
+    timeout = aiohttp.ClientTimeout(total=60)
+    headers = {"Authorization": f"Bearer {current_token}"}
+    params = dict(params, limit=1000, offset=0)
+
+    retries_401 = 0
+    max_retries_401 = 3
+    page_failures = 0
+
+    while True:
+        logging.debug(f"Fetching stock page with offset {params['offset']}")
+        try:
+            response = await ms_client.request("GET", url, headers=headers, params=params, timeout=timeout)
+            if response.status == 401:
+                if retries_401 < max_retries_401:
+                    success = await refresh_token_after_401(headers["Authorization"][len("Bearer "):])
+                    if success:
+                        headers["Authorization"] = f"Bearer {current_token}"
+                        retries_401 += 1
+                        continue
+                    else:
+                        return False
+                else:
+                    return False
+            elif response.status == 404:
+                logging.error(f"Store not found for stock report: {response.text()}")
+                return None
+            elif response.status != 200:
+                logging.error(f"Failed to get stock data: {response.status} - {response.text()}")
+                if response.status < 500 or page_failures >= MS_PAGE_RETRIES:
+                    return False
+                page_failures += 1
+                await asyncio.sleep(MS_BACKOFF_BASE * 2 ** (page_failures - 1))
+                continue
+
+            data = response.json()
+            del response
+        except Exception as e:
+            logging.error(f"Exception getting stock data: {e}")
+            if page_failures >= MS_PAGE_RETRIES:
+                return False
+            page_failures += 1
+            await asyncio.sleep(MS_BACKOFF_BASE * 2 ** (page_failures - 1))
+            continue
+        page_failures = 0
+
+        # Страница сразу сворачивается в остатки, строки отчета не накапливаются
+        MS_PAGES.inc(source="stock")
+        rows = data.get("rows", [])
+        del data
+        logging.debug(f"Stock API returned {len(rows)} records for offset {params['offset']}")
+        consume(rows)
+
+        if len(rows) < params["limit"]:
+            return True
+        params["offset"] += params["limit"]
+
+def stock_row_entity_id(row):
+    """id товара или модификации строки отчета об остатках (None для прочих типов)."""
+    meta = row.get("meta", {})
+    # Модификации тоже учитываются: они бывают компонентами комплектов
+    if meta.get("type") in ("product", "variant"):
+        return meta["href"].split("/")[-1].split("?")[0]
+    return None
+
+async def fetch_stock_report(store_href):
+    """
+    Загружает отчет об остатках по складу: {id товара: остаток за вычетом резерва}.
+    Возвращает None, если склад не найден (404), чтобы вызывающий сбросил кэш href.
+    """
     start_ts = time.time()
-    logging.info("get_stock_for_products: начинаю запрос отчета по складу...")
-
-    store_href = await get_store_href(current_token)
-    if not store_href:
-        logging.error("get_stock_for_products: Store href not found.")
-        return {}
+    logging.info("fetch_stock_report: начинаю запрос отчета по складу...")
     store_id = store_href.split('/')[-1]
-
     stock_data = {}
-    timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        url = "https://api.moysklad.ru/api/remap/1.2/report/stock/all"
-        headers = {"Authorization": f"Bearer {current_token}"}
-        params = {
-            "store.id": store_id,
-            "stockMode": "all",
-            "limit": 1000,
-            "offset": 0
-        }
-
-        all_stock_rows = []
-        retries_401 = 0
-        max_retries_401 = 3
 
-        while True:
-            logging.debug(f"Fetching stock page with offset {params['offset']}")
-            try:
-                async with session.get(url, headers=headers, params=params) as response:
-                    if response.status == 401:
-                        if retries_401 < max_retries_401:
-                            success = await ensure_token_is_valid(force_refresh=True)
-                            if success:
-                                headers["Authorization"] = f"Bearer {current_token}"
-                                retries_401 += 1
-                                continue
-                            else:
-                                return {}
-                        else:
-                            return {}
-                    elif response.status != 200:
-                        logging.error(f"Failed to get stock data: {response.status} - {await response.text()}")
-                        return {}
-                    
-                    data = await response.json()
-                    rows = data.get("rows", [])
-                    all_stock_rows.extend(rows)
-                    logging.debug(f"Stock API returned {len(rows)} records for offset {params['offset']}")
-                    
-                    if len(rows) < params["limit"]:
-                        break
-                    params["offset"] += params["limit"]
-
-            except Exception as e:
-                logging.error(f"Exception getting stock data: {e}")
-                return {}
-
-    # Обработка полученных данных с учетом резервов (только товары product)
-    for row in all_stock_rows:
-        meta = row.get("meta", {})
-        entity_type = meta.get("type")
-        if entity_type == "product":
-            entity_id = meta["href"].split("/")[-1].split("?")[0]
+    def consume(rows):
+        for row in rows:
+            entity_id = stock_row_entity_id(row)
+            if entity_id is None:
+                continue
             stock = row.get("stock", 0)  # Общий остаток
             reserve = row.get("reserve", 0)  # Резерв
             available = max(0, stock - reserve)  # Доступный остаток
             stock_data[entity_id] = available
-            
-            if logging.getLogger().level == logging.DEBUG:
-                logging.debug(f"Product {entity_id} - Stock: {stock}, Reserve: {reserve}, Available: {available}")
+            log_sampler.debug("stock_row", "Product %s - Stock: %s, Reserve: %s, Available: %s",
+                              entity_id, stock, reserve, available)
+
+    result = await fetch_stock_pages(f"{MS_API_BASE}/report/stock/all",
+                                     {"store.id": store_id, "stockMode": "all"}, consume)
+    if result is None:
+        return None
+    if not result:
+        return {}
 
     elapsed = time.time() - start_ts
     logging.info(f"Retrieved stock data for {len(stock_data)} unique products in {elapsed:.1f} seconds")
     return stock_data
 
+async def fetch_stock_by_store_report(store_hrefs):
+    """
+    Отчет об остатках по складам (/report/stock/bystore) для нескольких складов одним проходом:
+    {externalCode: {id товара: остаток за вычетом резерва}}. None, если склад не найден (404).
+    """
+    start_ts = time.time()
+    code_by_href = {href.split("?")[0]: code for code, href in store_hrefs.items()}
+    stock_data = {code: {} for code in store_hrefs}
+
+    def consume(rows):
+        for row in rows:
+            entity_id = stock_row_entity_id(row)
+            if entity_id is None:
+                continue
+            for store_row in row.get("stockByStore") or ():
+                code = code_by_href.get(store_row.get("meta", {}).get("href", "").split("?")[0])
+                if code is None:
+                    continue
+                available = max(0, store_row.get("stock", 0) - store_row.get("reserve", 0))
+                if available:
+                    stock_data[code][entity_id] = available
+
+    params = {"filter": ";".join(f"store={href}" for href in code_by_href)}
+    result = await fetch_stock_pages(f"{MS_API_BASE}/report/stock/bystore", params, consume)
+    if result is None:
+        return None
+    if not result:
+        return {}
+
+    logging.info(f"Retrieved stock by store for {len(stock_data)} stores in {time.time() - start_ts:.1f} seconds: "
+                 + ", ".join(f"{code}: {len(stock)}" for code, stock in stock_data.items()))
+    return stock_data
+
+async def fetch_current_stock(store_hrefs):
+    """
+    Краткий отчет текущих остатков (stockType=freeStock — остаток за вычетом резерва) одним запросом
+    без постраничной загрузки: {externalCode: {id товара или модификации: остаток}}. Строки отчета —
+    только assortmentId и остаток (для нескольких складов еще storeId), нулевые остатки не передаются.
+    Один склад — /report/stock/all/current, несколько — /report/stock/bystore/current.
+    None, если склад не найден (404); {} при прочих ошибках.
+    """
+    start_ts = time.time()
+    code_by_id = {href.split("?")[0].split("/")[-1]: code for code, href in store_hrefs.items()}
+    by_store = len(code_by_id) > 1
+    url = f"{MS_API_BASE}/report/stock/{'bystore' if by_store else 'all'}/current"
+    params = {"stockType": "freeStock", "filter": ";".join(f"storeId={store_id}" for store_id in code_by_id)}
+    timeout = aiohttp.ClientTimeout(total=120)
+    retries_401 = 0
+    failures = 0
+
+    while True:
+        headers = {"Authorization": f"Bearer {current_token}"}
+        try:
+            response = await ms_client.request("GET", url, headers=headers, params=params, timeout=timeout)
+            if response.status == 401:
+                if retries_401 < 3 and await refresh_token_after_401(headers["Authorization"][len("Bearer "):]):
+                    retries_401 += 1
+                    continue
+                return {}
+            if response.status == 404:
+                logging.error(f"Store not found for current stock report: {response.text()}")
+                return None
+            if response.status != 200:
+                logging.error(f"Failed to get current stock: {response.status} - {response.text()}")
+                if response.status < 500 or failures >= MS_PAGE_RETRIES:
+                    return {}
+                failures += 1
+                await asyncio.sleep(MS_BACKOFF_BASE * 2 ** (failures - 1))
+                continue
+            rows = response.json()
+            del response
+            break
+        except Exception as e:
+            logging.error(f"Exception getting current stock: {e}")
+            if failures >= MS_PAGE_RETRIES:
+                return {}
+            failures += 1
+            await asyncio.sleep(MS_BACKOFF_BASE * 2 ** (failures - 1))
+
+    MS_PAGES.inc(source="stock")
+    if by_store:
+        stock_data = {code: {} for code in store_hrefs}
+        for row in rows:
+            stock = stock_data.get(code_by_id.get(row.get("storeId")))
+            if stock is not None and row.get("stock", 0) > 0:
+                stock[row["assortmentId"]] = row["stock"]
+    else:
+        # Свободный остаток бывает отрицательным (резерв больше остатка) — такие позиции не в наличии
+        stock_data = {code: {row["assortmentId"]: row["stock"] for row in rows if row.get("stock", 0) > 0}
+                      for code in store_hrefs}
+    logging.info(f"Retrieved current stock ({len(rows)} rows) in {time.time() - start_ts:.1f} seconds: "
+                 + ", ".join(f"{code}: {len(stock)}" for code, stock in stock_data.items()))
+    return stock_data
+
 def has_kaspi_attribute(product):
     """Проверяет, отмечен ли чекбокс 'Выгружать на Каспи?' у товара"""
     attrs = product.get("attributes") or []
@@ -281,356 +954,1523 @@ def has_kaspi_attribute(product):
                 return val["value"] is True
     return False
 
-async def fetch_entity_items(token, entity_type, use_attribute_filter=True):
-    """Базовый загрузчик сущностей (товары/комплекты) с фильтрацией по атрибуту."""
+def kaspi_price_of(entity):
+    """Цена Каспи сущности в тенге (0, если цены нет)."""
+    for price_info in entity.get("salePrices") or []:
+        if price_info.get("priceType", {}).get("id") == KASPI_PRICE_TYPE_ID:
+            return int(price_info.get("value", 0) / 100)  # Переводим копейки в рубли
+    return 0
+
+def extra_prices_of(entity):
+    """Цены сущности по типам цен фидов помимо Каспи: {id типа: цена}; None, если таких фидов нет."""
+    if not EXTRA_PRICE_TYPE_IDS:
+        return None
+    return {price_info["priceType"]["id"]: int(price_info.get("value", 0) / 100)
+            for price_info in entity.get("salePrices") or []
+            if price_info.get("priceType", {}).get("id") in EXTRA_PRICE_TYPE_IDS}
+
+def record_price(record, price_type_id=None):
+    """Цена позиции по типу цены фида; None или тип цены Каспи — основная цена record.price."""
+    if price_type_id is None or price_type_id == KASPI_PRICE_TYPE_ID:
+        return record.price
+    return (record.prices or {}).get(price_type_id, 0)
+
+class OfferRecord:
+    """
+    Компактная запись сущности МойСклад: только поля, нужные для XML.
+    components — кортеж (id, тип, количество, цена Каспи компонента) для комплектов;
+    цена компонента None, если МойСклад не развернул его assortment.
+    prices — цены по дополнительным типам цен фидов (None, если все фиды используют цену Каспи).
+    """
+    __slots__ = ("id", "entity_type", "code", "name", "brand", "price", "components", "updated", "flagged", "folder",
+                 "prices")
+
+    def __init__(self, id, entity_type, code, name, brand, price, components, updated, flagged, folder=None,
+                 prices=None):
+        self.id = id
+        self.entity_type = entity_type
+        self.code = code
+        self.name = name
+        self.brand = brand
+        self.price = price
+        self.components = components
+        self.updated = updated
+        self.flagged = flagged
+        self.folder = folder
+        self.prices = prices
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.__slots__}
+        data["components"] = [list(comp) for comp in self.components] if self.components is not None else None
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        components = data.get("components")
+        if components is not None:
+            components = tuple(tuple(comp) for comp in components)
+        return cls(
+            data["id"], data["entity_type"], data.get("code"), data.get("name"), data.get("brand"),
+            data.get("price", 0), components, data.get("updated"), data.get("flagged", True), data.get("folder"),
+            data.get("prices"),
+        )
+
+def project_entity_row(row, default_type="product"):
+    """Сворачивает строку ответа API в OfferRecord, отбрасывая остальные поля."""
+    entity_type = row.get("meta", {}).get("type", default_type)
+    brand = row.get("brand")
+    components = None
+    if entity_type == "bundle":
+        components_block = row.get("components") or []
+        if isinstance(components_block, dict):
+            raw_components = components_block.get("rows") or []
+        elif isinstance(components_block, list):
+            raw_components = components_block
+        else:
+            raw_components = []
+        projected = []
+        for comp in raw_components:
+            if not isinstance(comp, dict):
+                continue
+            assortment = comp.get("assortment")
+            if isinstance(assortment, str):
+                assortment = {"meta": {"href": assortment}}
+            assortment = assortment or {}
+            comp_meta = assortment.get("meta", {})
+            comp_id = comp_meta.get("href", "").split("/")[-1].split("?")[0]
+            comp_price = kaspi_price_of(assortment) if "salePrices" in assortment else None
+            projected.append((comp_id, comp_meta.get("type"), comp.get("quantity", 1), comp_price))
+        components = tuple(projected)
+    return OfferRecord(
+        row.get("id"),
+        entity_type,
+        row.get("code"),
+        row.get("name"),
+        brand.get("name") if isinstance(brand, dict) else None,
+        kaspi_price_of(row),
+        components,
+        row.get("updated"),
+        has_kaspi_attribute(row),
+        (row.get("productFolder") or {}).get("meta", {}).get("href", "").split("/")[-1] or None,
+        extra_prices_of(row),
+    )
+
+async def fetch_entity_items(token, entity_type, use_attribute_filter=True, concurrency=None, extra_filter=None,
+                             apply_local_filter=True, row_hook=None, profile=None, page_sink=None, raise_errors=False):
+    """
+    Базовый загрузчик сущностей (товары/комплекты) с фильтрацией по атрибуту.
+    Первая страница дает meta.size, остальные страницы запрашиваются параллельно
+    по offset (не более concurrency одновременно) и склеиваются в исходном порядке.
+    Разворачиваемые поля и размер страницы берутся из FETCH_PROFILES (profile — имя другого профиля).
+    Каждая страница сразу после загрузки сворачивается в OfferRecord, сырые строки не хранятся.
+    extra_filter добавляется к фильтру API; apply_local_filter=False отключает
+    локальную проверку атрибута (нужно инкрементальной синхронизации, чтобы видеть снятые с выгрузки).
+    row_hook вызывается для каждой сырой строки до свертки (например, чтобы забрать остаток).
+    page_sink — корутина (offset, строки): сырые страницы передаются в нее по мере загрузки
+    (конвейер STREAM_PIPELINE), функция возвращает пустой список, а ошибки загрузки пробрасываются.
+    Следующая страница не запрашивается, пока page_sink не принял одну из concurrency загруженных.
+    raise_errors=True пробрасывает ошибки и без page_sink: пустой список тогда означает, что сущностей нет.
+    Неудачная страница повторяется до MS_PAGE_RETRIES раз; загруженные страницы многостраничной
+    выгрузки сохраняются в контрольную точку (FETCH_CHECKPOINT_DB), и после сбоя следующий прогон
+    запрашивает только недостающие.
+    """
     if not token:
         logging.error(f"No token, cannot fetch {entity_type}")
+        if raise_errors:
+            raise RuntimeError(f"no token for {entity_type}")
         return []
 
-    base_url = f"https://api.moysklad.ru/api/remap/1.2/entity/{entity_type}"
+    if concurrency is None:
+        concurrency = MS_PAGE_CONCURRENCY
+    concurrency = max(1, concurrency)
+
+    profile = FETCH_PROFILES.get(profile or entity_type, FETCH_PROFILES["bundle"])
+    page_size = profile["limit"]
+    base_url = f"{MS_API_BASE}/entity/{entity_type}"
     headers = {"Authorization": f"Bearer {token}"}
-    params = {
-        "limit": 100,
-        "expand": "attributes,salePrices,components,components.assortment"
-    }
+    params = {"limit": page_size}
+    if profile["expand"]:
+        params["expand"] = profile["expand"]
 
+    filters = []
     filter_active = False
     if use_attribute_filter and ATTRIBUTE_ID:
-        params["filter"] = f"{base_url}/metadata/attributes/{ATTRIBUTE_ID}=true"
+        filters.append(f"{base_url}/metadata/attributes/{ATTRIBUTE_ID}=true")
         filter_active = True
         logging.info(f"[{entity_type}] Using API filter for attribute: {ATTRIBUTE_ID}")
+    if extra_filter:
+        filters.append(extra_filter)
+    if filters:
+        params["filter"] = ";".join(filters)
 
-    items = []
     timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        current_url = base_url
-        current_params = params
-        while current_url:
-            logging.info(f"[{entity_type}] Fetching page: {current_url}")
+    semaphore = asyncio.Semaphore(concurrency)
+    # С page_sink слот занят, пока стадия не примет страницу: при отставании конвейера загрузка ждет,
+    # и сырых страниц в памяти не больше concurrency плюс размер входной очереди
+    sink_slots = asyncio.Semaphore(concurrency)
+    # Страницы с row_hook и page_sink нужны сырыми, их контрольная точка не сохраняет
+    checkpoint = get_page_checkpoint() if row_hook is None and page_sink is None else None
+    stream = None
+    saved_offsets = set()
+
+    async def fetch_page_once(offset):
+        page_params = dict(params, offset=offset)
+        async with semaphore:
+            for attempt in range(2):
+                logging.info(f"[{entity_type}] Fetching page: offset={offset}")
+                response = await ms_client.request("GET", base_url, headers=headers, params=page_params, timeout=timeout)
+                if response.status == 401 and attempt == 0:
+                    if not await refresh_token_after_401(headers["Authorization"][len("Bearer "):]):
+                        raise MsApiError("API error: 401 and token refresh failed", 401)
+                    headers["Authorization"] = f"Bearer {current_token}"
+                    continue
+                if response.status == 404 and filter_active and ATTRIBUTE_NAME:
+                    # Закэшированный id атрибута мог устареть
+                    metadata_cache.invalidate(f"attribute:{ATTRIBUTE_NAME}")
+                if response.status != 200:
+                    raise MsApiError(f"API error: {response.status} - {response.text()}", response.status)
+                break
+            data = response.json()
+            del response
+            MS_PAGES.inc(source=entity_type)
+            return data.get("meta", {}), data.get("rows", [])
+
+    async def fetch_page(offset):
+        if page_sink is not None:
+            async with sink_slots:
+                meta, rows = await fetch_page_rows(offset)
+                await page_sink(offset, rows)
+            return meta, []
+        if offset in saved_offsets:
+            stored = checkpoint.load(stream, offset)
+            if stored is not None:
+                MS_CHECKPOINT_PAGES.inc(source=entity_type)
+                return {"offset": offset}, [OfferRecord.from_dict(item) for item in stored]
+        meta, rows = await fetch_page_rows(offset)
+        if row_hook is not None:
+            for row in rows:
+                row_hook(row)
+        records = [project_entity_row(row, entity_type) for row in rows]
+        if stream is not None:
+            checkpoint.save(stream, offset, [record.to_dict() for record in records])
+        return meta, records
+
+    async def fetch_page_rows(offset):
+        """Сырые строки страницы; неудачная страница повторяется до MS_PAGE_RETRIES раз."""
+        for page_attempt in range(MS_PAGE_RETRIES + 1):
             try:
-                async with session.get(current_url, headers=headers, params=current_params) as response:
-                    if response.status != 200:
-                        logging.error(f"[{entity_type}] API error: {response.status} - {await response.text()}")
-                        return []
-                    data = await response.json()
+                meta, rows = await fetch_page_once(offset)
+                break
             except Exception as e:
-                logging.error(f"[{entity_type}] Exception while fetching entities: {e}")
-                return []
+                # Ошибки клиента (4xx) повтор не исправит
+                if page_attempt >= MS_PAGE_RETRIES or getattr(e, "status", 500) < 500:
+                    raise
+                delay = MS_BACKOFF_BASE * 2 ** page_attempt
+                logging.warning(f"[{entity_type}] Страница offset={offset} не загружена ({e}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+        return meta, rows
 
-            rows = data.get("rows", [])
-            logging.info(f"[{entity_type}] Received {len(rows)} entities from current page.")
+    try:
+        first_page = await fetch_page(0)
+        total = first_page[0].get("size", 0)
+        offsets = range(page_size, total, page_size)
+        if offsets and checkpoint is not None:
+            # Свертка записей зависит от типов цен и атрибута, они входят в ключ потока
+            stream = checkpoint_stream(base_url, params, entity_type, KASPI_PRICE_TYPE_ID,
+                                       sorted(EXTRA_PRICE_TYPE_IDS), ATTRIBUTE_ID)
+            saved_offsets = checkpoint.begin(stream, total)
+            if saved_offsets:
+                logging.info(f"[{entity_type}] Продолжение загрузки: {len(saved_offsets)} страниц из контрольной точки",
+                             extra=CONSOLE)
+        if offsets:
+            logging.info(f"[{entity_type}] {total} entities, fetching {len(offsets)} more pages with concurrency {concurrency}")
+        # gather сохраняет порядок страниц независимо от порядка их завершения
+        pages = [first_page] + list(await asyncio.gather(*(fetch_page(offset) for offset in offsets)))
+        if stream is not None:
+            checkpoint.finish(stream)
+    except Exception as e:
+        logging.error(f"[{entity_type}] Exception while fetching entities: {e}")
+        if page_sink is not None or raise_errors:
+            raise
+        return []
 
-            if filter_active:
-                items.extend(rows)
-            else:
-                filtered_rows = [p for p in rows if has_kaspi_attribute(p)]
-                items.extend(filtered_rows)
-                logging.info(f"[{entity_type}] Local filtering kept {len(filtered_rows)} out of {len(rows)} entities.")
-                # Дополнительное логирование для комплектов
-                if entity_type == "bundle":
-                    for bundle in filtered_rows:
-                        logging.info(f"[{entity_type}] Bundle included: {bundle.get('name', 'Unknown')} (ID: {bundle.get('id')})")
+    items = []
+    for page_meta, records in pages:
+        logging.info(f"[{entity_type}] Received {len(records)} entities from page offset={page_meta.get('offset', 0)}.")
 
-            current_url = data.get("meta", {}).get("nextHref")
-            current_params = None
+        if filter_active or not apply_local_filter:
+            items.extend(records)
+        else:
+            filtered_records = [record for record in records if record.flagged]
+            items.extend(filtered_records)
+            logging.info(f"[{entity_type}] Local filtering kept {len(filtered_records)} out of {len(records)} entities.")
+            # Дополнительное логирование для комплектов
+            if entity_type == "bundle":
+                for bundle in filtered_records:
+                    log_sampler.debug("bundle_included", "[bundle] Bundle included: %s (ID: %s)", bundle.name or 'Unknown', bundle.id)
 
     logging.info(f"[{entity_type}] Total fetched {len(items)} entities after filtering.")
     return items
 
-@retry_async()
-async def fetch_products():
-    token = await get_access_token()
-    if not token:
-        logging.error("No token, cannot fetch products and bundles")
-        return []
+async def fetch_assortment(token, store_href):
+    """
+    Товары и модификации одним постраничным потоком /entity/assortment с остатками склада store_href.
+    Возвращает (отмеченные для Каспи товары, прочие записи для BundleResolver, {id: остаток}).
+    Фильтр по атрибуту ассортимент не поддерживает, поэтому он применяется локально; комплекты
+    здесь не запрашиваются — их состав ассортимент не разворачивает.
+    """
+    stock_data = {}
 
-    products = await fetch_entity_items(token, "product", use_attribute_filter=True)
-    bundles = await fetch_entity_items(token, "bundle", use_attribute_filter=False)
+    def collect_stock(row):
+        if row.get("meta", {}).get("type") in ("product", "variant") and "stock" in row:
+            stock_data[row["id"]] = max(0, (row.get("stock") or 0) - (row.get("reserve") or 0))
 
-    total_items = products + bundles
-    logging.info(f"Fetched {len(products)} products and {len(bundles)} bundles. Total items: {len(total_items)}")
-    return total_items
+    records = await fetch_entity_items(
+        token, "assortment", use_attribute_filter=False, apply_local_filter=False,
+        extra_filter=f"type=product;type=variant;stockStore={store_href}", row_hook=collect_stock,
+    )
+    products = [record for record in records if record.entity_type == "product" and record.flagged]
+    others = [record for record in records if record.entity_type != "product" or not record.flagged]
+    logging.info(f"[assortment] {len(products)} товаров для Каспи, {len(others)} прочих позиций, остатки {len(stock_data)}")
+    return products, others, stock_data
 
-async def generate_xml(products):
-    logging.info(f"Starting XML generation for {len(products)} products.")
-    if not products:
-        logging.warning("Невозможно сгенерировать XML: список продуктов пуст.")
+async def fetch_entities_by_ids(token, entity_type, ids, batch_size=ENTITY_ID_BATCH, use_attribute_filter=False):
+    """
+    Загружает сущности по списку id пачками: условия id=...;id=... по одному полю
+    МойСклад объединяет через ИЛИ. Фильтр по атрибуту применяется, только если use_attribute_filter.
+    Ошибка любой пачки пробрасывается: отсутствие id в результате значит, что сущности нет (или она
+    не отмечена), а не что запрос не удался.
+    """
+    ids = list(ids)
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    results = await asyncio.gather(*(
+        fetch_entity_items(
+            token, entity_type, use_attribute_filter=use_attribute_filter,
+            extra_filter=";".join(f"id={entity_id}" for entity_id in batch), apply_local_filter=use_attribute_filter,
+            raise_errors=True,
+        )
+        for batch in batches
+    ))
+    return [record for batch in results for record in batch]
+
+def in_stock_ids(stock_by_store):
+    """id позиций, у которых есть остаток хотя бы на одном складе."""
+    return {entity_id for stock in stock_by_store.values() for entity_id, count in stock.items() if count > 0}
+
+async def fetch_stocked_products(token, stock_by_store, skip_ids=()):
+    """
+    Отмеченные для Каспи товары с остатком (режим MS_STOCK_FIRST): загружаются по id из отчета
+    об остатках с фильтром по атрибуту. Модификации из отчета в /entity/product не находятся и просто
+    не возвращаются. Возвращает (товары, запрошенные id); skip_ids — уже запрошенные ранее.
+    Ошибка загрузки любой пачки пробрасывается.
+    """
+    ids = sorted(in_stock_ids(stock_by_store) - set(skip_ids))
+    if not ids:
+        return [], ids
+    products = await fetch_entities_by_ids(token, "product", ids, use_attribute_filter=True)
+    logging.info(f"[stock-first] {len(products)} товаров для Каспи из {len(ids)} позиций с остатком")
+    return products, ids
+
+class BundleResolver:
+    """
+    Расчет остатков и цен комплектов.
+    Строит индекс компонент -> комплекты один раз, догружает пачками компоненты без цены
+    (МойСклад обрезает развернутый components.assortment на больших страницах) и вложенные
+    комплекты, затем считает все комплекты за один проход с мемоизацией.
+    Цены кэшируются между вызовами resolve, поэтому пересчет при изменении только остатков дешевый.
+    Кэши ведутся отдельно для каждого склада (store) и типа цены (price_type_id) фидов.
+    """
+
+    def __init__(self, records):
+        self.records = {}
+        self.component_index = {}
+        self._unavailable = set()
+        # {тип цены: {id комплекта: (цена, рассчитана)}} и {склад: {id комплекта: остаток}}
+        self._prices = {}
+        self._stock = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """
+        Добавляет или заменяет сущность; сбрасывает кэши зависящих от нее комплектов
+        (и при первом добавлении догруженного компонента, который раньше считался отсутствующим).
+        """
+        replaced = record.id in self.records
+        self.records[record.id] = record
+        if record.entity_type == "bundle":
+            for comp_id, _, _, _ in record.components or ():
+                self.component_index.setdefault(comp_id, set()).add(record.id)
+        if (replaced or record.id in self.component_index) and (self._prices or self._stock):
+            self._forget({record.id} | self.dependent_bundles([record.id]))
+
+    def remove(self, entity_id):
+        """Удаляет сущность (например, удаленную в МойСклад) и сбрасывает кэш зависящих комплектов."""
+        if self.records.pop(entity_id, None) is None:
+            return
+        self._forget({entity_id} | self.dependent_bundles([entity_id]))
+
+    def _forget(self, bundle_ids):
+        for cache in list(self._prices.values()) + list(self._stock.values()):
+            for bundle_id in bundle_ids:
+                cache.pop(bundle_id, None)
+
+    def dependent_bundles(self, ids):
+        """Все комплекты (включая вложенные уровни), в состав которых входят ids."""
+        result = set()
+        pending = list(ids)
+        while pending:
+            for bundle_id in self.component_index.get(pending.pop(), ()):
+                if bundle_id not in result:
+                    result.add(bundle_id)
+                    pending.append(bundle_id)
+        return result
+
+    def missing_components(self, bundle_ids=None):
+        """
+        {тип: [id]} компонентов без известной цены и вложенных комплектов без состава.
+        Если фидам нужны дополнительные типы цен, догружаются все компоненты: в развернутом
+        assortment сохраняется только цена Каспи. bundle_ids ограничивает проверку этими комплектами.
+        """
+        missing = {}
+        for record in list(self.records.values()):
+            if record.entity_type != "bundle" or (bundle_ids is not None and record.id not in bundle_ids):
+                continue
+            for comp_id, comp_type, _, comp_price in record.components or ():
+                if comp_id in self.records or comp_id in self._unavailable or not comp_type:
+                    continue
+                if comp_type == "bundle" or comp_price is None or EXTRA_PRICE_TYPE_IDS:
+                    missing.setdefault(comp_type, set()).add(comp_id)
+        return {comp_type: sorted(ids) for comp_type, ids in missing.items()}
+
+    async def backfill(self, token, max_depth=5, bundle_ids=None):
+        """
+        Догружает недостающие компоненты; max_depth ограничивает глубину вложенных комплектов,
+        bundle_ids — комплекты, для которых нужны компоненты (None — все).
+        """
+        for _ in range(max_depth):
+            missing = self.missing_components(bundle_ids)
+            if not missing:
+                return
+            for comp_type, ids in missing.items():
+                # Ошибка загрузки пробрасывается: отсутствующими считаются только id, не найденные успешным запросом
+                fetched = await fetch_entities_by_ids(token, comp_type, ids)
+                for record in fetched:
+                    self.add(record)
+                self._unavailable.update(set(ids) - {record.id for record in fetched})
+                logging.info(f"BundleResolver: догружено {len(fetched)} из {len(ids)} компонентов типа {comp_type}")
+
+    def _bundle_price(self, bundle_id, visiting, price_type_id, cache):
+        """
+        (цена, рассчитана_по_компонентам) комплекта по типу цены. Если цена хотя бы одного компонента
+        неизвестна, цена комплекта None: сумма остальных компонентов занизила бы ее.
+        """
+        if bundle_id in cache:
+            return cache[bundle_id]
+        record = self.records[bundle_id]
+        own_price = record_price(record, price_type_id)
+        if own_price:
+            result = (own_price, False)
+        elif bundle_id in visiting:
+            return (0, False)
+        else:
+            visiting.add(bundle_id)
+            total = 0
+            for comp_id, _, quantity, comp_price in record.components or ():
+                if quantity <= 0:
+                    continue
+                component = self.records.get(comp_id)
+                if component is None:
+                    # Цена из развернутого assortment известна только для типа цены Каспи
+                    comp_price = comp_price if price_type_id is None else None
+                elif component.entity_type == "bundle":
+                    comp_price = self._bundle_price(comp_id, visiting, price_type_id, cache)[0]
+                else:
+                    comp_price = record_price(component, price_type_id)
+                if not comp_price:
+                    total = None
+                    break
+                total += comp_price * quantity
+            visiting.discard(bundle_id)
+            result = (total, bool(total))
+        cache[bundle_id] = result
+        return result
+
+    def stocked_bundles(self, stock_by_store):
+        """id комплектов, которые можно собрать хотя бы на одном складе (кэши resolve не затрагиваются)."""
+        result = set()
+        for stock_data in stock_by_store.values():
+            cache = {}
+            for bundle_id, record in self.records.items():
+                if record.entity_type == "bundle" and self._bundle_stock(bundle_id, stock_data, set(), cache) > 0:
+                    result.add(bundle_id)
+        return result
+
+    def _bundle_stock(self, bundle_id, stock_data, visiting, cache):
+        """Сколько комплектов можно собрать: минимум по компонентам с учетом количества."""
+        if bundle_id in cache:
+            return cache[bundle_id]
+        if bundle_id in visiting:
+            return 0
+        visiting.add(bundle_id)
+        available = None
+        for comp_id, comp_type, quantity, _ in self.records[bundle_id].components or ():
+            if quantity <= 0:
+                continue
+            if comp_type == "bundle":
+                comp_available = self._bundle_stock(comp_id, stock_data, visiting, cache) if comp_id in self.records else 0
+            elif comp_type in ("product", "variant"):
+                comp_available = int(stock_data.get(comp_id, 0))
+            else:
+                # Услуги не ограничивают количество комплектов
+                continue
+            comp_limit = comp_available // quantity
+            available = comp_limit if available is None else min(available, comp_limit)
+        visiting.discard(bundle_id)
+        result = int(available or 0)
+        cache[bundle_id] = result
+        return result
+
+    def resolve(self, stock_data, changed_ids=None, store=None, price_type_id=None):
+        """
+        Остатки и цены всех комплектов: {id: (остаток, цена, цена_рассчитана)}; цена None — неизвестна.
+        changed_ids — id товаров, у которых изменился только остаток: пересчитываются
+        лишь зависящие от них комплекты; без него остатки склада store пересчитываются полностью.
+        """
+        stock_cache = self._stock.setdefault(store, {})
+        if changed_ids is None:
+            stock_cache.clear()
+        else:
+            for bundle_id in self.dependent_bundles(changed_ids):
+                stock_cache.pop(bundle_id, None)
+        if price_type_id == KASPI_PRICE_TYPE_ID:
+            price_type_id = None
+        price_cache = self._prices.setdefault(price_type_id, {})
+        values = {}
+        for bundle_id, record in self.records.items():
+            if record.entity_type != "bundle":
+                continue
+            price, calculated = self._bundle_price(bundle_id, set(), price_type_id, price_cache)
+            values[bundle_id] = (self._bundle_stock(bundle_id, stock_data, set(), stock_cache), price, calculated)
+        return values
+
+def get_catalog_store():
+    """Открывает хранилище каталога при первом обращении (если задан CATALOG_DB)."""
+    global catalog_store
+    if catalog_store is None and CATALOG_DB:
+        # Набор дополнительных типов цен входит в формат записей: при его смене хранилище заполняется заново
+        catalog_store = CatalogStore(CATALOG_DB, layout=",".join(sorted(EXTRA_PRICE_TYPE_IDS)))
+        logging.info(f"Хранилище каталога: {CATALOG_DB}")
+    return catalog_store
+
+def get_page_checkpoint():
+    """Открывает файл контрольных точек при первом обращении (если задан FETCH_CHECKPOINT_DB)."""
+    global page_checkpoint, FETCH_CHECKPOINT_DB
+    if page_checkpoint is None and FETCH_CHECKPOINT_DB:
+        try:
+            page_checkpoint = PageCheckpoint(FETCH_CHECKPOINT_DB, FETCH_CHECKPOINT_MAX_AGE_MINUTES * 60)
+        except sqlite3.Error as e:
+            logging.warning(f"Контрольные точки загрузки недоступны ({FETCH_CHECKPOINT_DB}: {e}), страницы не сохраняются")
+            FETCH_CHECKPOINT_DB = ""
+    return page_checkpoint
+
+def checkpoint_stream(url, params, *extra):
+    """Ключ потока контрольной точки: URL, параметры без offset и параметры свертки страниц."""
+    return stream_key(url, {key: value for key, value in params.items() if key != "offset"}, *extra)
+
+async def sync_entity_store(store, token, entity_type, use_attribute_filter=True):
+    """
+    Синхронизирует сущности типа с локальным хранилищем и возвращает их.
+    Обычно запрашиваются только сущности с updated не раньше водяного знака (без фильтра
+    по атрибуту, чтобы увидеть снятые с выгрузки); раз в CATALOG_FULL_SYNC_HOURS
+    выполняется полная сверка, которая убирает удаленные в МойСклад сущности.
+    Цены компонентов из сохраненного состава комплекта устаревают: изменение цены компонента
+    не меняет updated комплекта. Поэтому при инкрементальной синхронизации у комплектов,
+    не загруженных в этом прогоне, цены компонентов сбрасываются, и BundleResolver.backfill
+    догружает компоненты не из фида по id. Если догрузка не удалась, prepare_catalog прерывает
+    прогон и остается прежний фид: комплект не оценивается по неполному составу.
+    """
+    if store.needs_full_sync(entity_type, CATALOG_FULL_SYNC_HOURS):
+        items = await fetch_entity_items(token, entity_type, use_attribute_filter=use_attribute_filter)
+        if items:
+            store.replace_all(entity_type, [item.to_dict() for item in items])
+            logging.info(f"[{entity_type}] Полная сверка хранилища: {len(items)} сущностей")
+        else:
+            logging.warning(f"[{entity_type}] Полная сверка не вернула сущностей, хранилище не изменено")
+    else:
+        # Дробная часть секунд отбрасывается: >= с перекрытием безопасен, запись идемпотентна
+        watermark = store.watermark(entity_type).split(".")[0]
+        changed = await fetch_entity_items(
+            token, entity_type, use_attribute_filter=False,
+            extra_filter=f"updated>={watermark}", apply_local_filter=False,
+        )
+        upserts = [item.to_dict() for item in changed if item.flagged]
+        removed = [item.to_dict() for item in changed if not item.flagged]
+        store.apply_changes(entity_type, upserts, removed)
+        logging.info(f"[{entity_type}] Инкрементальная синхронизация с {watermark}: обновлено {len(upserts)}, снято с выгрузки {len(removed)}")
+        if entity_type == "bundle":
+            fresh_ids = {item.id for item in changed}
+            records = [OfferRecord.from_dict(data) for data in store.load(entity_type)]
+            for record in records:
+                if record.id not in fresh_ids and record.components:
+                    record.components = tuple((comp_id, comp_type, quantity, None)
+                                              for comp_id, comp_type, quantity, _ in record.components)
+            return records
+    return [OfferRecord.from_dict(data) for data in store.load(entity_type)]
+
+class CatalogFetchResult:
+    """
+    Результат стадии загрузки: товары, комплекты, остатки по складам и время каждого источника.
+    component_records — загруженные попутно позиции не из фида (например, модификации из ассортимента),
+    которые BundleResolver использует как компоненты без догрузки. checked_ids задан в режиме
+    MS_STOCK_FIRST: id, запрошенные по остаткам (товаров без остатка в результате нет).
+    """
+
+    def __init__(self, products, bundles, stock_by_store, timings, component_records=None, checked_ids=None):
+        self.products = products
+        self.bundles = bundles
+        self.stock_by_store = stock_by_store
+        self.timings = timings
+        self.component_records = component_records or []
+        self.checked_ids = checked_ids
+
+    @property
+    def items(self):
+        return self.products + self.bundles
+
+    @property
+    def stock(self):
+        """Остатки основного (первого) склада."""
+        return next(iter(self.stock_by_store.values()), {})
+
+class LiveCatalog:
+    """
+    Каталог последнего прогона в памяти: позиции фида в исходном порядке, остатки и BundleResolver.
+    Вебхуки точечно обновляют его, после чего фид пересобирается без полной загрузки каталога.
+    checked_ids (режим MS_STOCK_FIRST) — id, уже запрошенные по остаткам: каталог содержит только
+    товары с остатком, и появившиеся на складе позиции догружаются при изменении остатков.
+    """
+
+    def __init__(self, items, stock_by_store, bundle_resolver, checked_ids=None):
+        self.items = {record.id: record for record in items}
+        self.stock_by_store = {code: dict(stock) for code, stock in stock_by_store.items()}
+        self.bundle_resolver = bundle_resolver
+        self.checked_ids = set(checked_ids) if checked_ids is not None else None
+
+    def backfill_bundle_ids(self):
+        """Комплекты, которым нужны компоненты: в режиме MS_STOCK_FIRST — только те, что можно собрать."""
+        if self.checked_ids is None:
+            return None
+        return self.bundle_resolver.stocked_bundles(self.stock_by_store)
+
+    def apply_records(self, entity_type, ids, fetched):
+        """
+        Применяет перезагруженные сущности: отмеченные для Каспи товары и комплекты попадают в фид,
+        снятые с выгрузки убираются. ids — удаленные по событию DELETE и запрошенные id; fetched должен быть
+        результатом успешной загрузки, тогда не вернувшийся id значит, что сущность удалена.
+        Возвращает число изменений.
+        """
+        changed = 0
+        found = set()
+        for record in fetched:
+            found.add(record.id)
+            self.bundle_resolver.add(record)
+            if record.entity_type in ("product", "bundle") and record.flagged:
+                self.items[record.id] = record
+            elif self.items.pop(record.id, None) is None:
+                continue
+            changed += 1
+        for entity_id in set(ids) - found:
+            self.bundle_resolver.remove(entity_id)
+            if self.items.pop(entity_id, None) is not None:
+                changed += 1
+        return changed
+
+    def apply_stock(self, stock_by_store):
+        """Заменяет остатки по складам; возвращает id, у которых остаток изменился хотя бы на одном складе."""
+        changed = set()
+        for code, stock in stock_by_store.items():
+            previous = self.stock_by_store.get(code, {})
+            changed.update(entity_id for entity_id in previous.keys() | stock.keys()
+                           if previous.get(entity_id, 0) != stock.get(entity_id, 0))
+            self.stock_by_store[code] = dict(stock)
+        return changed
+
+async def resolve_assortment_store(token, store):
+    """
+    href склада для режима MS_ASSORTMENT_MODE или None, если режим не применим: остатки ассортимента
+    даются по одному складу, а при CATALOG_DB товары синхронизируются инкрементально.
+    """
+    if not MS_ASSORTMENT_MODE:
+        return None
+    if store is not None or len(STORE_CODES) > 1:
+        logging.warning("MS_ASSORTMENT_MODE не используется: он несовместим с CATALOG_DB и несколькими складами")
+        return None
+    return await resolve_store_href(token, STORE_CODES[0])
+
+def stock_first_enabled(store):
+    """Режим MS_STOCK_FIRST применим: загрузка не через CATALOG_DB и не через ассортимент."""
+    if not MS_STOCK_FIRST:
+        return False
+    if store is not None:
+        logging.warning("MS_STOCK_FIRST не используется: он несовместим с CATALOG_DB")
         return False
+    return True
 
-    price_rules = load_price_rules()
-    logging.info(f"Загружены правила корректировки цен из {PRICE_RULES_FILE}: {price_rules}")
+async def fetch_catalog():
+    """
+    Загружает товары, комплекты и отчет по остаткам параллельно,
+    под одним токеном и в общей сессии ms_client.
+    """
+    if not await ensure_token_is_valid():
+        logging.error("No token, cannot fetch products and bundles")
+        return None
+    token = current_token
+    await resolve_catalog_metadata(token)
 
-    root = ET.Element("kaspi_catalog", xmlns="kaspiShopping", date=datetime.datetime.now().strftime("%Y-%m-%d"))
-    root.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-    root.set("xsi:schemaLocation", "http://kaspi.kz/kaspishopping.xsd")
+    timings = {}
 
-    company = os.getenv('COMPANY', 'ИП ВОЗРОЖДЕНИЕ')
-    merchant_id = os.getenv('MERCHANT_ID', '30286450')
-    ET.SubElement(root, "company").text = company
-    ET.SubElement(root, "merchantid").text = merchant_id
-    offers = ET.SubElement(root, "offers")
+    async def timed(source, coro):
+        t_source = time.time()
+        try:
+            return await coro
+        finally:
+            timings[source] = round(time.time() - t_source, 3)
 
-    stock_data = {}
-    if products:
-        logging.info("generate_xml: запрашиваем остатки по складу для всех позиций...")
-        t_stock = time.time()
-        stock_data = await get_stock_for_products(products)
-        logging.info(f"generate_xml: остатки получены для {len(stock_data)} товаров за {time.time() - t_stock:.1f} секунд")
-
-    products_in_xml = 0
-    products_with_zero_stock = 0
-    products_with_stock = 0
-    products_with_price = 0
-    products_with_both = 0
-    bundles_in_xml = 0
-    bundles_with_calculated_price = 0
-    adjusted_prices_count = 0
-
-    # Логируем информацию о ценах для первых 3 товаров для диагностики
-    logging.info(f"=== ДИАГНОСТИКА ЦЕН (первые 3 товаров) ===")
-    logging.info(f"Используемый ID цены Каспи: {KASPI_PRICE_TYPE_ID}")
-    print(f"[{datetime.datetime.now().isoformat()}] === ДИАГНОСТИКА ЦЕН (первые 3 товаров) ===")
-    print(f"[{datetime.datetime.now().isoformat()}] Используемый ID цены Каспи: {KASPI_PRICE_TYPE_ID}")
-    for idx, p in enumerate(products[:3]):
-        sale_prices = p.get('salePrices', [])
-        price_info_list = []
-        for sp in sale_prices:
-            pt = sp.get('priceType', {})
-            price_info_list.append(f"ID: {pt.get('id')}, Name: {pt.get('name')}, Value: {sp.get('value')}")
-        logging.info(f"Товар {idx+1}: {p.get('name')} (артикул: {p.get('code')})")
-        logging.info(f"  Доступные цены: {price_info_list if price_info_list else 'Нет цен'}")
-        print(f"[{datetime.datetime.now().isoformat()}] Товар {idx+1}: {p.get('name')} (артикул: {p.get('code')})")
-        print(f"[{datetime.datetime.now().isoformat()}]   Доступные цены: {price_info_list if price_info_list else 'Нет цен'}")
-    logging.info(f"==============================================")
-    print(f"[{datetime.datetime.now().isoformat()}] ==============================================")
-
-    # Диагностика цен для комплектов
-    bundles = [p for p in products if p.get('meta', {}).get('type') == 'bundle']
-    if bundles:
-        logging.info(f"=== ДИАГНОСТИКА ЦЕН КОМПЛЕКТОВ (первые 3) ===")
-        logging.info(f"Всего комплектов: {len(bundles)}")
-        print(f"[{datetime.datetime.now().isoformat()}] === ДИАГНОСТИКА ЦЕН КОМПЛЕКТОВ (первые 10) ===")
-        print(f"[{datetime.datetime.now().isoformat()}] Всего комплектов: {len(bundles)}")
-        for idx, p in enumerate(bundles[:3]):
-            sale_prices = p.get('salePrices', [])
-            price_info_list = []
-            for sp in sale_prices:
-                pt = sp.get('priceType', {})
-                price_info_list.append(f"ID: {pt.get('id')}, Name: {pt.get('name')}, Value: {sp.get('value')}")
-            logging.info(f"Комплект {idx+1}: {p.get('name')} (артикул: {p.get('code')})")
-            logging.info(f"  Доступные цены: {price_info_list if price_info_list else 'Нет цен'}")
-            print(f"[{datetime.datetime.now().isoformat()}] Комплект {idx+1}: {p.get('name')} (артикул: {p.get('code')})")
-            print(f"[{datetime.datetime.now().isoformat()}]   Доступные цены: {price_info_list if price_info_list else 'Нет цен'}")
-        logging.info(f"==============================================")
-        print(f"[{datetime.datetime.now().isoformat()}] ==============================================")
-    else:
-        logging.info("Комплекты не найдены")
-        print(f"[{datetime.datetime.now().isoformat()}] Комплекты не найдены")
+    store = get_catalog_store()
 
-    for p in products:
-        product_id = p.get("id")
-        meta = p.get("meta", {})
-        entity_type = meta.get("type", "product")
-
-        # Остаток для товара берём напрямую из отчета, для комплекта считаем по компонентам
-        if entity_type == "product":
-            stock_count = int(stock_data.get(product_id, 0))
-        elif entity_type == "bundle":
-            # Расчет остатка комплекта по компонентам: минимум по доступности всех товарных компонент
-            components_block = p.get("components") or []
-            if isinstance(components_block, dict):
-                raw_components = components_block.get("rows") or []
-            elif isinstance(components_block, list):
-                raw_components = components_block
-            else:
-                raw_components = []
-
-            bundle_available = None
-            for comp in raw_components:
-                assortment = comp.get("assortment") if isinstance(comp, dict) else None
-                if isinstance(assortment, str):
-                    assortment = {"meta": {"href": assortment}}
-                assortment = assortment or {}
-                comp_meta = assortment.get("meta", {})
-                if comp_meta.get("type") != "product":
-                    continue
-                comp_id = comp_meta.get("href", "").split("/")[-1].split("?")[0]
-                quantity = comp.get("quantity", 1) if isinstance(comp, dict) else 1
-                available_comp = int(stock_data.get(comp_id, 0))
-                # Сколько комплектов можно собрать из этого компонента
-                if quantity <= 0:
-                    continue
-                comp_limit = available_comp // quantity
-                if bundle_available is None:
-                    bundle_available = comp_limit
-                else:
-                    bundle_available = min(bundle_available, comp_limit)
+    def fetch_entities(entity_type, use_attribute_filter):
+        if store is not None:
+            return sync_entity_store(store, token, entity_type, use_attribute_filter=use_attribute_filter)
+        return fetch_entity_items(token, entity_type, use_attribute_filter=use_attribute_filter)
 
-            stock_count = int(bundle_available or 0)
-            logging.debug(f"Комплект {p.get('name', 'Unknown')} (ID: {product_id}) доступен в кол-ве {stock_count} по компонентам.")
+    t_start = time.time()
+    component_records = []
+    checked_ids = None
+    store_href = await resolve_assortment_store(token, store)
+    if store_href:
+        (products, component_records, stock), bundles = await asyncio.gather(
+            timed("assortment", fetch_assortment(token, store_href)),
+            timed("bundle", fetch_entity_items(token, "bundle", use_attribute_filter=False, profile="bundle_components")),
+        )
+        stock_by_store = {STORE_CODES[0]: stock}
+    elif stock_first_enabled(store):
+        # Сначала остатки и легкий состав всех комплектов, затем по id только товары с остатком;
+        # компоненты комплектов, которые можно собрать, догружает BundleResolver
+        stock_by_store, all_bundles = await asyncio.gather(
+            timed("stock", get_stock_by_store(token)),
+            timed("bundle", fetch_entity_items(token, "bundle", use_attribute_filter=False, apply_local_filter=False,
+                                               profile="bundle_components")),
+        )
+        record_phase("stock", timings["stock"])
+        bundles = [record for record in all_bundles if record.flagged]
+        component_records = [record for record in all_bundles if not record.flagged]
+        # Запросы по id выгодны, пока их не больше, чем страниц полного списка (в отчете есть и нулевые остатки)
+        id_batches = -(-len(in_stock_ids(stock_by_store)) // ENTITY_ID_BATCH)
+        full_pages = -(-len(set().union(*stock_by_store.values())) // FETCH_PROFILES["product"]["limit"])
+        if id_batches <= full_pages:
+            try:
+                products, checked_ids = await timed("product", fetch_stocked_products(token, stock_by_store))
+            except Exception as e:
+                # Без пачки товары с остатком пропали бы из фида
+                logging.error(f"[stock-first] Не удалось загрузить товары по id, фид не публикуется: {e}")
+                return None
         else:
-            stock_count = 0
-
-        if stock_count == 0:
-            products_with_zero_stock += 1
-            logging.debug(f"Продукт {p.get('name', 'Unknown')} (ID: {product_id}) имеет нулевой остаток, пропускаем.")
-            continue
+            logging.info(f"[stock-first] {id_batches} запросов по id больше {full_pages} страниц, товары загружаются целиком")
+            products = await timed("product", fetch_entity_items(token, "product"))
+            checked_ids = sorted(in_stock_ids(stock_by_store))
+    else:
+        products, bundles, stock_by_store = await asyncio.gather(
+            timed("product", fetch_entities("product", True)),
+            timed("bundle", fetch_entities("bundle", False)),
+            timed("stock", get_stock_by_store(token)),
+        )
+        record_phase("stock", timings["stock"])
+    timings["total"] = round(time.time() - t_start, 3)
+    record_phase("fetch", timings["total"])
+
+    stock_rows = sum(len(stock) for stock in stock_by_store.values())
+    logging.info(f"Fetched {len(products)} products, {len(bundles)} bundles and {stock_rows} stock rows "
+                 f"for {len(stock_by_store)} stores. Timings: {timings}")
+    return CatalogFetchResult(products, bundles, stock_by_store, timings, component_records, checked_ids)
+
+class OfferXmlWriter:
+    """
+    Потоковая запись каталога Kaspi: офферы пишутся по одному во временный файл
+    рядом с целевым, при commit файл fsync-ается и атомарно заменяет опубликованный.
+    Клиенты /xml никогда не видят частично записанный фид, память не растет с размером каталога.
+    """
 
-        products_with_stock += 1
+    def __init__(self, path, company, merchant_id, date):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.offers_written = 0
+        self._file = open(self.tmp_path, "w", encoding="utf-8")
+        self._file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        self._file.write(
+            f'<kaspi_catalog xmlns="kaspiShopping" date="{xml_attr(date)}" '
+            f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            f'xsi:schemaLocation="http://kaspi.kz/kaspishopping.xsd">'
+            f"<company>{escape(company)}</company><merchantid>{escape(merchant_id)}</merchantid><offers>"
+        )
+
+    def write_offer(self, sku, model, brand, stock_count, price, store_id="PP1", availabilities=None):
+        """availabilities — [(storeId, остаток)] для нескольких складов; без него — один склад store_id."""
+        if availabilities is None:
+            availabilities = ((store_id, stock_count),)
+        self.write_fragment(offer_xml(sku, model, brand, availabilities, price))
+
+    def write_fragment(self, text, offers=1):
+        """Дописывает готовый XML offers офферов (например, шард, отрендеренный в пуле процессов)."""
+        self._file.write(text)
+        self.offers_written += offers
+
+    def commit(self):
+        """Дописывает закрывающие теги, сбрасывает на диск и атомарно публикует файл."""
+        self._file.write("</offers></kaspi_catalog>")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        # fsync каталога, чтобы переименование пережило сбой
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+    def abort(self):
+        """Отменяет запись: опубликованный файл остается прежним."""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+def load_feed_manifest(path=None):
+    """Офферы последнего опубликованного фида: {sku: [хэш, цена, остаток]} или None."""
+    path = path or FEED_MANIFEST_FILE
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("offers")
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать манифест фида {path}: {e}")
+        return None
 
+def save_feed_manifest(offers, diff, path=None):
+    path = path or FEED_MANIFEST_FILE
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"generated": datetime.datetime.now().isoformat(), "diff": diff, "offers": offers}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def diff_feed_offers(previous, current):
+    """
+    Структурированная разница между манифестами:
+    added/removed — SKU, repriced/restocked — {sku: [было, стало]}, updated — SKU с изменением названия или бренда.
+    """
+    previous = previous or {}
+    diff = {"added": [], "removed": [], "repriced": {}, "restocked": {}, "updated": []}
+    for sku, (offer_hash, price, stock_count) in current.items():
+        old = previous.get(sku)
+        if old is None:
+            diff["added"].append(sku)
+            continue
+        if old[0] == offer_hash:
+            continue
+        old_hash, old_price, old_stock = old
+        if old_price != price:
+            diff["repriced"][sku] = [old_price, price]
+        if old_stock != stock_count:
+            diff["restocked"][sku] = [old_stock, stock_count]
+        if old_price == price and old_stock == stock_count:
+            diff["updated"].append(sku)
+    diff["removed"] = [sku for sku in previous if sku not in current]
+    return diff
+
+def feed_diff_is_empty(diff):
+    return not any(diff.values())
+
+def backup_published_file(path, backup_path):
+    """Резервная копия опубликованного файла: жесткая ссылка, при невозможности — копия."""
+    try:
+        os.link(path, backup_path)
+    except OSError:
+        shutil.copy2(path, backup_path)
+
+class FeedOutput:
+    """Фид во время генерации: потоковая запись XML, манифест офферов и счетчики для статистики."""
+
+    def __init__(self, feed, docs_dir, date):
+        self.feed = feed
+        self.path = os.path.join(docs_dir, feed.file)
+        self.writer = OfferXmlWriter(self.path, feed.company, feed.merchant_id, date)
+        self.manifest = {}
+        self.counts = dict.fromkeys((
+            "with_stock", "with_price", "with_stock_and_price", "offers", "skipped_zero_stock",
+            "bundles_in_xml", "bundles_with_calculated_price", "price_adjusted",
+        ), 0)
+
+def publish_feed(output):
+    """
+    Публикует собранный фид, если его офферы изменились относительно манифеста.
+    Возвращает (статус, {вид изменения: количество}); для несобранного фида diff — None.
+    """
+    feed = output.feed
+    label = f"[{feed.name}] " if len(FEEDS) > 1 else ""
+    if output.counts["offers"] == 0:
+        output.writer.abort()
+        logging.warning("%sНе найдено товаров с ненулевым остатком для включения в XML.", label)
+        return RUN_FAILED, None
+
+    diff = diff_feed_offers(load_feed_manifest(feed.manifest_file), output.manifest)
+    diff_counts = {key: len(value) for key, value in diff.items()}
+    logging.info("%sИзменения фида: добавлено %d, удалено %d, цена %d, остаток %d, прочее %d", label,
+                 len(diff['added']), len(diff['removed']), len(diff['repriced']), len(diff['restocked']),
+                 len(diff['updated']), extra=CONSOLE)
+
+    # В GitHub Actions опубликованного файла локально нет — его хранит Pages
+    published = os.path.exists(output.path) or os.getenv('GITHUB_ACTIONS') == 'true'
+    if feed_diff_is_empty(diff) and published and not FORCE_PUBLISH:
+        output.writer.abort()
+        logging.info("%sФид не изменился, публикация пропущена.", label, extra=CONSOLE)
+        return RUN_UNCHANGED, diff_counts
+
+    t_publish = time.time()
+    output.writer.commit()
+    backup_file = f"{os.path.splitext(feed.file)[0]}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xml"
+    backup_published_file(output.path, os.path.join(os.path.dirname(output.path), backup_file))
+    save_feed_manifest(output.manifest, diff, feed.manifest_file)
+    record_phase("publish", time.time() - t_publish)
+    logging.info("XML успешно сгенерирован в %s.", output.path, extra=CONSOLE)
+    return RUN_UPDATED, diff_counts
+
+def resolve_offer_rows(products, stock_by_store, bundle_values):
+    """
+    Стадия расчета перед рендерингом: для каждой позиции остатки по складам и цена для каждого фида.
+    Возвращает строки в формате offer_render (их можно передать в другой процесс).
+    """
+    # Для каждого фида: тип цены и [(storeId Kaspi, остатки товаров склада, значения комплектов склада)]
+    feed_sources = [
+        (feed.price_type_id,
+         [(store.store_id, stock_by_store.get(store.external_code, {}),
+           bundle_values[(store.external_code, feed.price_type_id)]) for store in feed.stores])
+        for feed in FEEDS
+    ]
+    rows = []
+    append = rows.append
+    for p in products:
+        product_id = p.id
+        entity_type = p.entity_type
+        feed_values = []
+        for price_type_id, sources in feed_sources:
+            # Остаток для товара берём напрямую из отчета, для комплекта — из BundleResolver
+            if entity_type == "product":
+                if len(sources) == 1:
+                    point, stock, _ = sources[0]
+                    availabilities = ((point, int(stock.get(product_id, 0))),)
+                else:
+                    availabilities = tuple([(point, int(stock.get(product_id, 0))) for point, stock, _ in sources])
+                price = p.price if price_type_id is None else record_price(p, price_type_id)
+                feed_values.append((availabilities, price, False))
+            elif entity_type == "bundle":
+                availabilities = []
+                price, price_calculated = 0, False
+                for point, _, values in sources:
+                    stock_count, price, price_calculated = values.get(product_id, (0, 0, False))
+                    availabilities.append((point, stock_count))
+                feed_values.append((tuple(availabilities), price, price_calculated))
+            else:
+                feed_values.append((tuple((point, 0) for point, _, _ in sources), 0, False))
         # Используем только код (code) в качестве SKU, как указано пользователем
-        product_sku = p.get("code") or str(p["id"])
-        offer = ET.SubElement(offers, "offer", sku=product_sku)
-        ET.SubElement(offer, "model").text = p.get("name", "Unknown")
-        brand_name = p.get("brand", {}).get("name", "Без бренда") if p.get("brand") else "Без бренда"
-        ET.SubElement(offer, "brand").text = brand_name
-
-        # Получаем цену Каспи из типов цен (ТОЛЬКО цена Каспи, без fallback)
-        price = 0
-        sale_prices = p.get('salePrices', [])
-        for price_info in sale_prices:
-            price_type = price_info.get('priceType', {})
-            if price_type.get('id') == KASPI_PRICE_TYPE_ID:
-                price = int(price_info.get('value', 0) / 100)  # Переводим копейки в рубли
-                logging.info(f"Найдена цена Каспи для {entity_type} {p.get('name')}: {price}")
-                break
+        append((product_id, entity_type, p.code or str(p.id), p.name or "Unknown", p.brand or "Без бренда",
+                     p.name, p.code, p.folder, tuple(feed_values)))
+    return rows
+
+def get_render_pool():
+    """Пул процессов рендеринга, создается при первом большом каталоге и живет до конца процесса."""
+    global render_pool
+    if render_pool is None:
+        # spawn: дочерние процессы не наследуют потоки сервера и очереди логирования
+        render_pool = concurrent.futures.ProcessPoolExecutor(
+            RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        logging.info(f"Пул рендеринга: {RENDER_PROCESSES} процессов")
+    return render_pool
+
+async def render_in_pool(rows, feed_count, price_rules):
+    """
+    Рендерит строки шардами в пуле процессов, не блокируя цикл событий.
+    Возвращает результаты шардов в исходном порядке или None, если пул недоступен.
+    """
+    global render_pool
+    t_render = time.time()
+    loop = asyncio.get_running_loop()
+    shards = split_shards(rows, RENDER_PROCESSES * RENDER_SHARDS_PER_PROCESS)
+    try:
+        pool = get_render_pool()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, render_offers, shard, feed_count, price_rules) for shard in shards
+        ))
+    except Exception as e:
+        logging.warning(f"Рендеринг в пуле процессов не удался ({e!r}), используется рендеринг в основном процессе")
+        if render_pool is not None:
+            render_pool.shutdown(wait=False, cancel_futures=True)
+            render_pool = None
+        return None
+    logging.info("Рендеринг %d позиций в %d шардах на %d процессах: %.2f с", len(rows), len(shards),
+                 RENDER_PROCESSES, time.time() - t_render)
+    return results
 
-        # Если у комплекта цена Каспи = 0, рассчитываем как сумму цен компонентов
-        if price == 0 and entity_type == "bundle":
-            components_block = p.get("components") or []
-            if isinstance(components_block, dict):
-                raw_components = components_block.get("rows") or []
-            elif isinstance(components_block, list):
-                raw_components = components_block
-            else:
-                raw_components = []
+async def generate_xml(products, stock_data=None, bundle_resolver=None, stock_by_store=None, changed_stock_ids=None):
+    """
+    Строит все фиды FEEDS за один проход по каталогу и публикует те, чьи офферы изменились
+    относительно манифеста. stock_by_store — {externalCode склада: {id: остаток}};
+    stock_data — остатки единственного (основного) склада.
+    changed_stock_ids — id, у которых остаток изменился с прошлого вызова с тем же bundle_resolver
+    (вебхуки): остатки комплектов пересчитываются только для зависящих от них.
+    Возвращает RUN_UPDATED (опубликован хотя бы один фид), RUN_FAILED или RUN_UNCHANGED.
+    """
+    logging.info("Starting XML generation for %d products.", len(products))
+    if not products:
+        logging.warning("Невозможно сгенерировать XML: список продуктов пуст.")
+        return RUN_FAILED
 
-            calculated_price = 0
-            for comp in raw_components:
-                if not isinstance(comp, dict):
-                    continue
-                assortment = comp.get('assortment')
-                if not assortment or not isinstance(assortment, dict):
-                    continue
-                quantity = comp.get('quantity', 1) if isinstance(comp, dict) else 1
-                comp_prices = assortment.get('salePrices', [])
-                comp_price = 0
-                for cp in comp_prices:
-                    cpt = cp.get('priceType', {})
-                    if cpt.get('id') == KASPI_PRICE_TYPE_ID:
-                        comp_price = int(cp.get('value', 0) / 100)  # Переводим копейки в рубли
-                        break
-                calculated_price += comp_price * quantity
-
-            if calculated_price > 0:
-                price = calculated_price
-                bundles_with_calculated_price += 1
-                logging.info(f"Цена комплекта {p.get('name')} рассчитана как сумма компонентов: {price}")
-
-        if price == 0:
-            logging.warning(f"Не найдено цен для товара {p.get('name')} (артикул: {p.get('code')}) - тип: {entity_type}")
-            # Дополнительное логирование для комплектов
-            if entity_type == "bundle":
-                logging.warning(f"Комплект {p.get('name')} имеет 0 цен. Доступные типы цен: {[p.get('priceType', {}).get('name') for p in sale_prices]}")
-        else:
-            original_price = price
-            price = apply_price_adjustment(price, price_rules)
-            if price != original_price:
-                adjusted_prices_count += 1
-                logging.info(
-                    f"Цена скорректирована для {entity_type} {p.get('name')}: "
-                    f"{original_price} -> {price}"
-                )
-            products_with_price += 1
-            products_with_both += 1
-            if entity_type == "bundle":
-                bundles_in_xml += 1
-                logging.info(f"Комплект {p.get('name')} (ID: {product_id}) имеет цену {price} и будет включен в XML")
+    price_rules = load_price_rules()
 
-        availabilities = ET.SubElement(offer, "availabilities")
-        ET.SubElement(availabilities, "availability", available="yes", storeId="PP1", stockCount=str(stock_count))
-        ET.SubElement(offer, "price").text = str(int(price))
-        products_in_xml += 1
+    if stock_by_store is None and stock_data is not None:
+        stock_by_store = {STORE_CODES[0]: stock_data}
+    if stock_by_store is None:
+        logging.info("generate_xml: запрашиваем остатки по складам для всех позиций...")
+        t_stock = time.time()
+        stock_by_store = await get_stock_for_products(products)
+        logging.info(f"generate_xml: остатки получены для {len(stock_by_store)} складов за {time.time() - t_stock:.1f} секунд")
 
-    if products_in_xml == 0:
-        logging.warning("Не найдено товаров с ненулевым остатком для включения в XML.")
-        return False
+    # Остатки и цены комплектов для каждой пары (склад, тип цены), которая встречается в фидах
+    t_bundles = time.time()
+    if bundle_resolver is None:
+        bundle_resolver = BundleResolver(products)
+    bundle_values = resolve_bundle_values(bundle_resolver, stock_by_store, changed_stock_ids)
+    record_phase("bundles", time.time() - t_bundles)
 
-    tree = ET.ElementTree(root)
+    log_catalog_sample(products)
 
-    xml_file = os.getenv('XML_FILE', 'kaspi.xml')
-    docs_dir = "docs"
+    # Офферы пишутся во временные файлы; опубликованные XML заменяются только при успехе
+    t_write = time.time()
+    outputs = []
+    try:
+        outputs.extend(open_feed_outputs())
+        rows = resolve_offer_rows(products, stock_by_store, bundle_values)
+        if RENDER_PROCESSES > 1 and len(rows) >= RENDER_POOL_THRESHOLD:
+            shards = await render_in_pool(rows, len(outputs), price_rules)
+        else:
+            shards = None
+        if shards is None:
+            # Небольшой каталог (или пул недоступен): офферы пишутся в файлы прямо по ходу рендеринга
+            shards = [render_offers(rows, len(outputs), price_rules, log_sampler, [output.writer for output in outputs])]
+        # Шарды склеиваются в исходном порядке позиций
+        for shard in shards:
+            write_shard(outputs, shard)
+    except BaseException:
+        for output in outputs:
+            output.writer.abort()
+        raise
+    record_phase("xml_write", time.time() - t_write)
+    return finish_feeds(outputs, len(products))
+
+def resolve_bundle_values(bundle_resolver, stock_by_store, changed_stock_ids=None):
+    """
+    {(склад, тип цены): {id комплекта: (остаток, цена, рассчитана)}} для всех пар, которые встречаются в фидах.
+    changed_stock_ids передается в BundleResolver.resolve (None — остатки комплектов считаются заново).
+    """
+    bundle_values = {}
+    for feed in FEEDS:
+        for store in feed.stores:
+            key = (store.external_code, feed.price_type_id)
+            if key not in bundle_values:
+                bundle_values[key] = bundle_resolver.resolve(stock_by_store.get(store.external_code, {}),
+                                                             changed_ids=changed_stock_ids, store=store.external_code,
+                                                             price_type_id=feed.price_type_id)
+    return bundle_values
+
+def log_catalog_sample(products):
+    """Диагностика цен первых позиций: по ним видно, что тип цены Каспи найден."""
+    for idx, p in enumerate(products[:3]):
+        logging.info("Товар %d: %s (артикул: %s), цена Каспи: %s", idx + 1, p.name, p.code, p.price or 'Нет цены', extra=CONSOLE)
+    bundles = [p for p in products if p.entity_type == 'bundle']
+    logging.info("Всего комплектов: %d", len(bundles), extra=CONSOLE)
+    for idx, p in enumerate(bundles[:3]):
+        logging.info("Комплект %d: %s (артикул: %s), цена Каспи: %s, компонентов: %d",
+                     idx + 1, p.name, p.code, p.price or 'Нет цены', len(p.components or ()), extra=CONSOLE)
+
+def open_feed_outputs(docs_dir="docs"):
+    """Временные файлы всех фидов FEEDS; при ошибке уже открытые удаляются."""
     if not os.path.exists(docs_dir):
         os.makedirs(docs_dir)
-
-    full_xml_path = os.path.join(docs_dir, xml_file)
-    tree.write(full_xml_path, encoding="utf-8", xml_declaration=True)
-    backup_file = f"kaspi_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xml"
-    tree.write(os.path.join(docs_dir, backup_file), encoding="utf-8", xml_declaration=True)
-    
-    global last_generated_time
-    last_generated_time = datetime.datetime.now()
-    logging.info(f"XML успешно сгенерирован в {full_xml_path}.")
-    logging.info(f"=== СТАТИСТИКА ВЫГРУЗКИ ===")
-    logging.info(f"Всего позиций выгружено из МойСклад: {len(products)}")
-    logging.info(f"Позиций с остатками > 0: {products_with_stock}")
-    logging.info(f"Позиций с ценой Каспи > 0: {products_with_price}")
-    logging.info(f"Позиций с остатками И ценой > 0: {products_with_both}")
-    logging.info(f"Добавлено в XML: {products_in_xml} товаров")
-    logging.info(f"Пропущено с нулевым остатком: {products_with_zero_stock} товаров")
-    logging.info(f"Комплектов в XML: {bundles_in_xml}")
-    logging.info(f"Комплектов с рассчитанной ценой: {bundles_with_calculated_price}")
-    logging.info(f"Скорректировано цен по JSON-правилам: {adjusted_prices_count}")
-    logging.info(f"========================")
-    # Вывод статистики в консоль для GitHub Actions
-    print(f"[{datetime.datetime.now().isoformat()}] === СТАТИСТИКА ВЫГРУЗКИ ===")
-    print(f"[{datetime.datetime.now().isoformat()}] Всего позиций выгружено из МойСклад: {len(products)}")
-    print(f"[{datetime.datetime.now().isoformat()}] Позиций с остатками > 0: {products_with_stock}")
-    print(f"[{datetime.datetime.now().isoformat()}] Позиций с ценой Каспи > 0: {products_with_price}")
-    print(f"[{datetime.datetime.now().isoformat()}] Позиций с остатками И ценой > 0: {products_with_both}")
-    print(f"[{datetime.datetime.now().isoformat()}] Добавлено в XML: {products_in_xml} товаров")
-    print(f"[{datetime.datetime.now().isoformat()}] Пропущено с нулевым остатком: {products_with_zero_stock} товаров")
-    print(f"[{datetime.datetime.now().isoformat()}] Комплектов в XML: {bundles_in_xml}")
-    print(f"[{datetime.datetime.now().isoformat()}] Комплектов с рассчитанной ценой: {bundles_with_calculated_price}")
-    print(f"[{datetime.datetime.now().isoformat()}] Скорректировано цен по JSON-правилам: {adjusted_prices_count}")
-    print(f"[{datetime.datetime.now().isoformat()}] ========================")
+    date = datetime.datetime.now().strftime("%Y-%m-%d")
+    outputs = []
+    try:
+        for feed in FEEDS:
+            outputs.append(FeedOutput(feed, docs_dir, date))
+    except BaseException:
+        for output in outputs:
+            output.writer.abort()
+        raise
+    return outputs
+
+def write_shard(outputs, shard):
+    """Дописывает результат render_offers (по элементу на фид) в файлы, манифесты и счетчики фидов."""
+    for output, (fragment, manifest, counts) in zip(outputs, shard):
+        if fragment:
+            output.writer.write_fragment(fragment, counts["offers"])
+        output.manifest.update(manifest)
+        for key, value in counts.items():
+            output.counts[key] += value
+
+def finish_feeds(outputs, positions):
+    """Итоги генерации и публикация фидов: RUN_UPDATED, RUN_FAILED или RUN_UNCHANGED."""
+    totals = {key: sum(output.counts[key] for output in outputs) for key in outputs[0].counts}
+    OFFERS.set(totals["offers"], state="emitted")
+    OFFERS.set(totals["skipped_zero_stock"], state="skipped_zero_stock")
+    OFFERS.set(totals["price_adjusted"], state="price_adjusted")
+    OFFERS.set(totals["with_stock"] - totals["with_price"], state="without_price")
+
+    # Итоги одной структурированной записью (в extra["summary"] — для обработчиков, разбирающих записи)
+    summary = {"positions": positions}
+    if len(outputs) == 1:
+        summary.update(outputs[0].counts)
+    else:
+        summary["feeds"] = {output.feed.name: output.counts for output in outputs}
+    summary["suppressed_log_messages"] = log_sampler.suppressed()
+    logging.info("Статистика выгрузки: %s", json.dumps(summary, ensure_ascii=False), extra=dict(CONSOLE, summary=summary))
+
+    global last_generated_time, last_feed_diff
+    results = {output.feed.name: publish_feed(output) for output in outputs}
+    diffs = {name: diff for name, (_, diff) in results.items() if diff is not None}
+    if diffs:
+        last_feed_diff = diffs[FEEDS[0].name] if len(FEEDS) == 1 else diffs
+    statuses = [status for status, _ in results.values()]
+    if RUN_UPDATED in statuses:
+        last_generated_time = datetime.datetime.now()
+        return RUN_UPDATED
+    if RUN_FAILED in statuses:
+        return RUN_FAILED
+    return RUN_UNCHANGED
+
+def stream_pipeline_enabled():
+    """Конвейер применим к обычной загрузке: без CATALOG_DB, ассортимента и загрузки по остаткам."""
+    if not STREAM_PIPELINE:
+        return False
+    if CATALOG_DB or MS_ASSORTMENT_MODE or MS_STOCK_FIRST:
+        logging.warning("STREAM_PIPELINE не используется: он несовместим с CATALOG_DB, MS_ASSORTMENT_MODE и MS_STOCK_FIRST")
+        return False
     return True
 
+async def stream_catalog_feeds():
+    """
+    Загрузка и генерация конвейером (STREAM_PIPELINE): страницы товаров проходят стадии normalize
+    (свертка в OfferRecord), resolve (остатки и цены по фидам; первая страница ждет отчет по остаткам),
+    render (XML и манифест) и emit (запись в файлы в порядке страниц), пока следующие страницы
+    еще загружаются. Остатки и комплекты загружаются параллельно; комплекты пишутся после товаров,
+    им нужен весь состав.
+    Возвращает (статус, позиции, остатки по складам, BundleResolver) или None без токена.
+    """
+    if not await ensure_token_is_valid():
+        logging.error("No token, cannot fetch products and bundles")
+        return None
+    token = current_token
+    await resolve_catalog_metadata(token)
+    price_rules = load_price_rules()
+
+    t_start = time.time()
+
+    async def fetch_stock():
+        try:
+            return await get_stock_by_store(token)
+        finally:
+            record_phase("stock", time.time() - t_start)
+
+    stock_task = asyncio.create_task(fetch_stock())
+    bundle_task = asyncio.create_task(fetch_entity_items(token, "bundle", use_attribute_filter=False))
+    try:
+        outputs = open_feed_outputs()
+    except BaseException:
+        stock_task.cancel()
+        bundle_task.cancel()
+        raise
+    stock_by_store = {}
+    feed_count = len(outputs)
+    # Строкам товаров значения комплектов не нужны
+    no_bundles = {(store.external_code, feed.price_type_id): {} for feed in FEEDS for store in feed.stores}
+    page_size = FETCH_PROFILES["product"]["limit"]
+    products = []
+    pending = {}
+    next_offset = 0
+
+    def normalize(page):
+        offset, rows = page
+        records = [project_entity_row(row, "product") for row in rows]
+        if not ATTRIBUTE_ID:
+            records = [record for record in records if record.flagged]
+        return offset, records
+
+    async def resolve(page):
+        nonlocal stock_by_store
+        offset, records = page
+        stock_by_store = await stock_task
+        return offset, records, resolve_offer_rows(records, stock_by_store, no_bundles)
+
+    def render(page):
+        offset, records, rows = page
+        return offset, records, render_offers(rows, feed_count, price_rules, log_sampler)
+
+    def emit(page):
+        # Страницы завершаются в любом порядке, а в файл пишутся по возрастанию offset
+        nonlocal next_offset
+        offset, records, shard = page
+        pending[offset] = (records, shard)
+        while next_offset in pending:
+            records, shard = pending.pop(next_offset)
+            products.extend(records)
+            write_shard(outputs, shard)
+            next_offset += page_size
+
+    pipeline = Pipeline("fetch", [("normalize", normalize), ("resolve", resolve), ("render", render), ("emit", emit)],
+                        maxsize=PIPELINE_QUEUE_SIZE)
+    try:
+        pipeline.start()
+        try:
+            await fetch_entity_items(token, "product", page_sink=lambda offset, rows: pipeline.put((offset, rows)))
+        except BaseException:
+            await pipeline.abort()
+            raise
+        await pipeline.close()
+        stock_by_store = await stock_task
+        bundles = await bundle_task
+        timings = pipeline.stats()
+        record_phase("fetch", time.time() - t_start)
+        logging.info("Конвейер: %d товаров, %d комплектов за %.1f с, стадии: %s", len(products), len(bundles),
+                     time.time() - t_start, json.dumps(timings, ensure_ascii=False), extra=CONSOLE)
+        run_pipeline_stats.update(timings)
+        for stage, stats in timings.items():
+            PIPELINE_ITEMS_PER_SECOND.set(stats["items_per_second"] or 0, stage=stage)
+            PIPELINE_MAX_QUEUE_DEPTH.set(stats["max_queue_depth"], stage=stage)
+
+        items = products + bundles
+        bundle_resolver = BundleResolver(items)
+        if not items:
+            for output in outputs:
+                output.writer.abort()
+            return RUN_FAILED, items, stock_by_store, bundle_resolver
+        t_bundles = time.time()
+        await bundle_resolver.backfill(token)
+        bundle_values = resolve_bundle_values(bundle_resolver, stock_by_store)
+        record_phase("bundles", time.time() - t_bundles)
+        log_catalog_sample(items)
+
+        t_write = time.time()
+        rows = resolve_offer_rows(bundles, stock_by_store, bundle_values)
+        write_shard(outputs, render_offers(rows, feed_count, price_rules, log_sampler, [output.writer for output in outputs]))
+        record_phase("xml_write", time.time() - t_write)
+    except BaseException as e:
+        stock_task.cancel()
+        bundle_task.cancel()
+        for output in outputs:
+            output.writer.abort()
+        if not isinstance(e, Exception):
+            raise
+        logging.error(f"Конвейер: загрузка не удалась, фид не публикуется: {e}")
+        return RUN_FAILED, [], stock_by_store, None
+    return finish_feeds(outputs, len(items)), items, stock_by_store, bundle_resolver
+
 async def update_xml():
-    logging.info('update_xml: started')
-    print(f"[{datetime.datetime.now().isoformat()}] update_xml: старт")
+    """Полный прогон: загрузка, расчет и публикация. Возвращает RUN_UPDATED, RUN_UNCHANGED или RUN_FAILED."""
+    global last_run_status
+    run_phases.clear()
+    run_pipeline_stats.clear()
+    log_sampler.counts.clear()
+    logging.info('update_xml: старт', extra=CONSOLE)
     t_start = time.time()
 
-    products = await fetch_products()
-    logging.info(f'update_xml: fetched {len(products)} products from MoySklad.')
-    print(f"[{datetime.datetime.now().isoformat()}] update_xml: получено {len(products)} позиций из МойСклад за {time.time() - t_start:.1f} секунд")
+    if stream_pipeline_enabled():
+        result = await stream_catalog_feeds()
+        status, products, stock_by_store, bundle_resolver = result or (RUN_FAILED, [], {}, None)
+        if not products:
+            logging.error("Не удалось получить товары из МойСклад. Пропускаем генерацию XML.")
+        catalog_state = LiveCatalog(products, stock_by_store, bundle_resolver) if products else None
+    else:
+        status, catalog_state = await fetch_and_generate(t_start)
+
+    if status == RUN_UPDATED:
+        logging.info('update_xml: finished successfully.')
+    elif status == RUN_UNCHANGED:
+        logging.info('update_xml: feed unchanged, nothing published.')
+    elif catalog_state is not None:
+        logging.warning('update_xml: XML не был сгенерирован или содержит 0 товаров. Оставляем старый XML.')
+
+    ms_client.log_stats()
+    if status in (RUN_UPDATED, RUN_UNCHANGED):
+        global live_catalog
+        live_catalog = catalog_state
+    if status == RUN_UPDATED and feed_cache.active:
+        feed_cache.reload_feeds()
+    finish_run_metrics(status, time.time() - t_start)
+    last_run_status = status
+    return status
+
+async def prepare_catalog(t_start):
+    """Загрузка каталога и компонентов комплектов. Возвращает (CatalogFetchResult, LiveCatalog) или None."""
+    catalog = await fetch_catalog()
+    products = catalog.items if catalog else []
+    logging.info("update_xml: получено %d позиций из МойСклад за %.1f секунд, время источников (сек): %s",
+                 len(products), time.time() - t_start, catalog.timings if catalog else None, extra=CONSOLE)
 
     if not products:
         logging.error("Не удалось получить товары из МойСклад. Пропускаем генерацию XML.")
-        return
+        return None
+
+    t_bundles = time.time()
+    bundle_resolver = BundleResolver(products + catalog.component_records)
+    catalog_state = LiveCatalog(products, catalog.stock_by_store, bundle_resolver, catalog.checked_ids)
+    try:
+        await bundle_resolver.backfill(current_token, bundle_ids=catalog_state.backfill_bundle_ids())
+    except Exception as e:
+        logging.error(f"Не удалось догрузить компоненты комплектов, фид не публикуется: {e}")
+        return None
+    record_phase("bundles", time.time() - t_bundles)
+    logging.info("update_xml: компоненты комплектов подготовлены за %.1f секунд", time.time() - t_bundles, extra=CONSOLE)
+    return catalog, catalog_state
+
+async def fetch_and_generate(t_start):
+    """Поэтапный прогон: весь каталог, затем комплекты и generate_xml. Возвращает (статус, LiveCatalog или None)."""
+    prepared = await prepare_catalog(t_start)
+    if prepared is None:
+        return RUN_FAILED, None
+    catalog, catalog_state = prepared
+    products, bundle_resolver = catalog.items, catalog_state.bundle_resolver
 
     t_gen = time.time()
-    xml_generated_successfully = await generate_xml(products)
-    print(f"[{datetime.datetime.now().isoformat()}] update_xml: generate_xml завершен за {time.time() - t_gen:.1f} секунд")
+    status = await generate_xml(products, bundle_resolver=bundle_resolver, stock_by_store=catalog.stock_by_store)
+    logging.info("update_xml: generate_xml завершен за %.1f секунд", time.time() - t_gen, extra=CONSOLE)
+    return status, catalog_state
 
-    if xml_generated_successfully:
-        logging.info('update_xml: finished successfully.')
+async def fetch_snapshot(path):
+    """
+    Загружает каталог (с компонентами комплектов) и остатки и сохраняет снимок в path без генерации XML.
+    Возвращает размер снимка в байтах или None, если загрузить каталог не удалось.
+    """
+    run_phases.clear()
+    t_start = time.time()
+    prepared = await prepare_catalog(t_start)
+    ms_client.log_stats()
+    if prepared is None:
+        return None
+    catalog, catalog_state = prepared
+    items = catalog.items
+    item_ids = {record.id for record in items}
+    components = [record.to_dict() for record in catalog_state.bundle_resolver.records.values()
+                  if record.id not in item_ids]
+    t_write = time.time()
+    size = write_snapshot(path, [record.to_dict() for record in items], components, catalog.stock_by_store, {
+        "kaspi_price_type_id": KASPI_PRICE_TYPE_ID,
+        "price_type_ids": sorted(EXTRA_PRICE_TYPE_IDS),
+        "stores": STORE_CODES,
+    })
+    record_phase("snapshot", time.time() - t_write)
+    logging.info("Снимок каталога %s: %d позиций, %d компонентов, %.1f МБ, загрузка %.1f с", path, len(items),
+                 len(components), size / 1024 / 1024, time.time() - t_start, extra=CONSOLE)
+    return size
+
+async def render_snapshot(path):
+    """
+    Генерация и публикация фидов из снимка без обращения к МойСклад: остатки и компоненты комплектов
+    берутся из снимка. Возвращает RUN_UPDATED, RUN_UNCHANGED или RUN_FAILED.
+    """
+    global last_run_status
+    run_phases.clear()
+    run_pipeline_stats.clear()
+    log_sampler.counts.clear()
+    t_start = time.time()
+    try:
+        snapshot = read_snapshot(path)
+    except SnapshotError as e:
+        logging.error(f"Генерация из снимка невозможна: {e}")
+        status = RUN_FAILED
     else:
-        logging.warning('update_xml: XML не был сгенерирован или содержит 0 товаров. Оставляем старый XML.')
+        header = snapshot.header
+        logging.info("Генерация из снимка %s от %s: %d позиций", path, header.get("created"), len(snapshot.items),
+                     extra=CONSOLE)
+        if header.get("kaspi_price_type_id") != KASPI_PRICE_TYPE_ID:
+            logging.warning(f"Снимок содержит цены типа {header.get('kaspi_price_type_id')}, а не {KASPI_PRICE_TYPE_ID}")
+        missing_price_types = EXTRA_PRICE_TYPE_IDS - set(header.get("price_type_ids") or ())
+        missing_stores = set(STORE_CODES) - set(snapshot.stock_by_store)
+        if missing_price_types or missing_stores:
+            logging.warning(f"В снимке нет типов цен {sorted(missing_price_types)} и складов {sorted(missing_stores)} "
+                            f"из FEEDS_CONFIG: их цены и остатки считаются нулевыми")
+        items = [OfferRecord.from_dict(data) for data in snapshot.items]
+        components = [OfferRecord.from_dict(data) for data in snapshot.components]
+        record_phase("snapshot", time.time() - t_start)
+        # Компоненты уже в снимке, поэтому без backfill: сеть не нужна
+        bundle_resolver = BundleResolver(items + components)
+        status = await generate_xml(items, bundle_resolver=bundle_resolver, stock_by_store=snapshot.stock_by_store)
+    logging.info("Генерация из снимка завершена за %.1f с: %s", time.time() - t_start, status, extra=CONSOLE)
+    finish_run_metrics(status, time.time() - t_start, trigger="snapshot")
+    last_run_status = status
+    return status
+
+class FeedSnapshot:
+    """Неизменяемый снимок опубликованного фида: байты, сжатые варианты, ETag и время изменения."""
+    __slots__ = ("variants", "etag", "last_modified", "stat_key")
+
+    def __init__(self, body, last_modified, stat_key):
+        self.variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body, quality=9)
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = last_modified
+        self.stat_key = stat_key
+
+class FeedCache:
+    """
+    Фиды для /xml в памяти (по одному снимку на файл). Снимок заменяется целиком после каждой
+    успешной генерации (или при изменении файла на диске), поэтому потоки сервера читают его без блокировок.
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+        # Снимок готовится заранее только при запущенном HTTP-сервере (в cloud_run он не нужен)
+        self.active = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat_key(path):
+        st = os.stat(path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def load(self, path):
+        """Читает файл и готовит сжатые варианты; возвращает новый снимок."""
+        with self._lock:
+            stat_key = self._stat_key(path)
+            snapshot = self.snapshots.get(path)
+            if snapshot is not None and snapshot.stat_key == stat_key:
+                return snapshot
+            with open(path, "rb") as f:
+                body = f.read()
+            last_modified = datetime.datetime.fromtimestamp(stat_key[2] / 1e9, tz=datetime.timezone.utc)
+            snapshot = self.snapshots[path] = FeedSnapshot(body, last_modified, stat_key)
+            logging.info(f"FeedCache: загружен фид {path} ({len(body)} байт, ETag {snapshot.etag})")
+            return snapshot
+
+    def reload_feeds(self):
+        """Обновляет снимки всех фидов после публикации."""
+        for feed in FEEDS:
+            try:
+                self.load(feed_path(feed))
+            except OSError as e:
+                logging.warning(f"FeedCache: не удалось загрузить фид {feed.file}: {e}")
+
+    def get(self, path):
+        """Текущий снимок; перечитывает файл, если его заменили на диске (например, cloud_run)."""
+        snapshot = self.snapshots.get(path)
+        try:
+            if snapshot is None or snapshot.stat_key != self._stat_key(path):
+                snapshot = self.load(path)
+        except FileNotFoundError:
+            return snapshot
+        return snapshot
+
+feed_cache = FeedCache()
+
+def feed_path(feed=None):
+    """Путь опубликованного фида; без аргумента — первого (основного) фида."""
+    return os.path.join("docs", (feed or FEEDS[0]).file)
+
+def choose_encoding(accept_encoding, variants):
+    """Лучшая доступная кодировка из Accept-Encoding: br, затем gzip, иначе без сжатия."""
+    for encoding in ("br", "gzip"):
+        if encoding in variants and accept_encoding[encoding]:
+            return encoding
+    return "identity"
 
 @app.route("/xml")
-def serve_xml():
-    xml_file = os.path.join("docs", os.getenv('XML_FILE', 'kaspi.xml'))
-    return send_file(xml_file, mimetype="application/xml")
+@app.route("/xml/<name>")
+def serve_xml(name=None):
+    """Основной фид или фид с именем name из FEEDS_CONFIG."""
+    feed = FEEDS[0] if name is None else next((feed for feed in FEEDS if feed.name == name), None)
+    if feed is None:
+        return Response("unknown feed", status=404, mimetype="text/plain")
+    snapshot = feed_cache.get(feed_path(feed))
+    if snapshot is None:
+        return Response("feed is not generated yet", status=404, mimetype="text/plain")
+
+    encoding = choose_encoding(request.accept_encodings, snapshot.variants)
+    body = snapshot.variants[encoding]
+    response = Response(body, mimetype="application/xml")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    # Сильный ETag уникален для каждого варианта представления
+    response.set_etag(snapshot.etag if encoding == "identity" else f"{snapshot.etag}-{encoding}")
+    response.last_modified = snapshot.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = FEED_MAX_AGE
+    # 304 для If-None-Match/If-Modified-Since и 206 для Range
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+
+def post_control(cmd):
+    """Передает команду из потока Flask в цикл событий; False, если цикл еще не запущен."""
+    if event_loop is None or generation_scheduler is None:
+        return False
+    event_loop.call_soon_threadsafe(generation_scheduler.handle_command, cmd)
+    return True
+
+def parse_webhook_payload(payload):
+    """
+    Разбирает тело вебхука МойСклад: ({тип: {id: действие}}, изменились_остатки).
+    Вебхуки на сущности приходят как {"events": [{"meta": {...}, "action": ...}]},
+    вебхуки на остатки — как {"reportUrl": ...}.
+    """
+    entities = {}
+    for event in payload.get("events") or []:
+        meta = event.get("meta") or {}
+        entity_type = meta.get("type")
+        entity_id = meta.get("href", "").split("/")[-1].split("?")[0]
+        if entity_type in ("product", "bundle", "variant") and entity_id:
+            entities.setdefault(entity_type, {})[entity_id] = event.get("action", "UPDATE")
+    return entities, bool(payload.get("reportUrl"))
+
+@app.route('/webhook/moysklad', methods=['POST'])
+def webhook_moysklad():
+    """Прием вебхуков МойСклад (товары, комплекты, модификации, остатки)."""
+    if WEBHOOK_SECRET and request.args.get('secret') != WEBHOOK_SECRET:
+        return jsonify({'status': 'error', 'message': 'forbidden'}), 403
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'status': 'error', 'message': 'invalid payload'}), 400
+    entities, stock_changed = parse_webhook_payload(payload)
+    if event_loop is None or webhook_processor is None:
+        return jsonify({'status': 'error', 'message': 'webhook processor is not running'}), 503
+    # МойСклад ждет быстрого ответа: события только ставятся в очередь
+    event_loop.call_soon_threadsafe(webhook_processor.enqueue, entities, stock_changed)
+    return jsonify({'status': 'ok', 'events': sum(len(ids) for ids in entities.values()), 'stock': stock_changed})
+
+@app.route('/metrics')
+def serve_metrics():
+    """Метрики в текстовом формате Prometheus."""
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route('/control/generate')
 def control_generate():
     """Trigger generation now (schedules coroutine in event loop)."""
-    try:
-        control_queue.put_nowait({'cmd': 'generate_now'})
-        return jsonify({'status': 'ok', 'message': 'generation scheduled'})
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    if not post_control({'cmd': 'generate_now'}):
+        return jsonify({'status': 'error', 'message': 'scheduler is not running'}), 503
+    return jsonify({'status': 'ok', 'message': 'generation scheduled'})
 
 @app.route('/control/schedule')
 def control_schedule():
@@ -640,7 +2480,10 @@ def control_schedule():
         minutes = int(minutes)
     except Exception:
         return jsonify({'status': 'error', 'message': 'invalid minutes parameter'}), 400
-    control_queue.put_nowait({'cmd': 'set_schedule', 'minutes': minutes})
+    if minutes < 1:
+        return jsonify({'status': 'error', 'message': 'minutes must be positive'}), 400
+    if not post_control({'cmd': 'set_schedule', 'minutes': minutes}):
+        return jsonify({'status': 'error', 'message': 'scheduler is not running'}), 503
     return jsonify({'status': 'ok', 'message': f'schedule set to {minutes} minutes'})
 
 @app.route('/control/status')
@@ -648,19 +2491,230 @@ def control_status():
     """Return simple JSON status."""
     running = True
     lg = last_generated_time.isoformat() if last_generated_time else None
-    return jsonify({'server': running, 'last_generated': lg})
+    scheduler = generation_scheduler.status() if generation_scheduler else None
+    return jsonify({'server': running, 'last_generated': lg, 'last_status': last_run_status, 'last_diff': last_feed_diff,
+                    'scheduler': scheduler})
 
 @app.route('/control/stop', methods=['POST'])
 def control_stop():
     """Request the process to stop (will exit)."""
-    control_queue.put_nowait({'cmd': 'stop'})
+    if not post_control({'cmd': 'stop'}):
+        return jsonify({'status': 'error', 'message': 'scheduler is not running'}), 503
     return jsonify({'status': 'ok', 'message': 'stop requested'})
 
 def run_flask():
-    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
+    """HTTP-сервер: waitress, если установлен, иначе многопоточный встроенный сервер Flask."""
+    feed_cache.active = True
+    try:
+        from waitress import serve
+    except ImportError:
+        logging.warning("waitress не установлен, используется встроенный сервер Flask")
+        app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False, threaded=True)
+        return
+    serve(app, host="0.0.0.0", port=5000, threads=HTTP_THREADS, connection_limit=HTTP_CONNECTION_LIMIT)
+
+class GenerationScheduler:
+    """
+    Планировщик генерации на цикле событий asyncio.
+
+    Одновременно выполняется не больше одного прогона job. Запуски, запрошенные во время
+    прогона (по таймеру, /control/generate, вебхук), сливаются в один повторный прогон
+    сразу после текущего. Команды будят цикл немедленно, без опроса.
+    """
+
+    def __init__(self, job, interval_minutes=60):
+        self.job = job
+        self.interval = interval_minutes * 60
+        self.next_run = None
+        self.running = False
+        self.pending = False
+        self.stopped = False
+        self._wakeup = asyncio.Event()
+        # Общая блокировка записи фида: полный прогон и обновления по вебхукам не пересекаются
+        self.lock = asyncio.Lock()
+        self.stats = {"runs": 0, "coalesced": 0}
+
+    def trigger(self, reason="manual"):
+        """Запрашивает прогон; если прогон уже ожидается, запрос сливается с ним."""
+        if self.pending:
+            self.stats["coalesced"] += 1
+            logging.info(f"Scheduler: запуск ({reason}) объединен с уже запланированным")
+        else:
+            logging.info(f"Scheduler: запрошен запуск ({reason})")
+        self.pending = True
+        self._wakeup.set()
+
+    def set_interval(self, minutes):
+        """Новый интервал; следующий плановый запуск отсчитывается от текущего момента."""
+        self.interval = minutes * 60
+        self.next_run = asyncio.get_running_loop().time() + self.interval
+        self._wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self._wakeup.set()
+
+    def handle_command(self, cmd):
+        """Команда из /control/* (вызывается в цикле событий через call_soon_threadsafe)."""
+        c = cmd.get('cmd')
+        if c == 'generate_now':
+            logging.info('Control: generate_now received')
+            self.trigger('generate_now')
+        elif c == 'set_schedule':
+            minutes = int(cmd.get('minutes', 60))
+            logging.info(f'Control: set_schedule {minutes} minutes')
+            self.set_interval(minutes)
+        elif c == 'stop':
+            logging.info('Control: stop received, exiting')
+            self.stop()
+
+    def status(self):
+        next_run = None
+        if self.next_run is not None and event_loop is not None:
+            delay = max(0.0, self.next_run - event_loop.time())
+            next_run = (datetime.datetime.now() + datetime.timedelta(seconds=delay)).isoformat(timespec='seconds')
+        return {'interval_minutes': self.interval / 60, 'running': self.running, 'pending': self.pending,
+                'next_run': next_run, **self.stats}
+
+    async def run(self):
+        """Основной цикл: ждет таймер или команду, выполняет прогоны строго по одному."""
+        loop = asyncio.get_running_loop()
+        if self.next_run is None:
+            self.next_run = loop.time()
+        while not self.stopped:
+            timeout = max(0.0, self.next_run - loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.pending = True
+            self._wakeup.clear()
+            if self.stopped:
+                break
+            if not self.pending:
+                # Изменился только интервал: пересчитываем время ожидания
+                continue
+            self.pending = False
+            self.running = True
+            self.next_run = loop.time() + self.interval
+            self.stats["runs"] += 1
+            try:
+                async with self.lock:
+                    await self.job()
+            except Exception as e:
+                logging.exception(f"Scheduler: прогон завершился ошибкой: {e}")
+            finally:
+                self.running = False
+
+class WebhookProcessor:
+    """
+    Накопление и применение событий вебхуков.
+
+    События объединяются, пока идут подряд: пересборка начинается через WEBHOOK_DEBOUNCE_SECONDS
+    тишины, но не позже WEBHOOK_MAX_DELAY_SECONDS после первого события пачки. Перезагружаются
+    только затронутые сущности; комплекты, зависящие от них, пересчитываются BundleResolver.
+    """
+
+    def __init__(self, scheduler, debounce=WEBHOOK_DEBOUNCE_SECONDS, max_delay=WEBHOOK_MAX_DELAY_SECONDS):
+        self.scheduler = scheduler
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = {}
+        self.stock_changed = False
+        self._first_event = None
+        self._timer = None
+        # Ссылки на задачи применения пачек: цикл событий хранит только слабые ссылки
+        self._tasks = set()
+        self.stats = {"events": 0, "batches": 0, "refetched": 0, "fallback_runs": 0}
+
+    def enqueue(self, entities, stock_changed):
+        """Добавляет события в текущую пачку и переносит срок ее применения."""
+        if not entities and not stock_changed:
+            return
+        loop = asyncio.get_running_loop()
+        for entity_type, actions in entities.items():
+            self.pending.setdefault(entity_type, {}).update(actions)
+            self.stats["events"] += len(actions)
+        self.stock_changed = self.stock_changed or stock_changed
+        now = loop.time()
+        if self._first_event is None:
+            self._first_event = now
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = min(self.debounce, max(0.0, self._first_event + self.max_delay - now))
+        self._timer = loop.call_later(delay, self._flush)
+
+    def _flush(self):
+        batch, stock_changed = self.pending, self.stock_changed
+        self.pending, self.stock_changed = {}, False
+        self._first_event = None
+        self._timer = None
+        task = asyncio.create_task(self.process(batch, stock_changed))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def process(self, batch, stock_changed):
+        async with self.scheduler.lock:
+            try:
+                await self._apply(batch, stock_changed)
+            except Exception as e:
+                logging.exception(f"Webhook: ошибка применения событий, запрошен полный прогон: {e}")
+                self.scheduler.trigger("webhook")
+
+    async def _apply(self, batch, stock_changed):
+        if live_catalog is None:
+            # Каталога в памяти еще нет (первый прогон не завершился): нужна полная загрузка
+            self.stats["fallback_runs"] += 1
+            self.scheduler.trigger("webhook")
+            return
+        if not await ensure_token_is_valid():
+            raise RuntimeError("no token")
+        token = current_token
+        self.stats["batches"] += 1
+        run_phases.clear()
+        log_sampler.counts.clear()
+        t_start = time.time()
+
+        changed = 0
+        # Остатки комплектов пересчитываются только для зависящих от позиций с новым остатком
+        changed_stock_ids = set()
+        for entity_type, actions in batch.items():
+            deleted = [entity_id for entity_id, action in actions.items() if action == "DELETE"]
+            to_fetch = [entity_id for entity_id, action in actions.items() if action != "DELETE"]
+            # Ошибка загрузки пробрасывается в process: вместо удаления офферов будет полный прогон
+            fetched = await fetch_entities_by_ids(token, entity_type, to_fetch) if to_fetch else []
+            self.stats["refetched"] += len(to_fetch)
+            changed += live_catalog.apply_records(entity_type, actions.keys(), fetched)
+            # Удаленные в МойСклад сущности не перезагружаются
+            logging.info(f"Webhook: {entity_type}: перезагружено {len(to_fetch)}, удалено {len(deleted)}")
+
+        if stock_changed:
+            stock_by_store = await get_stock_by_store(token)
+            if any(stock_by_store.values()):
+                changed_stock = live_catalog.apply_stock(stock_by_store)
+                changed_stock_ids |= changed_stock
+                changed += len(changed_stock)
+                logging.info(f"Webhook: остаток изменился у {len(changed_stock)} позиций")
+            if live_catalog.checked_ids is not None:
+                # Каталог содержит только товары с остатком: появившиеся на складе догружаются
+                # При ошибке id не попадают в checked_ids: их запросит полный прогон или следующее событие
+                fetched, requested = await fetch_stocked_products(token, live_catalog.stock_by_store,
+                                                                  live_catalog.checked_ids)
+                live_catalog.checked_ids.update(requested)
+                # Не найденные id не удаляются: это позиции без отметки и компоненты комплектов
+                changed += live_catalog.apply_records("product", [record.id for record in fetched], fetched)
+
+        resolver = live_catalog.bundle_resolver
+        await resolver.backfill(token, bundle_ids=live_catalog.backfill_bundle_ids())
+
+        status = await generate_xml(list(live_catalog.items.values()), bundle_resolver=resolver,
+                                    stock_by_store=live_catalog.stock_by_store, changed_stock_ids=changed_stock_ids)
+        finish_run_metrics(status, time.time() - t_start, trigger="webhook")
+        if status == RUN_UPDATED and feed_cache.active:
+            feed_cache.reload_feeds()
+        logging.info(f"Webhook: фид пересобран за {time.time() - t_start:.1f} с, изменений каталога {changed}, итог {status}")
 
 async def main():
-    global event_loop
+    global event_loop, generation_scheduler, webhook_processor
     event_loop = asyncio.get_running_loop()
 
     # Start Flask server
@@ -668,37 +2722,12 @@ async def main():
     flask_thread.daemon = True
     flask_thread.start()
 
-    # schedule default job but do first update in background
-    schedule.clear()
-    schedule.every().hour.do(lambda: asyncio.create_task(update_xml()))
+    # Первый прогон сразу, далее каждый час (интервал меняется через /control/schedule)
+    generation_scheduler = GenerationScheduler(update_xml, interval_minutes=60)
+    webhook_processor = WebhookProcessor(generation_scheduler)
 
-    # kick off first generation in background
-    asyncio.create_task(update_xml())
-
-    running = True
     try:
-        while running:
-            try:
-                cmd = control_queue.get_nowait()
-            except queue.Empty:
-                cmd = None
-            if cmd:
-                c = cmd.get('cmd')
-                if c == 'generate_now':
-                    logging.info('Control: generate_now received')
-                    asyncio.create_task(update_xml())
-                elif c == 'set_schedule':
-                    minutes = int(cmd.get('minutes', 60))
-                    logging.info(f'Control: set_schedule {minutes} minutes')
-                    schedule.clear()
-                    schedule.every(minutes).minutes.do(lambda: asyncio.create_task(update_xml()))
-                elif c == 'stop':
-                    logging.info('Control: stop received, exiting')
-                    running = False
-                    break
-
-            schedule.run_pending()
-            await asyncio.sleep(1)
+        await generation_scheduler.run()
     except asyncio.CancelledError:
         logging.info('Main loop cancelled')
     except KeyboardInterrupt:
@@ -707,6 +2736,9 @@ async def main():
         logging.exception(f'Unhandled exception in main loop: {e}')
     finally:
         logging.info('Main exiting, stopping Flask thread if running')
+        await ms_client.close()
+        if render_pool is not None:
+            render_pool.shutdown(cancel_futures=True)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Настройка логирования: фоновая запись через очередь, ротация файла и выборочные сообщения.
+
+Записи из кода попадают в QueueHandler (без блокирующего ввода-вывода в цикле событий),
+а QueueListener в отдельном потоке пишет их в файл с ротацией и в консоль. В консоль
+идут предупреждения и ошибки, а также записи с extra=CONSOLE — то, что раньше дублировалось
+через print для журнала GitHub Actions.
+"""
+import atexit
+import datetime
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import sys
+
+# extra для записей, которые нужно показать и в консоли
+CONSOLE = {"console": True}
+
+_listener = None
+
+
+class ConsoleFilter(logging.Filter):
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or getattr(record, "console", False)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """Формат прежних print: [ISO-время] сообщение."""
+
+    def format(self, record):
+        timestamp = datetime.datetime.fromtimestamp(record.created).isoformat()
+        message = record.getMessage()
+        if record.exc_info:
+            message = f"{message}\n{self.formatException(record.exc_info)}"
+        return f"[{timestamp}] {message}"
+
+
+def setup_logging(log_file, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5,
+                  console=True, console_level=logging.WARNING):
+    """
+    Подключает к корневому логгеру очередь и фоновый поток записи; повторный вызов ничего не делает.
+    В дочерних процессах (пул рендеринга импортирует модули заново) логирование не настраивается,
+    чтобы они не открывали и не ротировали тот же файл.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    if multiprocessing.parent_process() is not None:
+        return None
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.addFilter(ConsoleFilter(console_level))
+        console_handler.setFormatter(ConsoleFormatter())
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class LogSampler:
+    """
+    Выборочные сообщения для циклов по офферам: по каждому ключу пишутся первые first
+    сообщений, дальше каждое every-е. Аргументы форматируются только для записанных
+    сообщений, а при выключенном уровне вызов почти ничего не стоит.
+    """
+
+    def __init__(self, first=20, every=1000, logger=None):
+        self.first = first
+        self.every = every
+        self.logger = logger or logging.getLogger()
+        self.counts = {}
+
+    def log(self, level, key, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        if count <= self.first or count % self.every == 0:
+            self.logger.log(level, msg, *args)
+
+    def debug(self, key, msg, *args):
+        self.log(logging.DEBUG, key, msg, *args)
+
+    def warning(self, key, msg, *args):
+        self.log(logging.WARNING, key, msg, *args)
+
+    def suppressed(self):
+        """{ключ: сколько сообщений не записано}."""
+        return {key: count - self.first - (count // self.every - self.first // self.every)
+                for key, count in self.counts.items() if count > self.first}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Рендеринг офферов Kaspi: цены по правилам, XML-фрагменты <offer>, манифест и счетчики.
+
+На вход приходят строки, уже рассчитанные в основном процессе (остатки по складам и цены
+для каждого фида), поэтому модуль не зависит от состояния kaspi_xml_sync и импортируется без
+побочных эффектов. Это позволяет рендерить большой каталог в пуле процессов: строки делятся
+на шарды (split_shards), каждый шард рендерится отдельно, а фрагменты склеиваются в исходном
+порядке под заголовком kaspi_catalog.
+
+Строка оффера — кортеж (id, тип, sku, model, brand, название, код, группа, значения фидов),
+где значения фидов — по одному (availabilities, цена, цена_рассчитана) на фид,
+availabilities — ((storeId, остаток), ...).
+"""
+import hashlib
+from xml.sax.saxutils import escape
+
+COUNT_KEYS = (
+    "with_stock", "with_price", "with_stock_and_price", "offers", "skipped_zero_stock",
+    "bundles_in_xml", "bundles_with_calculated_price", "price_adjusted",
+)
+
+
+def xml_attr(value):
+    """Экранирует значение XML-атрибута в двойных кавычках."""
+    return escape(str(value), {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"})
+
+
+def offer_xml(sku, model, brand, availabilities, price):
+    """XML одного оффера; склады без остатка помечаются available="no"."""
+    entries = "".join(
+        f'<availability available="{"yes" if count > 0 else "no"}" storeId="{xml_attr(point)}" stockCount="{int(count)}" />'
+        for point, count in availabilities
+    )
+    return (
+        f'<offer sku="{xml_attr(sku)}"><model>{escape(model)}</model><brand>{escape(brand)}</brand>'
+        f"<availabilities>{entries}</availabilities>"
+        f"<price>{int(price)}</price></offer>"
+    )
+
+
+def offer_fingerprint(sku, model, brand, stock_count, price):
+    """
+    Канонический хэш оффера: меняется при изменении любого поля, попадающего в XML.
+    stock_count — остаток или {storeId: остаток} для фида с несколькими складами.
+    """
+    if isinstance(stock_count, dict):
+        stock = ",".join(f"{point}:{int(count)}" for point, count in stock_count.items())
+    else:
+        stock = str(int(stock_count))
+    canonical = "\x1f".join((str(sku), str(int(price)), stock, str(model), str(brand)))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class _NullSampler:
+    """Заглушка LogSampler для процессов пула: сообщения по отдельным офферам там не пишутся."""
+
+    def debug(self, key, msg, *args):
+        pass
+
+    def warning(self, key, msg, *args):
+        pass
+
+
+def render_offers(rows, feed_count, price_rules, sampler=None, writers=None):
+    """
+    Рендерит строки офферов для feed_count фидов: [(XML-фрагмент, манифест, счетчики)] по фидам.
+    Манифест — {sku: [хэш, цена, остаток]}; остаток — число для одного склада и {storeId: остаток}
+    для нескольких. Если переданы writers (по одному на фид), офферы сразу пишутся в них
+    методом write_fragment, а фрагменты возвращаются пустыми.
+    """
+    sampler = sampler or _NullSampler()
+    parts = [[] for _ in range(feed_count)]
+    manifests = [{} for _ in range(feed_count)]
+    counts = [dict.fromkeys(COUNT_KEYS, 0) for _ in range(feed_count)]
+
+    for product_id, entity_type, sku, model, brand, name, code, folder, feed_values in rows:
+        for index, (availabilities, price, price_calculated) in enumerate(feed_values):
+            feed_counts = counts[index]
+            if entity_type == "bundle":
+                sampler.debug("bundle_stock", "Комплект %s (ID: %s) доступен в кол-ве %s по компонентам.",
+                              name or 'Unknown', product_id, availabilities)
+
+            if not any(count for _, count in availabilities):
+                feed_counts["skipped_zero_stock"] += 1
+                sampler.debug("zero_stock", "Продукт %s (ID: %s) имеет нулевой остаток, пропускаем.", name or 'Unknown', product_id)
+                continue
+
+            if price is None:
+                # Цена компонента неизвестна (например, не догрузился): комплект не выгружается
+                sampler.warning("bundle_price_unknown", "Цена комплекта %s (ID: %s) неизвестна, пропускаем.",
+                                name or 'Unknown', product_id)
+                continue
+
+            feed_counts["with_stock"] += 1
+
+            # Цена из типа цены фида (без fallback); у комплекта с нулевой ценой — сумма компонентов
+            if price_calculated:
+                feed_counts["bundles_with_calculated_price"] += 1
+                sampler.debug("bundle_price", "Цена комплекта %s рассчитана как сумма компонентов: %s", name, price)
+            elif price:
+                sampler.debug("price_found", "Найдена цена Каспи для %s %s: %s", entity_type, name, price)
+
+            if price == 0:
+                sampler.warning("no_price", "Не найдено цен для товара %s (артикул: %s) - тип: %s", name, code, entity_type)
+            else:
+                original_price = price
+                price = price_rules.apply(price, sku=sku, folder=folder)
+                if price != original_price:
+                    feed_counts["price_adjusted"] += 1
+                    sampler.debug("price_adjusted", "Цена скорректирована для %s %s: %s -> %s",
+                                  entity_type, name, original_price, price)
+                feed_counts["with_price"] += 1
+                feed_counts["with_stock_and_price"] += 1
+                if entity_type == "bundle":
+                    feed_counts["bundles_in_xml"] += 1
+                    sampler.debug("bundle_in_xml", "Комплект %s (ID: %s) имеет цену %s и будет включен в XML",
+                                  name, product_id, price)
+
+            text = offer_xml(sku, model, brand, availabilities, price)
+            if writers is not None:
+                writers[index].write_fragment(text)
+            else:
+                parts[index].append(text)
+            stock_value = availabilities[0][1] if len(availabilities) == 1 else dict(availabilities)
+            manifests[index][sku] = [offer_fingerprint(sku, model, brand, stock_value, price), int(price), stock_value]
+            feed_counts["offers"] += 1
+
+    return [("".join(feed_parts), manifest, feed_counts)
+            for feed_parts, manifest, feed_counts in zip(parts, manifests, counts)]
+
+
+def split_shards(rows, shards):
+    """Делит строки на shards непрерывных частей примерно равного размера (порядок сохраняется)."""
+    if not rows:
+        return []
+    shards = max(1, min(shards, len(rows)))
+    size = -(-len(rows) // shards)
+    return [rows[start:start + size] for start in range(0, len(rows), size)]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Контрольные точки постраничной загрузки (SQLite): прерванный прогон продолжает с сохраненных страниц.
+
+Поток — одна постраничная выгрузка (URL и параметры без offset). Каждая успешно загруженная
+страница сохраняется сразу; после полной загрузки поток удаляется, поэтому в файле остаются
+только страницы прерванных прогонов. Следующий прогон (или повтор job в GitHub Actions)
+загружает первую страницу заново и, если размер выгрузки (meta.size) не изменился, берет
+остальные страницы из контрольной точки. Потоки старше max_age_seconds удаляются при открытии
+и не используются — устаревшие данные не смешиваются со свежими.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def stream_key(*parts):
+    """Ключ потока по URL, параметрам (без offset) и прочему, что влияет на содержимое страниц."""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class PageCheckpoint:
+    def __init__(self, path, max_age_seconds):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS streams (stream TEXT PRIMARY KEY, size INTEGER, created REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "stream TEXT NOT NULL, page_offset INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (stream, page_offset))")
+        self.purge_expired()
+
+    def close(self):
+        self._conn.close()
+
+    def purge_expired(self):
+        """Удаляет потоки старше max_age_seconds вместе со страницами."""
+        cutoff = time.time() - self.max_age_seconds
+        self._conn.execute("DELETE FROM streams WHERE created < ?", (cutoff,))
+        self._conn.execute("DELETE FROM pages WHERE stream NOT IN (SELECT stream FROM streams)")
+        self._conn.commit()
+
+    def begin(self, stream, size):
+        """
+        Начинает (или продолжает) поток с meta.size = size и возвращает offset сохраненных страниц.
+        Если размер изменился или поток устарел, сохраненные страницы отбрасываются.
+        """
+        row = self._conn.execute("SELECT size, created FROM streams WHERE stream = ?", (stream,)).fetchone()
+        if row is not None and row[0] == size and row[1] >= time.time() - self.max_age_seconds:
+            cursor = self._conn.execute("SELECT page_offset FROM pages WHERE stream = ?", (stream,))
+            return {offset for (offset,) in cursor}
+        self.finish(stream)
+        self._conn.execute("INSERT INTO streams (stream, size, created) VALUES (?, ?, ?)", (stream, size, time.time()))
+        self._conn.commit()
+        return set()
+
+    def load(self, stream, offset):
+        """Данные сохраненной страницы или None."""
+        row = self._conn.execute(
+            "SELECT data FROM pages WHERE stream = ? AND page_offset = ?", (stream, offset)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, stream, offset, data):
+        self._conn.execute(
+            "INSERT INTO pages (stream, page_offset, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(stream, page_offset) DO UPDATE SET data = excluded.data",
+            (stream, offset, json.dumps(data, ensure_ascii=False)),
+        )
+        self._conn.commit()
+
+    def finish(self, stream):
+        """Поток загружен целиком (или его страницы больше не годятся): удаляет его."""
+        self._conn.execute("DELETE FROM pages WHERE stream = ?", (stream,))
+        self._conn.execute("DELETE FROM streams WHERE stream = ?", (stream,))
+        self._conn.commit()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Конвейер обработки страниц: стадии, связанные ограниченными очередями asyncio.
+
+Источник (например, загрузка страниц МойСклад) передает элементы через put(), каждая стадия —
+функция, которая выполняется в цикле событий, пока следующие страницы еще загружаются
+(стадия может вернуть awaitable, например чтобы дождаться остатков перед первой страницей). Очереди между стадиями ограничены (maxsize), поэтому быстрый источник ждет
+медленную стадию, а в памяти одновременно находится не больше нескольких сырых страниц.
+
+Для каждой стадии считаются элементы, время работы, время ожидания свободного места в
+следующей очереди (backpressure) и глубина входной очереди — stats() отдает их для отчета.
+"""
+import asyncio
+import inspect
+import time
+
+_DONE = object()
+
+
+class StageStats:
+    """Счетчики одной стадии конвейера."""
+    __slots__ = ("name", "items", "busy_seconds", "blocked_seconds", "max_depth", "depth_total", "samples", "started", "finished")
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self.depth_total = 0
+        self.samples = 0
+        self.started = None
+        self.finished = None
+
+    def observe_depth(self, depth):
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_total += depth
+        self.samples += 1
+
+    def as_dict(self):
+        elapsed = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        return {
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "items_per_second": round(self.items / elapsed, 1) if elapsed > 0 else None,
+            "max_queue_depth": self.max_depth,
+            "mean_queue_depth": round(self.depth_total / self.samples, 2) if self.samples else 0,
+        }
+
+
+class Pipeline:
+    """
+    Последовательность стадий [(имя, функция)]: функция получает элемент и возвращает элемент
+    для следующей стадии (None — дальше не передавать). Использование:
+
+        pipeline = Pipeline("fetch", [("normalize", f1), ("emit", f2)], maxsize=4)
+        pipeline.start()
+        await pipeline.put(page)   # из источника, ждет при заполненной очереди
+        await pipeline.close()     # дожидается обработки всех элементов, ошибку стадии пробрасывает
+    """
+
+    def __init__(self, source_name, stages, maxsize=4):
+        self.source = StageStats(source_name)
+        self.stages = [(StageStats(name), func) for name, func in stages]
+        self.queues = [asyncio.Queue(maxsize=max(1, maxsize)) for _ in self.stages]
+        self.error = None
+        self._tasks = []
+        self._aborted = asyncio.Event()
+
+    def start(self):
+        self.source.started = time.perf_counter()
+        self._tasks = [asyncio.create_task(self._worker(index)) for index in range(len(self.stages))]
+
+    async def _put(self, index, item, stats):
+        queue = self.queues[index]
+        if queue.full():
+            waited = time.perf_counter()
+            await queue.put(item)
+            stats.blocked_seconds += time.perf_counter() - waited
+        else:
+            queue.put_nowait(item)
+
+    async def put(self, item):
+        """Передает элемент источника в первую стадию; ошибка любой стадии или abort() прерывает источник."""
+        if self.error is not None:
+            raise self.error
+        queue = self.queues[0]
+        if queue.full():
+            # Ждем место в очереди или остановку конвейера, чтобы параллельные загрузки не зависли
+            waited = time.perf_counter()
+            put = asyncio.ensure_future(queue.put(item))
+            aborted = asyncio.ensure_future(self._aborted.wait())
+            await asyncio.wait((put, aborted), return_when=asyncio.FIRST_COMPLETED)
+            aborted.cancel()
+            if not put.done():
+                put.cancel()
+                raise self.error
+            self.source.blocked_seconds += time.perf_counter() - waited
+        else:
+            queue.put_nowait(item)
+        self.source.items += 1
+
+    async def _worker(self, index):
+        stats, func = self.stages[index]
+        queue = self.queues[index]
+        last = index == len(self.stages) - 1
+        stats.started = time.perf_counter()
+        while True:
+            stats.observe_depth(queue.qsize())
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if self.error is not None:
+                # После ошибки очередь только вычерпывается, чтобы источник не ждал вечно
+                continue
+            started = time.perf_counter()
+            try:
+                result = func(item)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                self.error = e
+                continue
+            finally:
+                stats.busy_seconds += time.perf_counter() - started
+            stats.items += 1
+            if not last and result is not None:
+                await self._put(index + 1, result, stats)
+        stats.finished = time.perf_counter()
+        if not last:
+            await self.queues[index + 1].put(_DONE)
+
+    async def close(self):
+        """Завершает источник и ждет все стадии; пробрасывает первую ошибку стадии."""
+        self.source.finished = time.perf_counter()
+        await self.queues[0].put(_DONE)
+        await asyncio.gather(*self._tasks)
+        if self.error is not None:
+            raise self.error
+
+    async def abort(self):
+        """Останавливает стадии без обработки оставшихся элементов (ошибка источника)."""
+        if self.error is None:
+            self.error = RuntimeError("конвейер остановлен")
+        self._aborted.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        """{стадия: счетчики}, первым — источник."""
+        result = {self.source.name: self.source.as_dict()}
+        for stats, _ in self.stages:
+            result[stats.name] = stats.as_dict()
+        return result
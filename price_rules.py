@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Правила корректировки цен Каспи (price_adjustments.json).
+
+JSON один раз проверяется и компилируется в неизменяемый объект PriceRules; дальше цена
+каждого оффера считается без разбора JSON: точные цены — поиск в словаре, диапазоны — bisect.
+
+Формат файла (все разделы необязательны):
+
+    {
+      "exact_price_adjustments": {"1000": {"operation": "add", "value": -1}},
+      "range_price_adjustments": [
+        {"min": 0, "max": 4999, "operation": "percent", "value": 10}
+      ],
+      "sku_overrides": {"SKU-1": {"operation": "set", "value": 1990}},
+      "folder_overrides": {"<id группы товаров>": {"operation": "percent", "value": 5}},
+      "rounding": {"step": 100, "ending": 90, "direction": "up", "min_price": 1000}
+    }
+
+Операции: add, subtract, set (целые тенге) и percent (наценка в процентах, может быть
+отрицательной). Применяется одно правило с наивысшим приоритетом: артикул, группа товаров,
+точная цена, диапазон. Затем цена округляется до «психологической» (например 1234 -> 1290),
+если задан rounding и у правила нет "round": false.
+"""
+import bisect
+import json
+import logging
+import os
+
+OPERATIONS = ("add", "subtract", "set", "percent")
+ROUNDING_DIRECTIONS = ("up", "down", "nearest")
+
+
+class PriceRuleError(ValueError):
+    """Ошибка в файле правил: файл не применяется целиком."""
+
+
+class Adjustment:
+    """Одно скомпилированное правило."""
+    __slots__ = ("operation", "value", "round")
+
+    def __init__(self, operation, value, round=True):
+        self.operation = operation
+        self.value = value
+        self.round = round
+
+    def apply(self, price):
+        if self.operation == "add":
+            return price + self.value
+        if self.operation == "subtract":
+            return price - self.value
+        if self.operation == "set":
+            return self.value
+        return int(price * (100 + self.value) / 100 + 0.5)
+
+
+def _compile_adjustment(rule, where):
+    if not isinstance(rule, dict):
+        raise PriceRuleError(f"{where}: правило должно быть объектом")
+    operation = rule.get("operation")
+    if operation not in OPERATIONS:
+        raise PriceRuleError(f"{where}: неизвестная операция '{operation}'")
+    value = rule.get("value", 0)
+    try:
+        value = float(value) if operation == "percent" else int(value)
+    except (TypeError, ValueError):
+        raise PriceRuleError(f"{where}: некорректное значение value: {value!r}")
+    if operation == "percent" and value <= -100:
+        raise PriceRuleError(f"{where}: скидка не может быть 100% и больше")
+    return Adjustment(operation, value, rule.get("round", True) is not False)
+
+
+def _parse_price(value, where):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise PriceRuleError(f"{where}: цена должна быть целым числом: {value!r}")
+
+
+class PriceRules:
+    """Неизменяемый набор скомпилированных правил."""
+    __slots__ = ("exact", "range_starts", "range_ends", "range_rules", "sku", "folder", "rounding")
+
+    def __init__(self, exact, ranges, sku, folder, rounding):
+        self.exact = exact
+        self.range_starts = [start for start, _, _ in ranges]
+        self.range_ends = [end for _, end, _ in ranges]
+        self.range_rules = [rule for _, _, rule in ranges]
+        self.sku = sku
+        self.folder = folder
+        self.rounding = rounding
+
+    def __len__(self):
+        return len(self.exact) + len(self.range_rules) + len(self.sku) + len(self.folder)
+
+    def find(self, price, sku=None, folder=None):
+        """Правило для цены: по артикулу, группе, точной цене, затем по диапазону."""
+        rule = self.sku.get(sku) if sku is not None else None
+        if rule is None and folder is not None:
+            rule = self.folder.get(folder)
+        if rule is None:
+            rule = self.exact.get(price)
+        if rule is None and self.range_starts:
+            index = bisect.bisect_right(self.range_starts, price) - 1
+            if index >= 0 and price <= self.range_ends[index]:
+                rule = self.range_rules[index]
+        return rule
+
+    def round_price(self, price):
+        """
+        Ближайшая цена вида k * step + ending в направлении direction. Цены ниже min_price не меняются,
+        как и цены, для которых при direction "down" нет меньшего положительного варианта.
+        """
+        step, ending, direction, min_price = self.rounding
+        if price < min_price:
+            return price
+        down = (price - ending) // step * step + ending
+        if down <= 0:
+            # Единственный положительный вариант больше цены: округление вниз ее бы подняло
+            return price if direction == "down" else down + step
+        if down == price or direction == "down":
+            return down
+        up = down + step
+        if direction == "up" or up - price <= price - down:
+            return up
+        return down
+
+    def apply(self, price, sku=None, folder=None):
+        """Итоговая цена оффера; цены <= 0 не меняются, результат не бывает отрицательным."""
+        if price <= 0:
+            return price
+        rule = self.find(price, sku, folder)
+        adjusted = price
+        if rule is not None:
+            adjusted = rule.apply(price)
+        if self.rounding is not None and (rule is None or rule.round) and adjusted > 0:
+            adjusted = self.round_price(adjusted)
+        if adjusted < 0:
+            logging.warning(f"Скорректированная цена стала отрицательной ({adjusted}) для исходной цены {price}. Используем 0.")
+            adjusted = 0
+        return adjusted
+
+
+def compile_price_rules(data):
+    """Проверяет JSON правил и возвращает PriceRules; при ошибке — PriceRuleError."""
+    if not isinstance(data, dict):
+        raise PriceRuleError("Корень JSON должен быть объектом")
+
+    exact = {}
+    for price, rule in (data.get("exact_price_adjustments") or {}).items():
+        where = f"exact_price_adjustments[{price}]"
+        exact[_parse_price(price, where)] = _compile_adjustment(rule, where)
+
+    ranges = []
+    for index, rule in enumerate(data.get("range_price_adjustments") or []):
+        where = f"range_price_adjustments[{index}]"
+        if not isinstance(rule, dict):
+            raise PriceRuleError(f"{where}: правило должно быть объектом")
+        start = _parse_price(rule.get("min", 0), where)
+        end = _parse_price(rule["max"], where) if rule.get("max") is not None else float("inf")
+        if end < start:
+            raise PriceRuleError(f"{where}: max меньше min")
+        ranges.append((start, end, _compile_adjustment(rule, where)))
+    ranges.sort(key=lambda item: item[0])
+    for previous, current in zip(ranges, ranges[1:]):
+        if current[0] <= previous[1]:
+            raise PriceRuleError(f"Диапазоны цен пересекаются: {previous[0]}-{previous[1]} и {current[0]}-{current[1]}")
+
+    sku = {str(key): _compile_adjustment(rule, f"sku_overrides[{key}]")
+           for key, rule in (data.get("sku_overrides") or {}).items()}
+    folder = {str(key): _compile_adjustment(rule, f"folder_overrides[{key}]")
+              for key, rule in (data.get("folder_overrides") or {}).items()}
+
+    rounding = None
+    spec = data.get("rounding")
+    if spec:
+        if not isinstance(spec, dict):
+            raise PriceRuleError("rounding должен быть объектом")
+        step = _parse_price(spec.get("step", 100), "rounding.step")
+        ending = _parse_price(spec.get("ending", 0), "rounding.ending")
+        direction = spec.get("direction", "up")
+        if step <= 0 or not 0 <= ending < step:
+            raise PriceRuleError("rounding: нужно step > 0 и 0 <= ending < step")
+        if direction not in ROUNDING_DIRECTIONS:
+            raise PriceRuleError(f"rounding: неизвестное направление '{direction}'")
+        rounding = (step, ending, direction, _parse_price(spec.get("min_price", 0), "rounding.min_price"))
+
+    return PriceRules(exact, ranges, sku, folder, rounding)
+
+
+class PriceRulesLoader:
+    """
+    Загружает и компилирует файл правил, перечитывая его только при изменении mtime/размера.
+    Если новый файл содержит ошибку, продолжают действовать предыдущие правила
+    (или правила по умолчанию, если корректного файла еще не было).
+    """
+
+    def __init__(self, path, default_rules):
+        self.path = path
+        self.default = compile_price_rules(default_rules)
+        self.rules = None
+        self._stat_key = None
+
+    def get(self):
+        try:
+            st = os.stat(self.path)
+            stat_key = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            if self._stat_key != "missing":
+                logging.warning(f"Файл правил цен не найден: {self.path}. Используются значения по умолчанию.")
+                self._stat_key = "missing"
+                self.rules = None
+            return self.default
+        if stat_key == self._stat_key:
+            return self.rules or self.default
+        self._stat_key = stat_key
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.rules = compile_price_rules(json.load(f))
+            logging.info(f"Загружены правила корректировки цен из {self.path}: {len(self.rules)} правил"
+                         f"{', с округлением' if self.rules.rounding else ''}")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки правил цен из {self.path}: {e}. "
+                          f"{'Оставлены предыдущие правила' if self.rules else 'Используются значения по умолчанию'}.")
+        return self.rules or self.default
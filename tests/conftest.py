@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Общие настройки тестов: окружение до импорта kaspi_xml_sync и локальная замена API МойСклад."""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# kaspi_xml_sync читает настройки при импорте: кэши, фид и лог — во временном каталоге
+# (фид и манифест задаются относительными путями, у каждого теста свой рабочий каталог)
+WORKDIR = tempfile.mkdtemp(prefix="kaspi_tests_")
+os.chdir(WORKDIR)
+os.environ.update({
+    "MS_LOGIN": "benchmark",
+    "MS_PASSWORD": "benchmark",
+    "CATALOG_DB": "",
+    "FETCH_CHECKPOINT_DB": "",
+    "MS_TOKEN_CACHE_HOURS": "0",
+    "METADATA_CACHE_FILE": os.path.join(WORKDIR, ".cache", "metadata.json"),
+    "PRICE_RULES_FILE": os.path.join(WORKDIR, "price_adjustments.json"),
+    "LOG_FILE": os.path.join(WORKDIR, "kaspi_xml_sync.log"),
+    "LOG_CONSOLE": "0",
+    "XML_FILE": "kaspi.xml",
+    "FORCE_PUBLISH": "1",
+})
+
+# Без правил корректировки: цены в фиде совпадают с ценами каталога
+with open(os.environ["PRICE_RULES_FILE"], "w", encoding="utf-8") as f:
+    f.write("{}")
+
+import kaspi_xml_sync  # noqa: E402
+from fake_moysklad import FakeMoySklad, SyntheticCatalog  # noqa: E402
+
+
+@pytest.fixture
+def fake_api(tmp_path, monkeypatch):
+    """
+    Запускает сценарий async def scenario(server) в новом цикле событий с локальной заменой
+    API МойСклад: run(scenario, products=..., bundles=..., **параметры сервера).
+    """
+
+    monkeypatch.chdir(tmp_path)
+
+    def run(scenario, products=200, bundles=20, latency=0.0, catalog_options=None, **server_options):
+        async def main():
+            catalog = SyntheticCatalog(products=products, bundles=bundles,
+                                       attribute_id=kaspi_xml_sync.ATTRIBUTE_ID,
+                                       price_type_id=kaspi_xml_sync.KASPI_PRICE_TYPE_ID, **(catalog_options or {}))
+            server = FakeMoySklad(catalog, latency=latency, rate_limit=0, max_parallel=0, **server_options)
+            kaspi_xml_sync.MS_API_BASE = await server.start()
+            # Клиент и блокировка привязаны к циклу событий: у каждого теста свои
+            kaspi_xml_sync.ms_client = kaspi_xml_sync.MoySkladClient()
+            kaspi_xml_sync.token_refresh_lock = asyncio.Lock()
+            kaspi_xml_sync.current_token = None
+            # href складов из прошлых тестов указывают на другие экземпляры сервера
+            kaspi_xml_sync.metadata_cache = kaspi_xml_sync.MetadataCache(str(tmp_path / "metadata.json"))
+            try:
+                return await scenario(server)
+            finally:
+                await kaspi_xml_sync.ms_client.close()
+                await server.stop()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""BundleResolver: пересчет комплектов при изменении только остатков и цены при недогруженных компонентах."""
+import asyncio
+
+import pytest
+
+import kaspi_xml_sync
+from kaspi_xml_sync import BundleResolver, OfferRecord
+
+
+def product(entity_id, price=100):
+    return OfferRecord(entity_id, "product", entity_id, entity_id, None, price, None, None, True)
+
+
+def bundle(entity_id, components):
+    return OfferRecord(entity_id, "bundle", entity_id, entity_id, None, 0, tuple(components), None, True)
+
+
+def make_records():
+    return [
+        product("p1"), product("p2"), product("p3"),
+        bundle("b1", [("p1", "product", 1, 100), ("p2", "product", 2, 100)]),
+        bundle("b2", [("p3", "product", 1, 100)]),
+        # Вложенный комплект: зависит от p1 через b1
+        bundle("b3", [("b1", "bundle", 1, None), ("p3", "product", 1, 100)]),
+    ]
+
+
+def test_changed_ids_recompute_only_dependent_bundles(monkeypatch):
+    stock = {"p1": 5, "p2": 10, "p3": 7}
+    resolver = BundleResolver(make_records())
+    resolver.resolve(stock)
+
+    computed = []
+    original = BundleResolver._bundle_stock
+
+    def spy(self, bundle_id, stock_data, visiting, cache):
+        if bundle_id not in cache:
+            computed.append(bundle_id)
+        return original(self, bundle_id, stock_data, visiting, cache)
+
+    monkeypatch.setattr(BundleResolver, "_bundle_stock", spy)
+    stock = dict(stock, p1=1)
+    values = resolver.resolve(stock, changed_ids={"p1"})
+
+    assert set(computed) == {"b1", "b3"}
+    monkeypatch.setattr(BundleResolver, "_bundle_stock", original)
+    assert values == BundleResolver(make_records()).resolve(stock)
+    assert values["b1"][0] == 1 and values["b3"][0] == 1 and values["b2"][0] == 7
+
+
+def test_webhook_passes_changed_stock_ids(monkeypatch):
+    """generate_xml передает id с изменившимся остатком в resolve, а не пересчитывает все комплекты."""
+    seen = []
+    original = BundleResolver.resolve
+
+    def spy(self, stock_data, changed_ids=None, **kwargs):
+        seen.append(changed_ids)
+        return original(self, stock_data, changed_ids=changed_ids, **kwargs)
+
+    monkeypatch.setattr(BundleResolver, "resolve", spy)
+    resolver = BundleResolver(make_records())
+    kaspi_xml_sync.resolve_bundle_values(resolver, {code: {"p1": 1} for code in kaspi_xml_sync.STORE_CODES}, {"p1"})
+    assert seen and all(changed_ids == {"p1"} for changed_ids in seen)
+
+
+def test_failed_backfill_does_not_price_missing_component_as_zero(monkeypatch):
+    async def unavailable(token, entity_type, ids, **kwargs):
+        raise kaspi_xml_sync.MsApiError("503 Service Unavailable", 503)
+
+    monkeypatch.setattr(kaspi_xml_sync, "fetch_entities_by_ids", unavailable)
+    # Цена px не развернута в assortment, компонент нужно догрузить
+    resolver = BundleResolver([product("p1"), bundle("b1", [("p1", "product", 1, 100), ("px", "product", 1, None)])])
+
+    with pytest.raises(kaspi_xml_sync.MsApiError):
+        asyncio.run(resolver.backfill("token"))
+    # Ошибка загрузки не делает компонент отсутствующим: следующая догрузка запросит его снова
+    assert resolver.missing_components() == {"product": ["px"]}
+    assert resolver.resolve({"p1": 5, "px": 5})["b1"] == (5, None, False)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Инкрементальная синхронизация каталога (CATALOG_DB)."""
+import time
+
+import pytest
+
+import kaspi_xml_sync
+from fake_moysklad import entity_id, SyntheticCatalog
+
+
+@pytest.fixture
+def catalog_db(monkeypatch, tmp_path):
+    monkeypatch.setattr(kaspi_xml_sync, "CATALOG_DB", str(tmp_path / "catalog.sqlite3"))
+    monkeypatch.setattr(kaspi_xml_sync, "catalog_store", None)
+    yield
+    if kaspi_xml_sync.catalog_store is not None:
+        kaspi_xml_sync.catalog_store.close()
+
+
+def find_bundle(catalog):
+    """Комплект без своей цены с одним компонентом не из фида (товар без отметки) и без вложенных."""
+    for index in range(1, catalog.bundles, 2):
+        components = catalog.components(index)
+        unflagged = [(comp_index, quantity) for comp_type, comp_index, quantity in components
+                     if comp_type == "product" and not catalog.is_flagged("product", comp_index)]
+        if len(unflagged) == 1 and all(comp_type == "product" for comp_type, _, _ in components):
+            return index, unflagged[0]
+    raise AssertionError("в каталоге нет подходящего комплекта")
+
+
+def test_incremental_sync_refreshes_component_prices(fake_api, catalog_db):
+    async def scenario(server):
+        catalog = server.catalog
+        bundle_index, (component_index, quantity) = find_bundle(catalog)
+        bundle_id = entity_id(SyntheticCatalog.BUNDLE, bundle_index)
+
+        async def bundle_price():
+            fetched, state = await kaspi_xml_sync.prepare_catalog(time.time())
+            return state.bundle_resolver.resolve(fetched.stock_by_store[kaspi_xml_sync.STORE_CODES[0]])[bundle_id][1]
+
+        price = await bundle_price()  # полная сверка
+        assert not kaspi_xml_sync.get_catalog_store().needs_full_sync("bundle", kaspi_xml_sync.CATALOG_FULL_SYNC_HOURS)
+        # Водяные знаки сдвигаются за начальный updated: комплект из теста больше не перезагружается
+        other_bundle = next(i for i in range(catalog.bundles) if i != bundle_index)
+        catalog.touched[("bundle", other_bundle)] = "2026-01-15 00:00:00.000"
+        catalog.touched[("product", 1)] = "2026-01-15 00:00:00.000"
+        assert await bundle_price() == price
+
+        catalog.price_overrides[component_index] = catalog.price(component_index) + 5000
+        catalog.touched[("product", component_index)] = "2026-02-01 00:00:00.000"
+        requests_before = server.stats["by_path"].get("/entity/bundle", 0)
+        assert await bundle_price() == price + 5000 * quantity
+        # Сам комплект при этом не перезагружался
+        assert server.stats["by_path"].get("/entity/bundle", 0) - requests_before == 1
+
+    fake_api(scenario, products=300, bundles=40)
+
+
+def test_failed_component_backfill_keeps_previous_feed(fake_api, catalog_db, monkeypatch):
+    monkeypatch.setattr(kaspi_xml_sync, "MS_PAGE_RETRIES", 0)
+
+    async def scenario(server):
+        monkeypatch.setattr(kaspi_xml_sync.ms_client.scheduler, "max_retries", 0)
+        # Водяные знаки за начальным updated: инкрементальный прогон не перезагружает остальные комплекты
+        server.catalog.touched[("bundle", 0)] = "2026-01-15 00:00:00.000"
+        server.catalog.touched[("product", 1)] = "2026-01-15 00:00:00.000"
+        assert await kaspi_xml_sync.update_xml() == kaspi_xml_sync.RUN_UPDATED  # полная сверка
+        with open(kaspi_xml_sync.feed_path(), encoding="utf-8") as f:
+            published = f.read()
+
+        # Инкрементальный прогон догружает компоненты по id, но МойСклад временно недоступен
+        server.failing_id_paths.add("/entity/product")
+        assert await kaspi_xml_sync.update_xml() == kaspi_xml_sync.RUN_FAILED
+        with open(kaspi_xml_sync.feed_path(), encoding="utf-8") as f:
+            assert f.read() == published
+
+    fake_api(scenario, products=300, bundles=40)
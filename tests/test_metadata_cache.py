@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""Кэш токена и метаданных МойСклад."""
+import json
+import time
+
+import kaspi_xml_sync
+
+
+def test_token_not_cached_when_disabled(fake_api, monkeypatch, tmp_path):
+    """При MS_TOKEN_CACHE_HOURS=0 сохраненный ранее токен не используется и удаляется из файла."""
+    monkeypatch.setattr(kaspi_xml_sync, "MS_TOKEN_CACHE_HOURS", 0)
+    path = tmp_path / "metadata.json"
+
+    async def scenario(server):
+        path.write_text(json.dumps({
+            "token": {"value": "cached-token", "expires": time.time() + 3600},
+            "store_href:main": {"value": "href", "expires": time.time() + 3600},
+        }), encoding="utf-8")
+        assert await kaspi_xml_sync.ensure_token_is_valid()
+        return kaspi_xml_sync.current_token
+
+    assert fake_api(scenario) == "benchmark-token"
+    entries = json.loads(path.read_text(encoding="utf-8"))
+    assert "token" not in entries
+    assert "store_href:main" in entries
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Конвейер STREAM_PIPELINE: загрузка страниц ждет отстающую стадию."""
+import asyncio
+
+import kaspi_xml_sync
+from pipeline import Pipeline
+
+CONCURRENCY = 4
+QUEUE_SIZE = 1
+
+
+def test_page_sink_backpressure_bounds_raw_pages(fake_api):
+    """Загруженных, но не принятых стадией страниц не больше concurrency + maxsize."""
+
+    async def scenario(server):
+        assert await kaspi_xml_sync.ensure_token_is_valid()
+        fetched = lambda: server.stats["by_path"].get("/entity/bundle", 0)
+        taken = []
+        in_flight = []
+
+        async def slow_stage(item):
+            taken.append(item[0])
+            in_flight.append(fetched() - len(taken))
+            await asyncio.sleep(0.05)
+
+        pipeline = Pipeline("fetch", [("consume", slow_stage)], maxsize=QUEUE_SIZE)
+        pipeline.start()
+
+        async def sample():
+            while True:
+                in_flight.append(fetched() - len(taken))
+                await asyncio.sleep(0.005)
+
+        sampler = asyncio.create_task(sample())
+        try:
+            await kaspi_xml_sync.fetch_entity_items(
+                kaspi_xml_sync.current_token, "bundle", use_attribute_filter=False, concurrency=CONCURRENCY,
+                page_sink=lambda offset, rows: pipeline.put((offset, rows)))
+            await pipeline.close()
+        finally:
+            sampler.cancel()
+        return taken, in_flight
+
+    taken, in_flight = fake_api(scenario, products=100, bundles=2000)
+    assert sorted(taken) == list(range(0, 2000, 100))
+    # Страницы у загрузчиков (concurrency) и во входной очереди стадии (maxsize)
+    assert max(in_flight) <= CONCURRENCY + QUEUE_SIZE
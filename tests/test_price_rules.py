@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Компиляция правил цен и округление до «психологической» цены."""
+import pytest
+
+from price_rules import compile_price_rules, PriceRuleError
+
+
+def rounding(direction, step=100, ending=99, min_price=0):
+    return compile_price_rules({"rounding": {"step": step, "ending": ending, "direction": direction,
+                                             "min_price": min_price}})
+
+
+@pytest.mark.parametrize("direction, price, expected", [
+    ("up", 1234, 1299),
+    ("up", 1299, 1299),
+    ("up", 10, 99),
+    ("down", 1234, 1199),
+    ("down", 1299, 1299),
+    ("nearest", 1234, 1199),
+    ("nearest", 1260, 1299),
+    ("nearest", 10, 99),
+])
+def test_rounding_modes(direction, price, expected):
+    assert rounding(direction).apply(price) == expected
+
+
+def test_round_down_never_raises_price():
+    rules = rounding("down")
+    for price in (1, 10, 98):
+        assert rules.apply(price) == price
+    assert rules.apply(99) == 99 and rules.apply(150) == 99
+
+
+def test_rounding_skips_prices_below_min_price():
+    rules = rounding("up", min_price=1000)
+    assert rules.apply(950) == 950
+    assert rules.apply(1001) == 1099
+
+
+def test_rule_can_disable_rounding():
+    rules = compile_price_rules({
+        "sku_overrides": {"SKU-1": {"operation": "set", "value": 1234, "round": False}},
+        "range_price_adjustments": [{"min": 0, "max": 4999, "operation": "percent", "value": 10}],
+        "rounding": {"step": 100, "ending": 90, "direction": "up"},
+    })
+    assert rules.apply(1000, sku="SKU-1") == 1234
+    assert rules.apply(1000) == 1190
+
+
+@pytest.mark.parametrize("spec", [
+    {"step": 0},
+    {"step": 100, "ending": 100},
+    {"step": 100, "ending": -1},
+    {"direction": "sideways"},
+])
+def test_invalid_rounding_is_rejected(spec):
+    with pytest.raises(PriceRuleError):
+        compile_price_rules({"rounding": spec})
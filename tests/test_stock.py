@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Остатки по складам фидов: склад берется из FEEDS_CONFIG, источник — MS_STOCK_SOURCE; режим MS_STOCK_FIRST."""
+import os
+
+import pytest
+
+import kaspi_xml_sync
+from fake_moysklad import entity_id, SyntheticCatalog
+
+
+@pytest.mark.parametrize("source", ["report", "current"])
+def test_single_feed_store_uses_its_external_code(fake_api, monkeypatch, source):
+    """Единственный склад фида запрашивается по своему externalCode, а не по STOCK_ID."""
+    monkeypatch.setattr(kaspi_xml_sync, "STORE_CODES", ["otherstore"])
+    monkeypatch.setattr(kaspi_xml_sync, "STOCK_EXTERNAL_CODE", "mainstore")
+    monkeypatch.setattr(kaspi_xml_sync, "MS_STOCK_SOURCE", source)
+
+    async def scenario(server):
+        # Склад «mainstore» заводится первым, чтобы его остатки отличались от «otherstore»
+        server._stores["mainstore"] = 0
+        assert await kaspi_xml_sync.ensure_token_is_valid()
+        stock_by_store = await kaspi_xml_sync.get_stock_by_store(kaspi_xml_sync.current_token)
+        return stock_by_store, dict(server._stores), server.catalog
+
+    stock_by_store, stores, catalog = fake_api(scenario, products=50)
+    assert list(stock_by_store) == ["otherstore"]
+    number = stores["otherstore"]
+    expected = {}
+    for index in range(catalog.products):
+        stock, reserve = catalog.stock(index, number)
+        if stock - reserve > 0:
+            expected[entity_id(SyntheticCatalog.PRODUCT, index)] = stock - reserve
+    assert {key: value for key, value in stock_by_store["otherstore"].items() if value > 0} == expected
+
+
+def test_stock_first_fails_run_when_id_batch_fails(fake_api, monkeypatch):
+    """Неудачная пачка товаров по id не выкидывает товары с остатком из фида: прогон завершается ошибкой."""
+    monkeypatch.setattr(kaspi_xml_sync, "MS_STOCK_FIRST", True)
+    monkeypatch.setattr(kaspi_xml_sync, "MS_PAGE_RETRIES", 0)
+
+    async def scenario(server):
+        monkeypatch.setattr(kaspi_xml_sync.ms_client.scheduler, "max_retries", 0)
+        server.failing_id_paths.add("/entity/product")
+        assert await kaspi_xml_sync.update_xml() == kaspi_xml_sync.RUN_FAILED
+        assert not os.path.exists(kaspi_xml_sync.feed_path())
+
+        server.failing_id_paths.clear()
+        assert await kaspi_xml_sync.update_xml() == kaspi_xml_sync.RUN_UPDATED
+        assert kaspi_xml_sync.live_catalog.checked_ids
+
+    fake_api(scenario, products=500, catalog_options={"in_stock_ratio": 0.1})
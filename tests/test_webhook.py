@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Вебхуки МойСклад: локальная замена API отправляет события в /webhook/moysklad, фид пересобирается по ним."""
+import asyncio
+import re
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+import kaspi_xml_sync
+from fake_moysklad import entity_id, SyntheticCatalog
+
+DEBOUNCE = 0.2
+
+
+@pytest.fixture
+def webhook_url():
+    """Flask-приложение сервиса на свободном порту; URL приема вебхуков."""
+    server = make_server("127.0.0.1", 0, kaspi_xml_sync.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/webhook/moysklad"
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+@pytest.fixture
+def live_service(monkeypatch):
+    """Глобальное состояние сервиса восстанавливается после теста."""
+    for name in ("event_loop", "generation_scheduler", "webhook_processor", "live_catalog"):
+        monkeypatch.setattr(kaspi_xml_sync, name, getattr(kaspi_xml_sync, name))
+
+
+async def start_service(with_catalog=True):
+    """Цикл событий, планировщик и обработчик вебхуков, как в main(); каталог — после полного прогона."""
+    kaspi_xml_sync.event_loop = asyncio.get_running_loop()
+    scheduler = kaspi_xml_sync.GenerationScheduler(kaspi_xml_sync.update_xml)
+    kaspi_xml_sync.generation_scheduler = scheduler
+    processor = kaspi_xml_sync.WebhookProcessor(scheduler, debounce=DEBOUNCE, max_delay=5)
+    kaspi_xml_sync.webhook_processor = processor
+    if with_catalog:
+        assert await kaspi_xml_sync.update_xml() == kaspi_xml_sync.RUN_UPDATED
+        assert kaspi_xml_sync.live_catalog is not None
+    else:
+        kaspi_xml_sync.live_catalog = None
+    return processor
+
+
+async def wait_applied(processor, batches=1, timeout=10):
+    """Ждет применения пачек событий (или перехода к полному прогону)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (processor.stats["batches"] + processor.stats["fallback_runs"] < batches
+           or processor.pending or processor._tasks):
+        assert loop.time() < deadline, f"события не применены: {processor.stats}"
+        await asyncio.sleep(0.02)
+
+
+def product_id(index):
+    return entity_id(SyntheticCatalog.PRODUCT, index)
+
+
+def read_offer(index):
+    """XML оффера товара index из опубликованного фида или None."""
+    with open(kaspi_xml_sync.feed_path(), encoding="utf-8") as f:
+        xml = f.read()
+    match = re.search(rf'<offer sku="{100000 + index}">.*?</offer>', xml, re.S)
+    return match.group(0) if match else None
+
+
+def product_requests(server):
+    return server.stats["by_path"].get("/entity/product", 0)
+
+
+def test_update_event_refetches_only_changed_product(fake_api, webhook_url, live_service):
+    async def scenario(server):
+        processor = await start_service()
+        assert "<price>4321</price>" not in read_offer(3)
+        requests_before = product_requests(server)
+
+        server.catalog.price_overrides[3] = 4321
+        status, body = await server.post_webhook(webhook_url, server.webhook_payload("product", [3]))
+        assert status == 200 and body["events"] == 1
+        await wait_applied(processor)
+
+        assert processor.stats["refetched"] == 1
+        assert product_requests(server) - requests_before == 1
+        assert kaspi_xml_sync.live_catalog.items[product_id(3)].price == 4321
+        assert "<price>4321</price>" in read_offer(3)
+
+    fake_api(scenario)
+
+
+def test_delete_event_removes_offer(fake_api, webhook_url, live_service):
+    async def scenario(server):
+        processor = await start_service()
+        assert read_offer(5) is not None
+        requests_before = product_requests(server)
+
+        server.catalog.deleted.add(5)
+        status, _ = await server.post_webhook(webhook_url, server.webhook_payload("product", [5], action="DELETE"))
+        assert status == 200
+        await wait_applied(processor)
+
+        # Удаленная сущность не перезагружается
+        assert product_requests(server) == requests_before
+        assert product_id(5) not in kaspi_xml_sync.live_catalog.items
+        assert read_offer(5) is None
+
+    fake_api(scenario)
+
+
+def test_stock_event_updates_availability(fake_api, webhook_url, live_service):
+    async def scenario(server):
+        processor = await start_service()
+        code = kaspi_xml_sync.STORE_CODES[0]
+        assert kaspi_xml_sync.live_catalog.stock_by_store[code].get(product_id(7), 0) > 0
+        assert 'available="yes"' in read_offer(7)
+        requests_before = product_requests(server)
+
+        server.catalog.stock_overrides[7] = (0, 0)
+        status, body = await server.post_webhook(webhook_url, server.webhook_payload(stock_changed=True))
+        assert status == 200 and body["stock"] is True
+        await wait_applied(processor)
+
+        # Остатки перечитываются отчетом, товары не перезагружаются
+        assert product_requests(server) == requests_before
+        assert kaspi_xml_sync.live_catalog.stock_by_store[code].get(product_id(7), 0) == 0
+        assert 'available="yes"' not in (read_offer(7) or "")
+
+    fake_api(scenario)
+
+
+def test_events_within_debounce_are_coalesced(fake_api, webhook_url, live_service):
+    async def scenario(server):
+        processor = await start_service()
+        requests_before = product_requests(server)
+
+        for index in (16, 17, 18):
+            server.catalog.price_overrides[index] = 2000 + index
+            await server.post_webhook(webhook_url, server.webhook_payload("product", [index]))
+            await asyncio.sleep(DEBOUNCE / 4)
+        await wait_applied(processor)
+
+        assert processor.stats["events"] == 3
+        assert processor.stats["batches"] == 1
+        # Три события — один запрос товаров по id
+        assert product_requests(server) - requests_before == 1
+        for index in (16, 17, 18):
+            assert f"<price>{2000 + index}</price>" in read_offer(index)
+
+    fake_api(scenario)
+
+
+def test_event_without_live_catalog_triggers_full_run(fake_api, webhook_url, live_service):
+    async def scenario(server):
+        processor = await start_service(with_catalog=False)
+        requests_before = server.stats["requests"]
+
+        status, _ = await server.post_webhook(webhook_url, server.webhook_payload("product", [3]))
+        assert status == 200
+        await wait_applied(processor)
+
+        assert processor.stats == {"events": 1, "batches": 0, "refetched": 0, "fallback_runs": 1}
+        assert kaspi_xml_sync.generation_scheduler.pending
+        assert server.stats["requests"] == requests_before
+
+    fake_api(scenario)
+
+
+def test_failed_refetch_keeps_offer_and_triggers_full_run(fake_api, webhook_url, live_service, monkeypatch):
+    monkeypatch.setattr(kaspi_xml_sync, "MS_PAGE_RETRIES", 0)
+
+    async def scenario(server):
+        processor = await start_service()
+        monkeypatch.setattr(kaspi_xml_sync.ms_client.scheduler, "max_retries", 0)
+        offer = read_offer(3)
+        assert offer is not None
+
+        server.failing_id_paths.add("/entity/product")
+        status, _ = await server.post_webhook(webhook_url, server.webhook_payload("product", [3]))
+        assert status == 200
+        await wait_applied(processor)
+
+        # Временная ошибка МойСклад не удаляет оффер: фид не пересобран, запрошен полный прогон
+        assert product_id(3) in kaspi_xml_sync.live_catalog.items
+        assert read_offer(3) == offer
+        assert kaspi_xml_sync.generation_scheduler.pending
+
+    fake_api(scenario)
+
+
+def test_stock_first_failed_fetch_is_retried_on_next_event(fake_api, webhook_url, live_service, monkeypatch):
+    """MS_STOCK_FIRST: id товара, не загруженного из-за ошибки, не считаются проверенными."""
+    monkeypatch.setattr(kaspi_xml_sync, "MS_STOCK_FIRST", True)
+    monkeypatch.setattr(kaspi_xml_sync, "MS_PAGE_RETRIES", 0)
+
+    async def scenario(server):
+        processor = await start_service()
+        monkeypatch.setattr(kaspi_xml_sync.ms_client.scheduler, "max_retries", 0)
+        catalog = server.catalog
+        # Отмеченный товар без остатка появляется на складе
+        index = next(i for i in range(1, catalog.products)
+                     if catalog.is_flagged("product", i) and catalog.stock(i)[0] == 0)
+        assert product_id(index) not in kaspi_xml_sync.live_catalog.checked_ids
+        catalog.stock_overrides[index] = (5, 0)
+
+        server.failing_id_paths.add("/entity/product")
+        await server.post_webhook(webhook_url, server.webhook_payload(stock_changed=True))
+        await wait_applied(processor)
+        assert product_id(index) not in kaspi_xml_sync.live_catalog.checked_ids
+        assert kaspi_xml_sync.generation_scheduler.pending
+
+        server.failing_id_paths.clear()
+        await server.post_webhook(webhook_url, server.webhook_payload(stock_changed=True))
+        await wait_applied(processor, batches=2)
+        assert product_id(index) in kaspi_xml_sync.live_catalog.checked_ids
+        assert 'available="yes"' in read_offer(index)
+
+    fake_api(scenario, products=500, catalog_options={"in_stock_ratio": 0.1})